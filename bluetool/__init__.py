@@ -36,9 +36,10 @@ def run_config(cfg, dev_list=None):
     return coord.run()
 
 
-def run_bluetest(filename, dev_list=None):
+def load_bluetest(filename):
+    """Load a test script and return its bluetest configuration."""
     if not os.path.exists(filename):
-        raise error.TestError('file does not exist: {}'.filename)
+        raise error.TestError('file does not exist: {}'.format(filename))
     fname = os.path.basename(filename)
     mod_name, ext = os.path.splitext(fname)
     if ext != '.py':
@@ -46,5 +47,8 @@ def run_bluetest(filename, dev_list=None):
 
     import imp
     mod = imp.load_source('bluetest', filename)
-    cfg = getattr(mod, 'bluetest')
-    return run_config(cfg, dev_list)
+    return getattr(mod, 'bluetest')
+
+
+def run_bluetest(filename, dev_list=None):
+    return run_config(load_bluetest(filename), dev_list)
@@ -0,0 +1,361 @@
+"""Advertising data and scan results.
+"""
+import collections
+
+from . import bluez
+from .clock import get_clock
+from .utils import letohs8, letoh16
+
+
+# AD types
+AD_FLAGS = 0x01
+AD_INCOMPLETE_UUID16 = 0x02
+AD_COMPLETE_UUID16 = 0x03
+AD_INCOMPLETE_UUID32 = 0x04
+AD_COMPLETE_UUID32 = 0x05
+AD_INCOMPLETE_UUID128 = 0x06
+AD_COMPLETE_UUID128 = 0x07
+AD_SHORTENED_LOCAL_NAME = 0x08
+AD_COMPLETE_LOCAL_NAME = 0x09
+AD_TX_POWER_LEVEL = 0x0A
+AD_SERVICE_DATA_UUID16 = 0x16
+AD_APPEARANCE = 0x19
+AD_MANUFACTURER_DATA = 0xFF
+
+# Legacy advertising report event types
+ADV_IND = 0x00
+ADV_DIRECT_IND = 0x01
+ADV_SCAN_IND = 0x02
+ADV_NONCONN_IND = 0x03
+SCAN_RSP = 0x04
+
+# Data status of extended advertising report event type
+DATA_STATUS_COMPLETE = 0
+DATA_STATUS_INCOMPLETE = 1
+DATA_STATUS_TRUNCATED = 2
+
+
+def ext_adv_data_status(evt_type):
+    return (evt_type >> 5) & 0x3
+
+
+class AdvData(object):
+    """AD structures of advertising data.
+
+    The data is parsed on first access, so that reports which are only
+    counted or deduplicated never pay for parsing. Parsing stops at a zero
+    length structure (padding) or at a truncated structure.
+    """
+
+    __slots__ = ('data', '_ad')
+
+    def __init__(self, data):
+        self.data = data
+        self._ad = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.ad)
+
+    @property
+    def ad(self):
+        """List of (ad_type, value) in the order of the data."""
+        if self._ad is None:
+            self._ad = parse_ad(self.data)
+        return self._ad
+
+    def get(self, ad_type, default=None):
+        for t, value in self.ad:
+            if t == ad_type:
+                return value
+        return default
+
+    def get_all(self, ad_type):
+        return [value for t, value in self.ad if t == ad_type]
+
+    @property
+    def flags(self):
+        value = self.get(AD_FLAGS)
+        return ord(value[0]) if value else None
+
+    @property
+    def local_name(self):
+        name = self.get(AD_COMPLETE_LOCAL_NAME)
+        if name is None:
+            name = self.get(AD_SHORTENED_LOCAL_NAME)
+        return name
+
+    @property
+    def tx_power_level(self):
+        value = self.get(AD_TX_POWER_LEVEL)
+        return letohs8(value) if value else None
+
+    @property
+    def uuid16(self):
+        uuids = []
+        for value in (self.get_all(AD_INCOMPLETE_UUID16)
+                      + self.get_all(AD_COMPLETE_UUID16)):
+            uuids.extend(letoh16(value, i)
+                         for i in xrange(0, len(value) - 1, 2))
+        return uuids
+
+    @property
+    def manufacturer_data(self):
+        """Tuple of (company_id, data), or None."""
+        value = self.get(AD_MANUFACTURER_DATA)
+        if value is None or len(value) < 2:
+            return None
+        return (letoh16(value), value[2:])
+
+
+def parse_ad(data):
+    """Parse advertising data into a list of (ad_type, value)."""
+    ad = []
+    offset = 0
+    end = len(data)
+    while offset < end:
+        length = ord(data[offset])
+        if length == 0 or offset + 1 + length > end:
+            break
+        ad.append((ord(data[offset + 1]),
+                   data[offset + 2:offset + 1 + length]))
+        offset += 1 + length
+    return ad
+
+
+class ScanResult(object):
+    """Advertising reports of the same advertiser and payload.
+
+    Attributes:
+        addr_type, addr: Address of the advertiser.
+        evt_type: Event type of the last report.
+        data: AdvData of the payload.
+        rssi: RSSI of the last report.
+        rssi_min, rssi_max: Minimum and maximum RSSI.
+        count: Number of reports.
+        first_seen, last_seen: Clock time of the first and last report.
+    """
+
+    __slots__ = ('addr_type', 'addr', 'evt_type', 'data', 'rssi',
+                 'rssi_min', 'rssi_max', 'count', 'first_seen', 'last_seen')
+
+    def __init__(self, evt_type, addr_type, addr, data, rssi, now):
+        self.addr_type = addr_type
+        self.addr = addr
+        self.evt_type = evt_type
+        self.data = AdvData(data)
+        self.rssi = rssi
+        self.rssi_min = rssi
+        self.rssi_max = rssi
+        self.count = 1
+        self.first_seen = now
+        self.last_seen = now
+
+    def __str__(self):
+        return '{}({}, {}, {} dBm, {})'.format(
+            self.__class__.__name__, bluez.ba2str(self.addr),
+            self.addr_type, self.rssi, self.count)
+
+    def update(self, evt_type, rssi, now):
+        self.evt_type = evt_type
+        self.rssi = rssi
+        if rssi < self.rssi_min:
+            self.rssi_min = rssi
+        elif rssi > self.rssi_max:
+            self.rssi_max = rssi
+        self.count += 1
+        self.last_seen = now
+
+
+class ScanResultAggregator(object):
+    """Aggregate advertising reports into ScanResults.
+
+    Reports are deduplicated by (addr_type, addr, hash of payload). At most
+    max_results results are kept; when full, the least recently seen result
+    is evicted, so memory stays bounded however many advertisers are around.
+
+    Attributes:
+        results: OrderedDict of ScanResult, least recently seen first.
+        num_reports: Number of reports added.
+        num_evicted: Number of results evicted.
+    """
+
+    def __init__(self, max_results=1024):
+        super(ScanResultAggregator, self).__init__()
+        self.max_results = max_results
+        self.results = collections.OrderedDict()
+        self.num_reports = 0
+        self.num_evicted = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return self.results.itervalues()
+
+    def add(self, evt_type, addr_type, addr, data, rssi, now=None):
+        """Add a report.
+
+        Returns:
+            bool: True if the report is a new result.
+        """
+        if now is None:
+            now = get_clock().time()
+        self.num_reports += 1
+        key = (addr_type, addr, hash(data))
+        result = self.results.pop(key, None)
+        if result is not None:
+            result.update(evt_type, rssi, now)
+            self.results[key] = result
+            return False
+        if len(self.results) >= self.max_results:
+            self.results.popitem(last=False)
+            self.num_evicted += 1
+        self.results[key] = ScanResult(evt_type, addr_type, addr, data, rssi,
+                                       now)
+        return True
+
+    def add_evt(self, evt):
+        """Add the reports of an LEAdvertisingReportEvent.
+
+        Returns:
+            int: Number of new results.
+        """
+        now = get_clock().time()
+        n_new = 0
+        for i in xrange(0, evt.num_reports):
+            if self.add(evt.evt_type[i], evt.addr_type[i], evt.addr[i],
+                        evt.data[i], evt.rssi[i], now):
+                n_new += 1
+        return n_new
+
+    def find(self, addr):
+        """Return the results of addr, most recently seen first."""
+        return [r for r in reversed(self.results.values()) if r.addr == addr]
+
+
+class ExtAdvertisement(object):
+    """Extended advertisement reassembled from report fragments.
+
+    Attributes:
+        evt_type: Event type of the last fragment.
+        addr_type, addr: Address of the advertiser.
+        primary_phy, secondary_phy: PHYs of the advertisement.
+        adv_sid: Advertising set ID.
+        tx_power, rssi: Tx power and RSSI of the last fragment.
+        periodic_adv_intvl: Periodic advertising interval, or 0.
+        data: AdvData of the reassembled payload.
+        truncated: True if the payload is incomplete.
+        num_fragments: Number of reports the payload was received in.
+    """
+
+    __slots__ = ('evt_type', 'addr_type', 'addr', 'primary_phy',
+                 'secondary_phy', 'adv_sid', 'tx_power', 'rssi',
+                 'periodic_adv_intvl', 'data', 'truncated', 'num_fragments')
+
+    def __str__(self):
+        return '{}({}, {}, sid {}, {} bytes{})'.format(
+            self.__class__.__name__, bluez.ba2str(self.addr), self.addr_type,
+            self.adv_sid, len(self.data), ', truncated' if self.truncated
+            else '')
+
+
+class _ExtAdvChain(object):
+    __slots__ = ('fragments', 'length', 'start')
+
+    def __init__(self, start):
+        self.fragments = []
+        self.length = 0
+        self.start = start
+
+
+class ExtAdvReassembler(object):
+    """Reassemble fragmented extended advertising reports.
+
+    Fragments with data status "incomplete, more data to come" are chained
+    per (addr_type, addr, adv_sid) until the fragment completing the chain.
+    Memory is bounded: a chain exceeding max_data_len is emitted truncated, at
+    most max_chains partial chains are kept (the oldest one is dropped), and
+    partial chains older than timeout seconds are dropped.
+
+    Attributes:
+        num_dropped: Number of partial chains dropped.
+    """
+
+    def __init__(self, timeout=1.0, max_chains=256, max_data_len=1650):
+        super(ExtAdvReassembler, self).__init__()
+        self.timeout = timeout
+        self.max_chains = max_chains
+        self.max_data_len = max_data_len
+        self.chains = collections.OrderedDict()
+        self.num_dropped = 0
+
+    def _emit(self, evt, i, data, truncated, num_fragments):
+        adv = ExtAdvertisement()
+        adv.evt_type = evt.evt_type[i]
+        adv.addr_type = evt.addr_type[i]
+        adv.addr = evt.addr[i]
+        adv.primary_phy = evt.primary_phy[i]
+        adv.secondary_phy = evt.secondary_phy[i]
+        adv.adv_sid = evt.adv_sid[i]
+        adv.tx_power = evt.tx_power[i]
+        adv.rssi = evt.rssi[i]
+        adv.periodic_adv_intvl = evt.periodic_adv_intvl[i]
+        adv.data = AdvData(data)
+        adv.truncated = truncated
+        adv.num_fragments = num_fragments
+        return adv
+
+    def expire(self, now=None):
+        """Drop partial chains older than timeout."""
+        if now is None:
+            now = get_clock().time()
+        chains = self.chains
+        while chains:
+            key, chain = next(chains.iteritems())
+            if now - chain.start < self.timeout:
+                break
+            del chains[key]
+            self.num_dropped += 1
+
+    def add_evt(self, evt, now=None):
+        """Add the reports of an LEExtendedAdvertisingReportEvent.
+
+        Returns:
+            list: ExtAdvertisements completed by the event.
+        """
+        if now is None:
+            now = get_clock().time()
+        self.expire(now)
+        advs = []
+        chains = self.chains
+        for i in xrange(0, evt.num_reports):
+            status = ext_adv_data_status(evt.evt_type[i])
+            key = (evt.addr_type[i], evt.addr[i], evt.adv_sid[i])
+            chain = chains.get(key)
+            if chain is None:
+                if status == DATA_STATUS_COMPLETE:
+                    # Fast path for unfragmented advertisements
+                    advs.append(self._emit(evt, i, evt.data[i], False, 1))
+                    continue
+                if status == DATA_STATUS_TRUNCATED:
+                    advs.append(self._emit(evt, i, evt.data[i], True, 1))
+                    continue
+                if len(chains) >= self.max_chains:
+                    chains.popitem(last=False)
+                    self.num_dropped += 1
+                chain = _ExtAdvChain(now)
+                chains[key] = chain
+            chain.fragments.append(evt.data[i])
+            chain.length += len(evt.data[i])
+            if chain.length > self.max_data_len:
+                status = DATA_STATUS_TRUNCATED
+            if status != DATA_STATUS_INCOMPLETE:
+                del chains[key]
+                data = ''.join(chain.fragments)[:self.max_data_len]
+                advs.append(self._emit(
+                    evt, i, data, status == DATA_STATUS_TRUNCATED,
+                    len(chain.fragments)))
+        return advs
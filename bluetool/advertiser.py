@@ -0,0 +1,261 @@
+"""Extended advertising sets.
+
+AdvSetManager programs any number of extended advertising sets, up to the
+number supported by the controller. Advertising and scan response data longer
+than a single command are fragmented automatically, the commands of all sets
+are pipelined, and all sets are enabled with one multi-set enable command.
+"""
+from . import command as btcmd
+from .clock import Deadline
+from .core import LEHelper
+
+# Advertising event properties
+ADV_PROP_CONNECTABLE = 0x01
+ADV_PROP_SCANNABLE = 0x02
+ADV_PROP_DIRECTED = 0x04
+ADV_PROP_HIGH_DUTY_CYCLE = 0x08
+ADV_PROP_LEGACY = 0x10
+ADV_PROP_ANONYMOUS = 0x20
+ADV_PROP_INCLUDE_TX_POWER = 0x40
+
+# Operations of set extended advertising/scan response data
+DATA_OP_INTERMEDIATE = 0x00
+DATA_OP_FIRST = 0x01
+DATA_OP_LAST = 0x02
+DATA_OP_COMPLETE = 0x03
+DATA_OP_UNCHANGED = 0x04
+
+# Fragment preference
+FRAG_PREF_MAY_FRAGMENT = 0x00
+FRAG_PREF_NO_FRAGMENT = 0x01
+
+PHY_LE_1M = 0x01
+PHY_LE_2M = 0x02
+PHY_LE_CODED = 0x03
+
+# Maximum data length of one set data command (255 - 4 bytes of header)
+MAX_DATA_FRAG_LEN = 251
+
+# Tx power value letting the controller choose
+TX_POWER_NO_PREFERENCE = 0x7F
+
+
+def fragment_adv_data(data, max_frag_len=MAX_DATA_FRAG_LEN):
+    """Split advertising data into (operation, fragment).
+
+    Data fitting in one command is a single complete operation; longer data
+    is split into first, intermediate and last operations.
+    """
+    if len(data) <= max_frag_len:
+        return [(DATA_OP_COMPLETE, data)]
+    frags = []
+    for offset in xrange(0, len(data), max_frag_len):
+        frags.append((DATA_OP_INTERMEDIATE,
+                      data[offset:offset + max_frag_len]))
+    frags[0] = (DATA_OP_FIRST, frags[0][1])
+    frags[-1] = (DATA_OP_LAST, frags[-1][1])
+    return frags
+
+
+class AdvSet(object):
+    """Extended advertising set.
+
+    Attributes:
+        adv_handle: Advertising handle.
+        adv_evt_prop: Advertising event properties.
+        adv_intvl: Primary advertising interval (0.625 ms units).
+        adv_sid: Advertising SID.
+        data: Advertising data.
+        scan_rsp_data: Scan response data.
+        duration: Advertising duration (10 ms units), 0 for no limit.
+        max_ext_adv_events: Maximum number of extended advertising events,
+            0 for no limit.
+        selected_tx_power: Tx power selected by the controller, or None
+            until the set is programmed.
+    """
+
+    def __init__(self, adv_handle, adv_evt_prop, adv_intvl, adv_sid, data,
+                 scan_rsp_data, pri_adv_phy, sec_adv_phy, own_addr_type,
+                 adv_tx_power, pri_adv_ch_map, duration, max_ext_adv_events):
+        super(AdvSet, self).__init__()
+        self.adv_handle = adv_handle
+        self.adv_evt_prop = adv_evt_prop
+        self.adv_intvl = adv_intvl
+        self.adv_sid = adv_sid
+        self.data = data
+        self.scan_rsp_data = scan_rsp_data
+        self.pri_adv_phy = pri_adv_phy
+        self.sec_adv_phy = sec_adv_phy
+        self.own_addr_type = own_addr_type
+        self.adv_tx_power = adv_tx_power
+        self.pri_adv_ch_map = pri_adv_ch_map
+        self.duration = duration
+        self.max_ext_adv_events = max_ext_adv_events
+        self.selected_tx_power = None
+
+    def __str__(self):
+        return '{}(0x{:02x}, sid {}, {} bytes)'.format(
+            self.__class__.__name__, self.adv_handle, self.adv_sid,
+            len(self.data))
+
+    def param_cmd(self):
+        return btcmd.HCILESetExtendedAdvertisingParameters(
+            self.adv_handle, self.adv_evt_prop, self.adv_intvl,
+            self.adv_intvl, self.pri_adv_ch_map, self.own_addr_type, 0,
+            '\x00'*6, 0, self.adv_tx_power, self.pri_adv_phy, 0,
+            self.sec_adv_phy, self.adv_sid, 0)
+
+    def data_cmds(self):
+        return [btcmd.HCILESetExtendedAdvertisingData(
+            self.adv_handle, op, FRAG_PREF_MAY_FRAGMENT, frag)
+                for op, frag in fragment_adv_data(self.data)]
+
+    def scan_rsp_data_cmds(self):
+        return [btcmd.HCILESetExtendedScanResponseData(
+            self.adv_handle, op, FRAG_PREF_MAY_FRAGMENT, frag)
+                for op, frag in fragment_adv_data(self.scan_rsp_data)]
+
+
+class AdvSetManager(LEHelper):
+    """Program and enable extended advertising sets.
+
+    The maximum data length and number of sets are read from the controller
+    capabilities, which are cached.
+
+    Args:
+        hci_sock: HCISock of the advertiser.
+        window: Maximum number of outstanding commands while programming,
+            whatever the controller allows.
+
+    Attributes:
+        adv_sets: Dict of AdvSet keyed by advertising handle.
+    """
+
+    def __init__(self, hci_sock, window=4):
+        super(AdvSetManager, self).__init__(hci_sock)
+        self.window = window
+        self.adv_sets = {}
+        caps = self.read_capabilities()
+        self.max_adv_data_len = caps.max_adv_data_len
+        self.num_supported_adv_sets = caps.num_supported_adv_sets
+
+    def add_set(self, adv_evt_prop=0, adv_intvl=0xA0, data='',
+                scan_rsp_data='', adv_sid=None, pri_adv_phy=PHY_LE_1M,
+                sec_adv_phy=PHY_LE_1M, own_addr_type=0,
+                adv_tx_power=TX_POWER_NO_PREFERENCE, pri_adv_ch_map=0x7,
+                duration=0, max_ext_adv_events=0):
+        """Add an advertising set to be programmed.
+
+        The set gets the lowest free advertising handle, which is also its
+        SID unless adv_sid is given.
+
+        Raises:
+            ValueError: Raised if no more sets are supported or the data is
+                longer than supported.
+        """
+        adv_handle = 0
+        while adv_handle in self.adv_sets:
+            adv_handle += 1
+        if (self.num_supported_adv_sets is not None
+                and adv_handle >= self.num_supported_adv_sets):
+            raise ValueError('{} advertising sets supported'.format(
+                self.num_supported_adv_sets))
+        self._check_data_len(data)
+        self._check_data_len(scan_rsp_data)
+        adv_set = AdvSet(
+            adv_handle, adv_evt_prop, adv_intvl,
+            adv_handle & 0xF if adv_sid is None else adv_sid, data,
+            scan_rsp_data, pri_adv_phy, sec_adv_phy, own_addr_type,
+            adv_tx_power, pri_adv_ch_map, duration, max_ext_adv_events)
+        self.adv_sets[adv_handle] = adv_set
+        return adv_set
+
+    def _check_data_len(self, data):
+        if (self.max_adv_data_len is not None
+                and len(data) > self.max_adv_data_len):
+            raise ValueError('data length {} > {}'.format(
+                len(data), self.max_adv_data_len))
+
+    def _get_sets(self, adv_sets):
+        if adv_sets is None:
+            return [self.adv_sets[h] for h in sorted(self.adv_sets)]
+        return list(adv_sets)
+
+    def program(self, adv_sets=None, timeout=None):
+        """Set the parameters and data of advertising sets.
+
+        Args:
+            adv_sets: AdvSets to program, or None for all sets.
+            timeout: Maximum time in seconds to complete all commands, or a
+                Deadline.
+        """
+        adv_sets = self._get_sets(adv_sets)
+        cmds = []
+        # AdvSet of each command, or None for data commands
+        cmd_sets = []
+        for adv_set in adv_sets:
+            cmds.append(adv_set.param_cmd())
+            cmd_sets.append(adv_set)
+            if adv_set.data:
+                cmds.extend(adv_set.data_cmds())
+            if adv_set.scan_rsp_data:
+                cmds.extend(adv_set.scan_rsp_data_cmds())
+            cmd_sets.extend([None] * (len(cmds) - len(cmd_sets)))
+        evts = self.send_hci_cmds_check_status(cmds, self.window, timeout)
+        for adv_set, evt in zip(cmd_sets, evts):
+            if adv_set is not None:
+                adv_set.selected_tx_power = evt.selected_tx_power
+
+    def set_data(self, adv_set, data, timeout=None):
+        """Change the advertising data of a set.
+
+        Controllers may not accept fragmented data while the set is
+        enabled.
+        """
+        self._check_data_len(data)
+        adv_set.data = data
+        self.send_hci_cmds_check_status(adv_set.data_cmds(), self.window,
+                                        timeout)
+
+    def enable(self, adv_sets=None, timeout=None):
+        """Enable advertising sets with one command.
+
+        Args:
+            adv_sets: AdvSets to enable, or None for all sets.
+            timeout: Maximum time in seconds to complete the command, or a
+                Deadline.
+        """
+        args = []
+        adv_sets = self._get_sets(adv_sets)
+        for adv_set in adv_sets:
+            args.extend((adv_set.adv_handle, adv_set.duration,
+                         adv_set.max_ext_adv_events))
+        cmd = btcmd.HCILESetExtendedAdvertisingEnable(1, len(adv_sets), *args)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def disable(self, adv_sets=None, timeout=None):
+        """Disable advertising sets, or all sets if adv_sets is None."""
+        if adv_sets is None:
+            cmd = btcmd.HCILESetExtendedAdvertisingEnable(0, 0)
+        else:
+            args = []
+            adv_sets = list(adv_sets)
+            for adv_set in adv_sets:
+                args.extend((adv_set.adv_handle, 0, 0))
+            cmd = btcmd.HCILESetExtendedAdvertisingEnable(
+                0, len(adv_sets), *args)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def start(self, timeout=None):
+        """Program and enable all sets within timeout."""
+        deadline = Deadline.from_timeout(timeout)
+        self.program(None, deadline)
+        self.enable(None, deadline)
+
+    def clear(self, timeout=None):
+        """Disable and remove all sets within timeout."""
+        deadline = Deadline.from_timeout(timeout)
+        self.disable(None, deadline)
+        cmd = btcmd.HCILEClearAdvertisingSets()
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
+        self.adv_sets.clear()
@@ -0,0 +1,261 @@
+"""Scan survey analytics with NumPy.
+
+This module is optional and requires NumPy (pip install bluetool[analytics]).
+
+Inquiry and advertising report events are decoded from their raw parameters
+straight into NumPy arrays and accumulated in append-only columnar chunks, so
+that multi-hour surveys do not keep a Python object per report. Statistics
+are computed per device in vectorized form.
+
+Device addresses are stored as 64-bit integers; see addr2key() and
+key2addr().
+"""
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError(
+        'bluetool.analytics requires NumPy: pip install bluetool[analytics]')
+
+from .clock import get_clock
+
+
+INQUIRY_RESULT_WITH_RSSI_DTYPE = np.dtype([
+    ('bd_addr', 'u1', 6),
+    ('page_scan_repetition_mode', 'u1'),
+    ('reserved', 'u1'),
+    ('class_of_dev', 'u1', 3),
+    ('clk_offset', '<u2'),
+    ('rssi', 'i1'),
+])
+
+# Address type of BR/EDR devices found by inquiry
+ADDR_TYPE_BREDR = 0xFF
+
+_COLUMNS = (('time', '<f8'), ('addr', '<u8'), ('addr_type', 'u1'),
+            ('rssi', 'i1'))
+
+_ADDR_OFFSETS = np.arange(6)
+
+
+def addr2key(addr):
+    """Return the integer key of a 6-byte address."""
+    return struct.unpack('<Q', addr + '\x00\x00')[0]
+
+
+def key2addr(key):
+    """Return the 6-byte address of an integer key."""
+    return struct.pack('<Q', key)[:6]
+
+
+def _addr_keys(addr):
+    # addr is an (n, 6) uint8 array
+    padded = np.zeros((len(addr), 8), np.uint8)
+    padded[:, :6] = addr
+    return padded.view('<u8').ravel()
+
+
+def decode_inquiry_results(buf, offset=0):
+    """Decode Inquiry Result with RSSI event parameters.
+
+    Args:
+        buf: Event parameters.
+        offset: Offset of the Num_Responses parameter in buf.
+
+    Returns:
+        ndarray: Responses as INQUIRY_RESULT_WITH_RSSI_DTYPE records.
+    """
+    num_responses = ord(buf[offset])
+    return np.frombuffer(buf, INQUIRY_RESULT_WITH_RSSI_DTYPE, num_responses,
+                         offset + 1)
+
+
+def decode_adv_reports(buf, offset=0):
+    """Decode LE Advertising Report event parameters.
+
+    Only the offsets of the variable-length reports are walked in Python;
+    the fields are gathered with vectorized indexing.
+
+    Args:
+        buf: Event parameters.
+        offset: Offset of the Num_Reports parameter in buf.
+
+    Returns:
+        tuple: Arrays of (evt_type, addr_type, addr key, rssi).
+    """
+    num_reports = ord(buf[offset])
+    offsets = np.empty(num_reports, np.intp)
+    rssi_offsets = np.empty(num_reports, np.intp)
+    offset += 1
+    for i in xrange(0, num_reports):
+        offsets[i] = offset
+        offset += 10 + ord(buf[offset + 8])
+        rssi_offsets[i] = offset - 1
+    b = np.frombuffer(buf, np.uint8)
+    addr = b[offsets[:, np.newaxis] + 2 + _ADDR_OFFSETS]
+    return (b[offsets], b[offsets + 1], _addr_keys(addr),
+            b[rssi_offsets].view(np.int8))
+
+
+class ScanSurvey(object):
+    """Append-only columnar store of device observations.
+
+    Each observation has the columns time, addr (integer key), addr_type and
+    rssi. Observations are written to preallocated chunks of chunk_size rows;
+    full chunks are kept as they are and concatenated only for analysis.
+    """
+
+    def __init__(self, chunk_size=1 << 16):
+        super(ScanSurvey, self).__init__()
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._chunk = dict((name, np.empty(self.chunk_size, dtype))
+                           for name, dtype in _COLUMNS)
+        self._len = 0
+
+    def __len__(self):
+        return len(self.chunks) * self.chunk_size + self._len
+
+    def append(self, time, addr, addr_type, rssi):
+        """Append observations.
+
+        Arguments are arrays of the same length or scalars broadcast to the
+        length of addr.
+        """
+        addr = np.asarray(addr, np.uint64)
+        n = len(addr)
+        end = self._len + n
+        if end < self.chunk_size:
+            # Fast path: scalars are broadcast by the slice assignment
+            chunk = self._chunk
+            chunk['time'][self._len:end] = time
+            chunk['addr'][self._len:end] = addr
+            chunk['addr_type'][self._len:end] = addr_type
+            chunk['rssi'][self._len:end] = rssi
+            self._len = end
+            return
+        cols = {
+            'time': np.broadcast_to(time, n),
+            'addr': addr,
+            'addr_type': np.broadcast_to(addr_type, n),
+            'rssi': np.broadcast_to(rssi, n),
+        }
+        start = 0
+        while start < n:
+            count = min(n - start, self.chunk_size - self._len)
+            for name, col in cols.iteritems():
+                self._chunk[name][self._len:self._len + count] = (
+                    col[start:start + count])
+            self._len += count
+            start += count
+            if self._len == self.chunk_size:
+                self.chunks.append(self._chunk)
+                self._new_chunk()
+
+    def add_inquiry_results(self, buf, offset=0, now=None):
+        """Add Inquiry Result with RSSI event parameters."""
+        results = decode_inquiry_results(buf, offset)
+        if now is None:
+            now = get_clock().time()
+        self.append(now, _addr_keys(results['bd_addr']), ADDR_TYPE_BREDR,
+                    results['rssi'])
+
+    def add_adv_reports(self, buf, offset=0, now=None):
+        """Add LE Advertising Report event parameters."""
+        _, addr_type, addr, rssi = decode_adv_reports(buf, offset)
+        if now is None:
+            now = get_clock().time()
+        self.append(now, addr, addr_type, rssi)
+
+    def add_evt(self, evt, now=None):
+        """Add a parsed InquiryResultWithRSSIEvent or
+        LEAdvertisingReportEvent."""
+        if now is None:
+            now = get_clock().time()
+        if hasattr(evt, 'bd_addr'):
+            addr = evt.bd_addr
+            addr_type = ADDR_TYPE_BREDR
+        else:
+            addr = evt.addr
+            addr_type = np.array(evt.addr_type, np.uint8)
+        if not addr:
+            return
+        addr = np.frombuffer(''.join(addr), np.uint8).reshape(-1, 6)
+        self.append(now, _addr_keys(addr), addr_type,
+                    np.array(evt.rssi, np.int8))
+
+    def columns(self):
+        """Return a dict of the concatenated columns."""
+        chunks = self.chunks + [
+            dict((name, col[:self._len])
+                 for name, col in self._chunk.iteritems())]
+        return dict((name, np.concatenate([c[name] for c in chunks]))
+                    for name, _ in _COLUMNS)
+
+    def rssi_stats(self, percentiles=(10, 50, 90)):
+        """Compute RSSI statistics per device.
+
+        Returns:
+            ndarray: A record per device, sorted by addr, with the fields
+            addr, count, mean, min, max, first_seen, last_seen and p<q> for
+            each q in percentiles (linear interpolation).
+        """
+        cols = self.columns()
+        addr = cols['addr']
+        rssi = cols['rssi']
+        t = cols['time']
+        order = np.lexsort((rssi, addr))
+        addr = addr[order]
+        rssi = rssi[order].astype(np.float64)
+        t = t[order]
+        keys, start, count = np.unique(addr, return_index=True,
+                                       return_counts=True)
+        stats = np.empty(len(keys), [
+            ('addr', '<u8'), ('count', '<i8'), ('mean', '<f8'),
+            ('min', 'i1'), ('max', 'i1'), ('first_seen', '<f8'),
+            ('last_seen', '<f8')] + [('p{}'.format(q), '<f8')
+                                     for q in percentiles])
+        if len(keys) == 0:
+            return stats
+        stats['addr'] = keys
+        stats['count'] = count
+        stats['mean'] = np.add.reduceat(rssi, start) / count
+        # RSSI is sorted within each device
+        stats['min'] = rssi[start]
+        stats['max'] = rssi[start + count - 1]
+        stats['first_seen'] = np.minimum.reduceat(t, start)
+        stats['last_seen'] = np.maximum.reduceat(t, start)
+        for q in percentiles:
+            pos = (count - 1) * (q / 100.0)
+            lo = np.floor(pos).astype(np.intp)
+            hi = np.minimum(lo + 1, count - 1)
+            frac = pos - lo
+            stats['p{}'.format(q)] = (rssi[start + lo] * (1 - frac)
+                                      + rssi[start + hi] * frac)
+        return stats
+
+    def presence(self, window):
+        """Compute in which time windows each device is seen.
+
+        Args:
+            window: Window length in seconds.
+
+        Returns:
+            tuple: (keys, t0, matrix) where keys are the sorted device keys,
+            t0 is the start time of the first window and matrix is a
+            boolean array of shape (len(keys), number of windows).
+        """
+        cols = self.columns()
+        if len(cols['time']) == 0:
+            return (np.empty(0, np.uint64), None,
+                    np.empty((0, 0), np.bool_))
+        t0 = cols['time'].min()
+        win = ((cols['time'] - t0) // window).astype(np.intp)
+        keys, inverse = np.unique(cols['addr'], return_inverse=True)
+        matrix = np.zeros((len(keys), win.max() + 1), np.bool_)
+        matrix[inverse, win] = True
+        return (keys, t0, matrix)
@@ -0,0 +1,277 @@
+"""Indexed reader of btsnoop captures.
+
+BtsnoopReader memory-maps a btsnoop file with the H4 datalink, as written by
+HCICapture, and indexes its records on open. The index holds an offset, flags
+and a small key per record in arrays, so that records can be accessed by
+number, time range or header fields without reading the file into memory.
+The index can be saved next to the capture and is then loaded instead of
+being rebuilt.
+
+Packets are returned as buffer objects, the zero-copy read-only views of
+Python 2 which can be mapped onto an mmap. They can be passed to
+parse_hci_pkt() directly, and their slices, e.g. parsed addresses, are
+strings.
+"""
+import array
+import mmap
+import os
+import struct
+
+from . import bluez
+from .capture import (BTSNOOP_DATALINK_H4, BTSNOOP_MAGIC, DIR_RECEIVED,
+                      _BTSNOOP_EPOCH_DELTA)
+from .core import parse_hci_pkt
+
+_file_hdr = struct.Struct('>8sII')
+_rec_hdr = struct.Struct('>IIIIq')
+_rec_len_flags = struct.Struct('>4xII')
+_ts = struct.Struct('>q')
+_u16 = struct.Struct('<H')
+
+INDEX_MAGIC = 'BTSNIDX\x01'
+_index_hdr = struct.Struct('<8sQdQ')
+
+_FLAG_DIRECTION = 0x1
+
+
+class BtsnoopRecord(object):
+    """Record of a btsnoop capture.
+
+    Attributes:
+        num: Record number.
+        timestamp: Time of the record in seconds since the epoch.
+        flags: btsnoop flags.
+        pkt: Packet including its H4 packet type octet, as a buffer into
+            the capture.
+    """
+
+    __slots__ = ('num', 'timestamp', 'flags', 'pkt')
+
+    def __init__(self, num, timestamp, flags, pkt):
+        self.num = num
+        self.timestamp = timestamp
+        self.flags = flags
+        self.pkt = pkt
+
+    def __str__(self):
+        return '{}({}, {:.6f}, {}, {} bytes)'.format(
+            self.__class__.__name__, self.num, self.timestamp,
+            'rx' if self.direction == DIR_RECEIVED else 'tx',
+            len(self.pkt))
+
+    @property
+    def direction(self):
+        return self.flags & _FLAG_DIRECTION
+
+    @property
+    def ptype(self):
+        return ord(self.pkt[0])
+
+    def parse(self):
+        """Parse the packet with parse_hci_pkt().
+
+        Only events and ACL and SCO data can be parsed.
+        """
+        return parse_hci_pkt(self.pkt)
+
+
+class BtsnoopReader(object):
+    """Random access to the records of a btsnoop capture.
+
+    Args:
+        path: btsnoop file with the H4 datalink.
+        index: Path of the index sidecar, True for path + '.idx', or None
+            to keep the index in memory only. A sidecar is used if it
+            matches the size and modification time of the capture;
+            otherwise the index is built and the sidecar written.
+    """
+
+    def __init__(self, path, index=None):
+        super(BtsnoopReader, self).__init__()
+        self.path = path
+        self._f = open(path, 'rb')
+        size = os.fstat(self._f.fileno()).st_size
+        if size < _file_hdr.size:
+            raise ValueError('not a btsnoop file: {}'.format(path))
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, datalink = _file_hdr.unpack_from(self._mm)
+        if magic != BTSNOOP_MAGIC:
+            raise ValueError('not a btsnoop file: {}'.format(path))
+        if datalink != BTSNOOP_DATALINK_H4:
+            raise ValueError('unsupported btsnoop datalink: {}'.format(
+                datalink))
+        if index is True:
+            index = path + '.idx'
+        self.index_path = index
+        if index is None or not self._load_index(index):
+            self._build_index()
+            if index is not None:
+                self._save_index(index)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, num):
+        if num < 0:
+            num += len(self.offsets)
+        offset = self.offsets[num]
+        _, incl_len, flags, _, ts = _rec_hdr.unpack_from(self._mm, offset)
+        return BtsnoopRecord(
+            num, (ts - _BTSNOOP_EPOCH_DELTA) * 1e-6, flags,
+            buffer(self._mm, offset + _rec_hdr.size, incl_len))
+
+    def __iter__(self):
+        for num in xrange(0, len(self.offsets)):
+            yield self[num]
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+    def _stat_key(self):
+        st = os.fstat(self._f.fileno())
+        return (st.st_size, st.st_mtime)
+
+    def _build_index(self):
+        mm = self._mm
+        end = len(mm)
+        offsets = array.array('L')
+        ptypes = array.array('B')
+        flags = array.array('B')
+        keys = array.array('H')
+        # Bound methods and constants are local: this loop runs once per
+        # record of captures with tens of millions of records.
+        add_offset = offsets.append
+        add_ptype = ptypes.append
+        add_flags = flags.append
+        add_key = keys.append
+        unpack_len_flags = _rec_len_flags.unpack_from
+        unpack_u16 = _u16.unpack_from
+        hdr_size = _rec_hdr.size
+        evt_pkt = bluez.HCI_EVENT_PKT
+        cmd_pkt = bluez.HCI_COMMAND_PKT
+        le_meta = bluez.EVT_LE_META_EVENT
+        offset = _file_hdr.size
+        while offset + hdr_size <= end:
+            incl_len, rec_flags = unpack_len_flags(mm, offset)
+            pkt = offset + hdr_size
+            if incl_len < 3 or pkt + incl_len > end:
+                # Truncated last record of a capture still being written
+                break
+            ptype = ord(mm[pkt])
+            # Key: opcode of commands, event code of events (with the
+            # subevent code in the high octet for LE meta events), and
+            # connection handle of ACL and SCO data
+            if ptype == evt_pkt:
+                key = ord(mm[pkt + 1])
+                if key == le_meta and incl_len > 3:
+                    key |= ord(mm[pkt + 3]) << 8
+            elif ptype == cmd_pkt:
+                key = unpack_u16(mm, pkt + 1)[0]
+            else:
+                key = unpack_u16(mm, pkt + 1)[0] & 0x0FFF
+            add_offset(offset)
+            add_ptype(ptype)
+            add_flags(rec_flags & 0xFF)
+            add_key(key)
+            offset = pkt + incl_len
+        self.offsets = offsets
+        self.ptypes = ptypes
+        self.flags = flags
+        self.keys = keys
+
+    def _load_index(self, path):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return False
+        with f:
+            hdr = f.read(_index_hdr.size)
+            if len(hdr) < _index_hdr.size:
+                return False
+            magic, size, mtime, count = _index_hdr.unpack(hdr)
+            if magic != INDEX_MAGIC or (size, mtime) != self._stat_key():
+                return False
+            arrays = []
+            for typecode in ('L', 'B', 'B', 'H'):
+                a = array.array(typecode)
+                try:
+                    a.fromfile(f, count)
+                except EOFError:
+                    return False
+                arrays.append(a)
+        self.offsets, self.ptypes, self.flags, self.keys = arrays
+        return True
+
+    def _save_index(self, path):
+        size, mtime = self._stat_key()
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_index_hdr.pack(INDEX_MAGIC, size, mtime,
+                                    len(self.offsets)))
+            for a in (self.offsets, self.ptypes, self.flags, self.keys):
+                a.tofile(f)
+        os.rename(tmp_path, path)
+
+    def timestamp(self, num):
+        """Return the timestamp of record num in seconds since the epoch."""
+        ts = _ts.unpack_from(self._mm, self.offsets[num] + 16)[0]
+        return (ts - _BTSNOOP_EPOCH_DELTA) * 1e-6
+
+    def bisect_time(self, t):
+        """Return the number of the first record at or after time t."""
+        lo = 0
+        hi = len(self.offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def select(self, start=None, end=None, ptype=None, direction=None,
+               evt_code=None, le_subevt_code=None, opcode=None,
+               conn_handle=None):
+        """Yield the records matching all the given criteria.
+
+        Args:
+            start, end: Time range [start, end) in seconds since the epoch.
+            ptype: H4 packet type.
+            direction: DIR_SENT or DIR_RECEIVED.
+            evt_code: Event code of events.
+            le_subevt_code: Subevent code of LE meta events.
+            opcode: Opcode of commands.
+            conn_handle: Connection handle of ACL and SCO data.
+        """
+        first = 0 if start is None else self.bisect_time(start)
+        last = len(self.offsets) if end is None else self.bisect_time(end)
+        key = None
+        mask = 0xFFFF
+        if evt_code is not None or le_subevt_code is not None:
+            ptype = bluez.HCI_EVENT_PKT
+            if le_subevt_code is not None:
+                key = bluez.EVT_LE_META_EVENT | (le_subevt_code << 8)
+            else:
+                key = evt_code
+                mask = 0xFF
+        elif opcode is not None:
+            ptype = bluez.HCI_COMMAND_PKT
+            key = opcode
+        elif conn_handle is not None:
+            key = conn_handle
+        ptypes = self.ptypes
+        flags = self.flags
+        keys = self.keys
+        for num in xrange(first, last):
+            if ptype is not None and ptypes[num] != ptype:
+                continue
+            if conn_handle is not None and ptypes[num] not in (
+                    bluez.HCI_ACLDATA_PKT, bluez.HCI_SCODATA_PKT):
+                continue
+            if (direction is not None
+                    and flags[num] & _FLAG_DIRECTION != direction):
+                continue
+            if key is not None and keys[num] & mask != key:
+                continue
+            yield self[num]
@@ -0,0 +1,316 @@
+"""Persistent cache of controller capabilities.
+
+Querying the static capabilities of a controller (features, supported
+commands, buffer sizes, advertising limits) takes several command round
+trips on every bring-up and reset. The capabilities are cached on disk keyed
+by BD_ADDR and are reused as long as the local version information of the
+controller, which identifies its firmware, does not change.
+
+The cache file can be selected by the BLUETOOL_CAP_CACHE environment
+variable; setting it to an empty string disables persistence.
+"""
+import binascii
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+from . import bluez
+from . import command as btcmd
+from .error import HCICommandError
+
+
+def _default_cache_path():
+    path = os.environ.get('BLUETOOL_CAP_CACHE')
+    if path is not None:
+        return path or None
+    return os.path.join(os.path.expanduser('~'), '.cache', 'bluetool',
+                        'capabilities.json')
+
+
+class ControllerCapabilities(object):
+    """Static capabilities of a controller.
+
+    Attributes which the controller does not support querying are None.
+
+    Attributes:
+        bd_addr: BD_ADDR of the controller.
+        version: Tuple of (hci_version, hci_revision, lmp_version, manu_name,
+            lmp_subversion) from the local version information.
+        supported_cmds: 64-octet supported commands bit mask.
+        lmp_features: LMP features.
+        le_features: LE features.
+        hc_acl_data_pkt_len: BR/EDR ACL data packet length.
+        hc_total_num_acl_data_pkts: Number of BR/EDR ACL data packets.
+        hc_le_acl_data_pkt_len: LE ACL data packet length.
+        hc_total_num_le_acl_data_pkts: Number of LE ACL data packets.
+        max_adv_data_len: Maximum advertising data length.
+        num_supported_adv_sets: Number of supported advertising sets.
+    """
+
+    _fields = ('version', 'supported_cmds', 'lmp_features', 'le_features',
+               'hc_acl_data_pkt_len', 'hc_total_num_acl_data_pkts',
+               'hc_le_acl_data_pkt_len', 'hc_total_num_le_acl_data_pkts',
+               'max_adv_data_len', 'num_supported_adv_sets')
+
+    def __init__(self, bd_addr, version):
+        super(ControllerCapabilities, self).__init__()
+        self.bd_addr = bd_addr
+        self.version = version
+        self.supported_cmds = None
+        self.lmp_features = None
+        self.le_features = None
+        self.hc_acl_data_pkt_len = None
+        self.hc_total_num_acl_data_pkts = None
+        self.hc_le_acl_data_pkt_len = None
+        self.hc_total_num_le_acl_data_pkts = None
+        self.max_adv_data_len = None
+        self.num_supported_adv_sets = None
+
+    def __str__(self):
+        return '{}({})'.format(self.__class__.__name__,
+                               bluez.ba2str(self.bd_addr))
+
+    def is_cmd_supported(self, octet, bit):
+        """Return True if the command at octet and bit of the supported
+        commands bit mask is supported.
+
+        If the supported commands are unknown, the command is assumed to be
+        supported.
+        """
+        if self.supported_cmds is None:
+            return True
+        return bool(ord(self.supported_cmds[octet]) & (1 << bit))
+
+    def to_dict(self):
+        d = {}
+        for name in self._fields:
+            d[name] = getattr(self, name)
+        d['supported_cmds'] = _hexlify(self.supported_cmds)
+        return d
+
+    @classmethod
+    def from_dict(cls, bd_addr, d):
+        caps = cls(bd_addr, tuple(d['version']))
+        for name in cls._fields[1:]:
+            setattr(caps, name, d.get(name))
+        caps.supported_cmds = _unhexlify(caps.supported_cmds)
+        return caps
+
+
+def _hexlify(s):
+    return None if s is None else binascii.hexlify(s)
+
+
+def _unhexlify(s):
+    return None if s is None else binascii.unhexlify(s)
+
+
+def _read(task, cmd, timeout):
+    evt = task.send_hci_cmd_wait_cmd_complt(cmd, timeout)
+    if evt.status != 0:
+        raise HCICommandError(evt)
+    return evt
+
+
+def read_local_version(task, timeout=None):
+    """Return the local version tuple used to validate cache entries."""
+    evt = _read(task, btcmd.HCIReadLocalVersionInformation(), timeout)
+    return (evt.hci_version, evt.hci_revision, evt.lmp_version,
+            evt.manu_name, evt.lmp_subversion)
+
+
+def query_capabilities(task, bd_addr, version, timeout=None):
+    """Query the capabilities of the controller of task.
+
+    Commands not supported by the controller are not sent.
+
+    Returns:
+        ControllerCapabilities: The capabilities.
+    """
+    caps = ControllerCapabilities(bd_addr, version)
+    evt = _read(task, btcmd.HCIReadLocalSupportedCommands(), timeout)
+    caps.supported_cmds = evt.supported_cmds
+
+    if caps.is_cmd_supported(14, 5):
+        evt = _read(task, btcmd.HCIReadLocalSupportedFeatures(), timeout)
+        caps.lmp_features = evt.lmp_features
+    if caps.is_cmd_supported(14, 7):
+        evt = _read(task, btcmd.HCIReadBufferSize(), timeout)
+        caps.hc_acl_data_pkt_len = evt.hc_acl_data_pkt_len
+        caps.hc_total_num_acl_data_pkts = evt.hc_total_num_acl_data_pkts
+    if caps.is_cmd_supported(25, 2):
+        evt = _read(task, btcmd.HCILEReadLocalSupportedFeatures(), timeout)
+        caps.le_features = evt.le_features
+    if caps.is_cmd_supported(25, 1):
+        evt = _read(task, btcmd.HCILEReadBufferSize(), timeout)
+        caps.hc_le_acl_data_pkt_len = evt.hc_le_acl_data_pkt_len
+        caps.hc_total_num_le_acl_data_pkts = (
+            evt.hc_total_num_le_acl_data_pkts)
+    if caps.is_cmd_supported(36, 6):
+        evt = _read(task, btcmd.HCILEReadMaximumAdvertisingDataLength(),
+                    timeout)
+        caps.max_adv_data_len = evt.max_adv_data_len
+    if caps.is_cmd_supported(36, 7):
+        evt = _read(task, btcmd.HCILEReadNumberOfSupportedAdvertisingSets(),
+                    timeout)
+        caps.num_supported_adv_sets = evt.num_supported_adv_sets
+    return caps
+
+
+class CapabilityCache(object):
+    """Cache of ControllerCapabilities stored in a JSON file.
+
+    Args:
+        path: Path of the cache file. If path is None, the cache is kept in
+            memory only.
+    """
+
+    def __init__(self, path=None):
+        super(CapabilityCache, self).__init__()
+        self.path = path
+        self.entries = {}
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+
+    def _key(self, bd_addr):
+        return bluez.ba2str(bd_addr)
+
+    def _lock(self):
+        lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _makedirs(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def load(self):
+        """Load entries from the cache file.
+
+        A missing or corrupted file results in an empty cache.
+        """
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _update(self, key, value):
+        self.entries.pop(key, None)
+        if self.path is None:
+            if value is not None:
+                self.entries[key] = value
+            return
+        try:
+            self._makedirs()
+            lock_file = self._lock()
+        except (IOError, OSError) as err:
+            self.log.warning('cannot update %s: %s', self.path, err)
+            if value is not None:
+                self.entries[key] = value
+            return
+        try:
+            # Merge with entries written by other processes meanwhile.
+            self.load()
+            if value is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = value
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path), prefix='.capabilities')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        finally:
+            lock_file.close()
+
+    def lookup(self, bd_addr, version):
+        """Return the cached capabilities of bd_addr.
+
+        Returns:
+            ControllerCapabilities: The capabilities, or None if bd_addr is
+            not cached or its firmware version changed.
+        """
+        d = self.entries.get(self._key(bd_addr))
+        if d is None:
+            return None
+        if tuple(d['version']) != version:
+            self.log.info('%s: firmware changed, invalidate capabilities',
+                          self._key(bd_addr))
+            return None
+        return ControllerCapabilities.from_dict(bd_addr, d)
+
+    def store(self, caps):
+        self._update(self._key(caps.bd_addr), caps.to_dict())
+
+    def invalidate(self, bd_addr=None):
+        """Remove bd_addr from the cache, or all entries if bd_addr is None.
+        """
+        if bd_addr is not None:
+            self._update(self._key(bd_addr), None)
+            return
+        self.entries = {}
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def get(self, task, bd_addr=None, timeout=None):
+        """Return the capabilities of the controller of task.
+
+        The local version information is always read to validate the cached
+        entry; the other capabilities are queried only on a cache miss.
+
+        Args:
+            task: HCITask of the controller.
+            bd_addr: BD_ADDR of the controller, or None to read it.
+            timeout: Maximum time in seconds of each command, or a Deadline.
+
+        Returns:
+            ControllerCapabilities: The capabilities.
+        """
+        if bd_addr is None:
+            evt = _read(task, btcmd.HCIReadBDAddr(), timeout)
+            bd_addr = evt.bd_addr
+        version = read_local_version(task, timeout)
+        self.load()
+        caps = self.lookup(bd_addr, version)
+        if caps is None:
+            caps = query_capabilities(task, bd_addr, version, timeout)
+            self.store(caps)
+        return caps
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Return the process-wide CapabilityCache."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = CapabilityCache(_default_cache_path())
+    return _default_cache
+
+
+def get_capabilities(task, bd_addr=None, timeout=None):
+    """Return the capabilities of the controller of task.
+
+    The capabilities are validated against the default cache once per
+    HCISock and kept in the caps attribute of the socket afterwards, so
+    helpers sharing a socket do not send any command.
+    """
+    caps = getattr(task.sock, 'caps', None)
+    if caps is None:
+        caps = default_cache().get(task, bd_addr, timeout)
+        task.sock.caps = caps
+    return caps
@@ -0,0 +1,159 @@
+"""Capture of HCI traffic to btsnoop or pcap files.
+
+HCICapture records the packets sent and received by an HCISock; see
+HCISock.start_capture(). Files can be opened with Wireshark. The socket only
+queues (timestamp, direction, packet) on its hot path; packets are formatted
+and written in batches by a writer thread.
+
+Timestamps are taken from the monotonic clock and converted to wall-clock
+time relative to the start of the capture.
+"""
+import collections
+import logging
+import struct
+import threading
+import time
+
+from . import bluez
+from .clock import monotonic, thread_monotonic
+
+FORMAT_BTSNOOP = 'btsnoop'
+FORMAT_PCAP = 'pcap'
+
+DIR_SENT = 0
+DIR_RECEIVED = 1
+
+BTSNOOP_MAGIC = 'btsnoop\x00'
+BTSNOOP_VERSION = 1
+BTSNOOP_DATALINK_H4 = 1002
+
+# Microseconds from 0000-01-01 to 1970-01-01
+_BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000
+
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR = 201
+
+_btsnoop_hdr = struct.Struct('>8sII')
+_btsnoop_rec = struct.Struct('>IIIIq')
+_pcap_hdr = struct.Struct('<IHHiIII')
+_pcap_rec = struct.Struct('<IIII')
+_pcap_phdr = struct.Struct('>I')
+
+_cmd_hdr = struct.Struct('<BHB')
+_acl_hdr = struct.Struct('<BHH')
+
+# btsnoop flags of commands and events
+_BTSNOOP_FLAG_CMD_EVT = 0x2
+
+
+class HCICapture(object):
+    """Write captured HCI packets to a file.
+
+    Args:
+        path: Output file; an existing file is overwritten.
+        fmt: FORMAT_BTSNOOP or FORMAT_PCAP.
+        flush_intvl: Interval in seconds at which queued packets are
+            written.
+    """
+
+    def __init__(self, path, fmt=FORMAT_BTSNOOP, flush_intvl=0.1):
+        super(HCICapture, self).__init__()
+        if fmt not in (FORMAT_BTSNOOP, FORMAT_PCAP):
+            raise ValueError('unknown capture format: {}'.format(fmt))
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+        self.path = path
+        self.fmt = fmt
+        self.flush_intvl = flush_intvl
+        self.num_pkts = 0
+        self._queue = collections.deque()
+        # Timestamps are taken by the thread using the socket only.
+        self._clock = thread_monotonic()
+        self._mono0 = monotonic()
+        self._wall0 = time.time()
+        self._f = open(path, 'wb')
+        if fmt == FORMAT_BTSNOOP:
+            self._f.write(_btsnoop_hdr.pack(BTSNOOP_MAGIC, BTSNOOP_VERSION,
+                                            BTSNOOP_DATALINK_H4))
+            self._format = self._format_btsnoop
+        else:
+            self._f.write(_pcap_hdr.pack(
+                PCAP_MAGIC, 2, 4, 0, 0, 0xFFFF,
+                LINKTYPE_BLUETOOTH_HCI_H4_WITH_PHDR))
+            self._format = self._format_pcap
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='HCICapture')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # The record methods are called on the hot path of HCISock; they only
+    # queue what the writer thread needs to build the packet.
+
+    def record_cmd(self, opcode, param):
+        self._queue.append((self._clock(), bluez.HCI_COMMAND_PKT, opcode,
+                            param))
+
+    def record_acl(self, handle_flags, data):
+        self._queue.append((self._clock(), bluez.HCI_ACLDATA_PKT,
+                            handle_flags, data))
+
+    def record_received(self, pkt):
+        """Record a received packet, including its packet type octet."""
+        self._queue.append((self._clock(), None, None, pkt))
+
+    def _format_btsnoop(self, ts, direction, pkt, out):
+        usec = int(round((self._wall0 + ts - self._mono0) * 1e6))
+        flags = direction
+        ptype = ord(pkt[0])
+        if (ptype == bluez.HCI_COMMAND_PKT
+                or ptype == bluez.HCI_EVENT_PKT):
+            flags |= _BTSNOOP_FLAG_CMD_EVT
+        out.append(_btsnoop_rec.pack(len(pkt), len(pkt), flags, 0,
+                                     usec + _BTSNOOP_EPOCH_DELTA))
+        out.append(pkt)
+
+    def _format_pcap(self, ts, direction, pkt, out):
+        wall = self._wall0 + ts - self._mono0
+        sec = int(wall)
+        usec = int((wall - sec) * 1e6)
+        out.append(_pcap_rec.pack(sec, usec, len(pkt) + 4, len(pkt) + 4))
+        out.append(_pcap_phdr.pack(direction))
+        out.append(pkt)
+
+    def _write_queued(self):
+        queue = self._queue
+        out = []
+        n = 0
+        while queue:
+            ts, ptype, hdr, data = queue.popleft()
+            if ptype is None:
+                self._format(ts, DIR_RECEIVED, data, out)
+            elif ptype == bluez.HCI_COMMAND_PKT:
+                self._format(ts, DIR_SENT, ''.join(
+                    (_cmd_hdr.pack(ptype, hdr, len(data)), data)), out)
+            else:
+                self._format(ts, DIR_SENT, ''.join(
+                    (_acl_hdr.pack(ptype, hdr, len(data)), data)), out)
+            n += 1
+        if out:
+            self._f.write(''.join(out))
+            self._f.flush()
+            self.num_pkts += n
+
+    def _run(self):
+        while not self._stop.is_set():
+            time.sleep(self.flush_intvl)
+            try:
+                self._write_queued()
+            except (IOError, OSError) as err:
+                self.log.warning('capture stopped: %s', err)
+                return
+
+    def close(self):
+        """Write the remaining packets and close the file."""
+        self._stop.set()
+        self._thread.join()
+        self._write_queued()
+        self._f.close()
+        self.log.info('%s: %d packets captured', self.path, self.num_pkts)
@@ -0,0 +1,489 @@
+"""Monotonic clock, deadlines and virtual time.
+
+All timeouts in bluetool are in seconds. A timeout is turned into a Deadline
+once, at the start of an operation, and the Deadline is passed down the
+receive path so that the operation ends at its deadline however many
+unrelated packets arrive in between.
+
+Deadlines, sleep() and the waits of HCISock, HCIWorker, the shared sync
+primitives and HCILoop follow the clock set with set_clock(), the monotonic
+clock by default. A VirtualClock runs simulated time instead: when every
+thread taking part in a test is waiting, the time jumps straight to the
+earliest deadline, so that sleeps and timeouts against virtual controllers
+(see bluetool.virtual) take no real time:
+
+    set_clock(VirtualClock())
+    medium = VirtualMedium()
+
+A wait on the virtual clock is woken by notify() of its key, which the party
+making the wait ready calls. Virtual controllers, worker pipes and signals,
+and the sync primitives notify their keys; waits on other transports, e.g.
+HCI devices, run in real time and hold the virtual time meanwhile.
+"""
+import contextlib
+import ctypes
+import ctypes.util
+import math
+import multiprocessing as mp
+import os
+import threading
+import time
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1
+
+
+def _load_clock_gettime():
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    return clock_gettime
+
+_clock_gettime = _load_clock_gettime()
+
+
+def monotonic():
+    """Return the value in seconds of a monotonic clock.
+
+    Falls back to time.time() if clock_gettime() is not available.
+    """
+    if _clock_gettime is None:
+        return time.time()
+    ts = _timespec()
+    if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+def thread_monotonic():
+    """Return a function equivalent to monotonic() for use by one thread.
+
+    The function reuses a single timespec instead of allocating one per
+    call, which makes it about three times faster. It must not be shared
+    by threads.
+    """
+    if _clock_gettime is None:
+        return time.time
+    ts = _timespec()
+    ts_ref = ctypes.byref(ts)
+
+    def _monotonic():
+        _clock_gettime(_CLOCK_MONOTONIC, ts_ref)
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return _monotonic
+
+
+def timeout_ms(timeout):
+    """Return timeout in seconds as milliseconds for poll(), or None.
+
+    The value is rounded up so that a poll does not return before the
+    timeout.
+    """
+    if timeout is None:
+        return None
+    return int(math.ceil(timeout * 1000))
+
+
+class Deadline(object):
+    """Point in time at which a wait expires.
+
+    Args:
+        timeout: Time in seconds from now. If timeout is None, the deadline
+            never expires.
+    """
+
+    def __init__(self, timeout=None):
+        super(Deadline, self).__init__()
+        if timeout is None:
+            self.expiry = None
+        else:
+            self.expiry = now() + timeout
+
+    def __str__(self):
+        return '{}({})'.format(self.__class__.__name__, self.remaining())
+
+    @classmethod
+    def from_timeout(cls, timeout):
+        """Return a Deadline for timeout.
+
+        timeout can be a time in seconds, None or a Deadline, which is
+        returned as is.
+        """
+        if isinstance(timeout, Deadline):
+            return timeout
+        return cls(timeout)
+
+    @classmethod
+    def at(cls, expiry):
+        """Return a Deadline expiring at time expiry of now()."""
+        deadline = cls()
+        deadline.expiry = expiry
+        return deadline
+
+    def remaining(self):
+        """Return the remaining time in seconds, or None if infinite."""
+        if self.expiry is None:
+            return None
+        return max(0.0, self.expiry - now())
+
+    def remaining_ms(self):
+        """Return the remaining time in milliseconds for poll(), or None."""
+        return timeout_ms(self.remaining())
+
+    def expired(self):
+        return self.expiry is not None and now() >= self.expiry
+
+
+class Clock(object):
+    """Monotonic clock; see set_clock().
+
+    Waits are plain blocking waits, and the participant methods used by
+    VirtualClock do nothing.
+    """
+
+    virtual = False
+
+    def time(self):
+        return monotonic()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def wait_ready(self, poll, timeout=None, key=None):
+        """Wait until poll reports readiness or the deadline expires.
+
+        Args:
+            poll: Function of a timeout in seconds, or None for an infinite
+                one, waiting at most that long until something is ready and
+                returning a true value if it is, e.g. Connection.poll or
+                Event.wait.
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+            key: Key notified with notify() by the party making poll ready,
+                or a sequence of keys. Keys are ints shared by the processes
+                of a test, such as the id() of an object created before they
+                are forked.
+
+        Returns:
+            The last value returned by poll.
+        """
+        return poll(Deadline.from_timeout(timeout).remaining())
+
+    def notify(self, key):
+        """Wake up the waits on key."""
+        pass
+
+    def reserve(self):
+        """Reserve a participant for a thread or process about to start.
+
+        Returns:
+            Ticket passed to participant() by the thread or process, and to
+            release() if it may have exited without leaving the clock.
+        """
+        return None
+
+    def release(self, ticket):
+        pass
+
+    @contextlib.contextmanager
+    def participant(self, ticket=None):
+        """Take part in the time of the clock while in the block."""
+        yield
+
+    @contextlib.contextmanager
+    def blocked(self):
+        """Count the calling participant as waiting while in the block.
+
+        The block is not woken by the clock; it is meant for waits the clock
+        does not know of, e.g. joining a process.
+        """
+        yield
+
+
+# States of the participants of a VirtualClock
+_FREE = 0
+_RUNNING = 1
+_WAITING = 2
+
+# Number of wait channels of a VirtualClock keys are mapped to
+_NUM_CHANNELS = 64
+
+_INFINITY = float('inf')
+
+_key_channels = {}
+
+
+def _channels(key):
+    # Keys sharing a channel only cause spurious wake-ups. Keys are usually
+    # ids, whose low bits are aligned.
+    channels = _key_channels.get(key)
+    if channels is None:
+        keys = (key,) if isinstance(key, (int, long)) else key
+        channels = tuple(set(((k >> 4) ^ (k >> 10)) % _NUM_CHANNELS
+                             for k in keys))
+        mask = 0
+        for channel in channels:
+            mask |= 1 << channel
+        channels = (channels, mask)
+        if isinstance(key, (int, long)):
+            _key_channels[key] = channels
+    return channels
+
+
+class VirtualClock(Clock):
+    """Simulated time shared by the processes and threads of a test.
+
+    The threads taking part in a test are the participants of the clock.
+    When none of them is running, the time jumps to the earliest deadline
+    of the waiting ones, which are woken up; the time stands still
+    otherwise. A thread not taking part is a participant only while it
+    waits on the clock.
+
+    The clock must be set with set_clock() before the processes sharing it
+    are forked. A participant starting a thread or process reserves it a
+    ticket, so that the time does not jump before it attaches with
+    participant(); HCIWorker, HCICoordinator, VirtualMedium and
+    init_hci_devices() do so.
+
+    Args:
+        max_threads: Maximum number of participants.
+    """
+
+    virtual = True
+
+    def __init__(self, max_threads=256):
+        super(VirtualClock, self).__init__()
+        self.max_threads = max_threads
+        self._lock = mp.Lock()
+        self._now = mp.RawValue(ctypes.c_double, 0.0)
+        self._num_running = mp.RawValue(ctypes.c_int, 0)
+        # Participants are below top
+        self._top = mp.RawValue(ctypes.c_int, 0)
+        self._last_tag = mp.RawValue(ctypes.c_ulonglong, 0)
+        self._states = mp.RawArray(ctypes.c_ubyte, max_threads)
+        self._tags = mp.RawArray(ctypes.c_ulonglong, max_threads)
+        self._expiries = mp.RawArray(ctypes.c_double, max_threads)
+        self._masks = mp.RawArray(ctypes.c_ulonglong, max_threads)
+        # Notifications of each channel, compared by waits to find out
+        # whether they missed one
+        self._seqs = mp.RawArray(ctypes.c_ulonglong, _NUM_CHANNELS)
+        self._sems = [mp.Semaphore(0) for _ in xrange(0, max_threads)]
+        self._local = threading.local()
+
+    def time(self):
+        return self._now.value
+
+    def sleep(self, secs):
+        expiry = self._now.value + secs
+        while self._now.value < expiry:
+            self._wait((), None, expiry)
+
+    def wait_ready(self, poll, timeout=None, key=None):
+        deadline = Deadline.from_timeout(timeout)
+        if key is None:
+            # Nobody notifies the wait: it is done in real time, during
+            # which a running participant holds the time.
+            return poll(deadline.remaining())
+        channels = _channels(key)[0]
+        while True:
+            seq = self._seq(channels)
+            ready = poll(0)
+            if ready or deadline.expired():
+                return ready
+            self._wait(channels, seq, deadline.expiry)
+
+    def notify(self, key):
+        channels, mask = _channels(key)
+        states = self._states
+        masks = self._masks
+        with self._lock:
+            for channel in channels:
+                self._seqs[channel] += 1
+            for slot in xrange(0, self._top.value):
+                if states[slot] == _WAITING and masks[slot] & mask:
+                    self._wake(slot)
+
+    def reserve(self):
+        states = self._states
+        with self._lock:
+            for slot in xrange(0, self.max_threads):
+                if states[slot] == _FREE:
+                    break
+            else:
+                raise RuntimeError(
+                    'more than {} participants'.format(self.max_threads))
+            states[slot] = _RUNNING
+            self._num_running.value += 1
+            self._last_tag.value += 1
+            tag = self._last_tag.value
+            self._tags[slot] = tag
+            self._top.value = max(self._top.value, slot + 1)
+        # Drop a wake-up left by a previous participant killed when woken
+        while self._sems[slot].acquire(False):
+            pass
+        return (slot, tag)
+
+    def release(self, ticket):
+        slot, tag = ticket
+        states = self._states
+        with self._lock:
+            if self._tags[slot] != tag:
+                return
+            if states[slot] == _RUNNING:
+                self._num_running.value -= 1
+            states[slot] = _FREE
+            self._tags[slot] = 0
+            top = self._top.value
+            while top > 0 and states[top - 1] == _FREE:
+                top -= 1
+            self._top.value = top
+            self._advance()
+
+    @contextlib.contextmanager
+    def participant(self, ticket=None):
+        if self._current() is not None:
+            if ticket is not None:
+                self.release(ticket)
+            yield
+            return
+        if ticket is None:
+            ticket = self.reserve()
+        self._local.owner = (os.getpid(), ticket)
+        try:
+            yield
+        finally:
+            self._local.owner = None
+            self.release(ticket)
+
+    @contextlib.contextmanager
+    def blocked(self):
+        ticket = self._current()
+        if ticket is None:
+            yield
+            return
+        slot = ticket[0]
+        with self._lock:
+            self._set_waiting(slot, 0, None)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._set_running(slot)
+
+    def _current(self):
+        # Ticket of the calling thread, not inherited through a fork
+        owner = getattr(self._local, 'owner', None)
+        if owner is None or owner[0] != os.getpid():
+            return None
+        return owner[1]
+
+    def _seq(self, channels):
+        seqs = self._seqs
+        return sum(seqs[channel] for channel in channels)
+
+    def _wait(self, channels, seq, expiry):
+        # Wait until a notification of channels, or the time reaching
+        # expiry. If seq is not None, return at once if channels were
+        # notified since seq was read. Callers check again what they wait
+        # for, as a wait can end spuriously.
+        ticket = self._current()
+        temporary = ticket is None
+        if temporary:
+            ticket = self.reserve()
+        slot = ticket[0]
+        mask = 0
+        for channel in channels:
+            mask |= 1 << channel
+        try:
+            with self._lock:
+                if seq is not None and self._seq(channels) != seq:
+                    return
+                if expiry is not None and expiry <= self._now.value:
+                    return
+                self._set_waiting(slot, mask, expiry)
+            self._sems[slot].acquire()
+        finally:
+            with self._lock:
+                # Interrupted, or woken by a wake-up left behind
+                self._set_running(slot)
+            if temporary:
+                self.release(ticket)
+
+    # The following methods are called with the lock held.
+
+    def _set_waiting(self, slot, mask, expiry):
+        self._states[slot] = _WAITING
+        self._num_running.value -= 1
+        self._masks[slot] = mask
+        self._expiries[slot] = _INFINITY if expiry is None else expiry
+        self._advance()
+
+    def _set_running(self, slot):
+        if self._states[slot] == _WAITING:
+            self._states[slot] = _RUNNING
+            self._num_running.value += 1
+
+    def _wake(self, slot):
+        self._states[slot] = _RUNNING
+        self._num_running.value += 1
+        self._sems[slot].release()
+
+    def _advance(self):
+        if self._num_running.value > 0:
+            return
+        states = self._states
+        expiries = self._expiries
+        top = self._top.value
+        expiry = min([expiries[slot] for slot in xrange(0, top)
+                      if states[slot] == _WAITING] or [_INFINITY])
+        if expiry == _INFINITY:
+            # Every participant waits for another: nothing can happen.
+            return
+        if expiry > self._now.value:
+            self._now.value = expiry
+        for slot in xrange(0, top):
+            if states[slot] == _WAITING and expiries[slot] <= expiry:
+                self._wake(slot)
+
+
+_clock = Clock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    """Set the clock of deadlines and waits, or None for the monotonic
+    clock."""
+    global _clock
+    _clock = Clock() if clock is None else clock
+
+
+def now():
+    """Return the time in seconds of the clock set with set_clock()."""
+    return _clock.time()
+
+
+def sleep(secs):
+    """Sleep for secs seconds of the clock set with set_clock()."""
+    _clock.sleep(secs)
+
+
+def wait_ready(poll, timeout=None, key=None):
+    """Wait on the clock set with set_clock(); see Clock.wait_ready()."""
+    return _clock.wait_ready(poll, timeout, key)
+
+
+def notify(key):
+    """Wake up the waits on key of the clock set with set_clock()."""
+    _clock.notify(key)
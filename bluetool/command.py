@@ -295,6 +295,36 @@ class HCIInfoParamCommand(HCICommand):
     ogf = bluez.OGF_INFO_PARAM
 
 
+class HCIReadLocalVersionInformation(HCIInfoParamCommand,
+                                     CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_READ_LOCAL_VERSION
+
+    @classmethod
+    def unpack_ret_param(cls, evt, buf, offset):
+        offset = super(HCIReadLocalVersionInformation, cls).unpack_ret_param(
+            evt, buf, offset)
+        evt.hci_version = letoh8(buf, offset)
+        offset += 1
+        evt.hci_revision = letoh16(buf, offset)
+        offset += 2
+        evt.lmp_version = letoh8(buf, offset)
+        offset += 1
+        evt.manu_name = letoh16(buf, offset)
+        offset += 2
+        evt.lmp_subversion = letoh16(buf, offset)
+
+
+class HCIReadLocalSupportedCommands(HCIInfoParamCommand,
+                                    CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_READ_LOCAL_COMMANDS
+
+    @classmethod
+    def unpack_ret_param(cls, evt, buf, offset):
+        offset = super(HCIReadLocalSupportedCommands, cls).unpack_ret_param(
+            evt, buf, offset)
+        evt.supported_cmds = buf[offset:offset+64]
+
+
 class HCIReadLocalSupportedFeatures(HCIInfoParamCommand,
                                     CmdCompltEvtParamUnpacker):
     ocf = bluez.OCF_READ_LOCAL_FEATURES
@@ -321,6 +351,22 @@ class HCIReadLocalExtendedFeatures(HCIInfoParamCommand,
         evt.ext_lmp_features = buf[offset:offset+8]
 
 
+class HCIReadBufferSize(HCIInfoParamCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_READ_BUFFER_SIZE
+
+    @classmethod
+    def unpack_ret_param(cls, evt, buf, offset):
+        offset = super(HCIReadBufferSize, cls).unpack_ret_param(
+            evt, buf, offset)
+        evt.hc_acl_data_pkt_len = letoh16(buf, offset)
+        offset += 2
+        evt.hc_sco_data_pkt_len = letoh8(buf, offset)
+        offset += 1
+        evt.hc_total_num_acl_data_pkts = letoh16(buf, offset)
+        offset += 2
+        evt.hc_total_num_sco_data_pkts = letoh16(buf, offset)
+
+
 class HCIReadBDAddr(HCIInfoParamCommand, CmdCompltEvtParamUnpacker):
     ocf = bluez.OCF_READ_BD_ADDR
 
@@ -711,6 +757,21 @@ class HCILEWriteSuggestedDefaultDataLength(HCILEControllerCommand,
              htole16(self.sug_max_tx_time)))
 
 
+class HCILESetAdvertisingSetRandomAddress(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_SET_ADVERTISING_SET_RANDOM_ADDRESS
+
+    def __init__(self, adv_handle, random_addr):
+        super(HCILESetAdvertisingSetRandomAddress, self).__init__()
+        self.adv_handle = adv_handle
+        self.random_addr = random_addr
+
+    def pack_param(self):
+        return ''.join((
+            htole8(self.adv_handle),
+            self.random_addr))
+
+
 class HCILESetExtendedAdvertisingParameters(
         HCILEControllerCommand, CmdCompltEvtParamUnpacker):
     ocf = bluez.OCF_LE_SET_EXT_ADVERTISING_PARAMETERS
@@ -828,7 +889,7 @@ class HCILESetExtendedAdvertisingEnable(
         self.num_sets = num_sets
         self.adv_set = [None] * num_sets
         for i in xrange(0, num_sets):
-            self.adv_set[i] = HCILESetExtendedAdvertisingEnable.AdvEnableParam(
+            self.adv_set[i] = HCILESetExtendedAdvertisingEnable.AdvSetParam(
                 args[3 * i], args[3 * i + 1], args[3 * i + 2])
 
     def pack_param(self):
@@ -986,5 +1047,97 @@ class HCILEExtendedCreateConnection(HCILEControllerCommand):
             ''.join(o.pack_param() for o in self.init_param)))
 
 
+class HCILEPeriodicAdvertisingCreateSync(HCILEControllerCommand):
+    ocf = bluez.OCF_LE_PERIODIC_ADVERTISING_CREATE_SYNC
+
+    def __init__(self, options, adv_sid, adv_addr_type, adv_addr, skip,
+                 sync_timeout, sync_cte_type=0):
+        super(HCILEPeriodicAdvertisingCreateSync, self).__init__()
+        self.options = options
+        self.adv_sid = adv_sid
+        self.adv_addr_type = adv_addr_type
+        self.adv_addr = adv_addr
+        self.skip = skip
+        self.sync_timeout = sync_timeout
+        self.sync_cte_type = sync_cte_type
+
+    def pack_param(self):
+        return ''.join((
+            htole8(self.options),
+            htole8(self.adv_sid),
+            htole8(self.adv_addr_type),
+            self.adv_addr,
+            htole16(self.skip),
+            htole16(self.sync_timeout),
+            htole8(self.sync_cte_type)))
+
+
+class HCILEPeriodicAdvertisingCreateSyncCancel(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_PERIODIC_ADVERTISING_CREATE_SYNC_CANCEL
+
+
+class HCILEPeriodicAdvertisingTerminateSync(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_PERIODIC_ADVERTISING_TERM_SYNC
+
+    def __init__(self, sync_handle):
+        super(HCILEPeriodicAdvertisingTerminateSync, self).__init__()
+        self.sync_handle = sync_handle
+
+    def pack_param(self):
+        return htole16(self.sync_handle)
+
+
+class HCILEAddDeviceToPeriodicAdvertiserList(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_ADD_DEVICE_TO_PERIODIC_ADVERTISER_LIST
+
+    def __init__(self, adv_addr_type, adv_addr, adv_sid):
+        super(HCILEAddDeviceToPeriodicAdvertiserList, self).__init__()
+        self.adv_addr_type = adv_addr_type
+        self.adv_addr = adv_addr
+        self.adv_sid = adv_sid
+
+    def pack_param(self):
+        return ''.join((
+            htole8(self.adv_addr_type),
+            self.adv_addr,
+            htole8(self.adv_sid)))
+
+
+class HCILERemoveDeviceFromPeriodicAdvertiserList(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_REMOVE_DEVICE_FROM_PERIODIC_ADVERTISER_LIST
+
+    def __init__(self, adv_addr_type, adv_addr, adv_sid):
+        super(HCILERemoveDeviceFromPeriodicAdvertiserList, self).__init__()
+        self.adv_addr_type = adv_addr_type
+        self.adv_addr = adv_addr
+        self.adv_sid = adv_sid
+
+    def pack_param(self):
+        return ''.join((
+            htole8(self.adv_addr_type),
+            self.adv_addr,
+            htole8(self.adv_sid)))
+
+
+class HCILEClearPeriodicAdvertiserList(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_CLEAR_PERIODIC_ADVERTISER_LIST
+
+
+class HCILEReadPeriodicAdvertiserListSize(
+        HCILEControllerCommand, CmdCompltEvtParamUnpacker):
+    ocf = bluez.OCF_LE_READ_PERIODIC_ADVERTISER_LIST_SIZE
+
+    @classmethod
+    def unpack_ret_param(cls, evt, buf, offset):
+        offset = super(HCILEReadPeriodicAdvertiserListSize,
+                       cls).unpack_ret_param(evt, buf, offset)
+        evt.list_size = letoh8(buf, offset)
+
+
 class HCIVendorCommand(HCICommand):
     ogf = bluez.OGF_VENDOR_CMD
@@ -1,17 +1,29 @@
 """Core module for HCI operations.
 """
+import collections
+import contextlib
 import logging
 import multiprocessing as mp
 import os
 import select
 import signal
+import struct
+import threading
 
 from . import bluez
 from . import command as btcmd
+from . import event as btevt
+from .adv import ExtAdvReassembler, ScanResultAggregator
+from .capability import get_capabilities
+from .capture import FORMAT_BTSNOOP, HCICapture
+from .clock import Deadline, get_clock, notify, timeout_ms, wait_ready
 from .command import HCICommand, HCIReadBDAddr
 from .data import HCIACLData, HCISCOData
-from .error import HCICommandError, HCIParseError, HCITimeoutError
+from .error import (HCICommandError, HCIParseError, HCITimeoutError,
+                    TestError)
 from .event import HCIEvent
+from .state import ControllerState
+from .sync import SharedBarrier, SharedCounter
 from .utils import letoh8
 
 
@@ -23,9 +35,33 @@ _pkt_table = {
 }
 
 
+# Size of the header holding the length of each packet type, after the
+# packet type octet
+_pkt_hdr_size = {
+    bluez.HCI_COMMAND_PKT: 3,
+    bluez.HCI_ACLDATA_PKT: 4,
+    bluez.HCI_SCODATA_PKT: 3,
+    bluez.HCI_EVENT_PKT: 2,
+}
+
+
 def get_hci_pkt_size(buf, offset=0):
+    """Return the size of the packet at offset of buf.
+
+    Returns:
+        int: Size of the packet including its packet type octet, or None if
+        buf ends before the length of the packet.
+
+    Raises:
+        HCIParseError: Raised if the packet type is unknown.
+    """
     ptype = letoh8(buf, offset)
+    hdr_size = _pkt_hdr_size.get(ptype)
+    if hdr_size is None:
+        raise HCIParseError('unknown packet type: {}'.format(ptype))
     offset += 1
+    if len(buf) - offset < hdr_size:
+        return None
     return 1 + _pkt_table[ptype].get_pkt_size(buf, offset)
 
 
@@ -36,13 +72,63 @@ def parse_hci_pkt(buf, offset=0):
     return (ptype, pkt)
 
 
+_cmd_pkt_hdr = struct.Struct('<BHB')
+_acl_pkt_hdr = struct.Struct('<BHH')
+
+
+def pack_hci_cmd_pkt(opcode, param=None):
+    """Return the H4 packet of a command."""
+    if param is None:
+        return _cmd_pkt_hdr.pack(bluez.HCI_COMMAND_PKT, opcode, 0)
+    return ''.join((_cmd_pkt_hdr.pack(bluez.HCI_COMMAND_PKT, opcode,
+                                      len(param)), param))
+
+
+def pack_acl_data_pkt(acl):
+    """Return the H4 packet of HCIACLData."""
+    data = acl.data or ''
+    return ''.join((_acl_pkt_hdr.pack(
+        bluez.HCI_ACLDATA_PKT,
+        acl.conn_handle | (acl.pb_flag << 12) | (acl.bc_flag << 14),
+        len(data)), data))
+
+
+def dev_name(dev_id):
+    """Return the name of a device id or transport for messages."""
+    if isinstance(dev_id, (int, long)):
+        return 'hci{}'.format(dev_id)
+    return str(dev_id)
+
+
 class HCISock(object):
+    """HCI socket of a controller.
+
+    Args:
+        dev_id: HCI device id, whose HCI user channel is opened, or a
+            transport standing in for the controller, e.g. a
+            ReplayTransport. A transport is a socket-like object with
+            fileno(), send(), recv() and close(), exchanging H4 packets,
+            one per send() and recv(). A transport with a clock_key
+            attribute notifies it when it has packets to receive, so that
+            it is waited on in virtual time; see bluetool.clock.
+    """
+
     def __init__(self, dev_id):
         super(HCISock, self).__init__()
-        self.sock = bluez.hci_new_user_channel(dev_id)
+        if isinstance(dev_id, (int, long)):
+            self.sock = bluez.hci_new_user_channel(dev_id)
+            self.transport = None
+        else:
+            self.sock = self.transport = dev_id
+        self.clock_key = getattr(self.sock, 'clock_key', None)
         self.poll = select.poll()
         self.poll.register(self.sock, (select.POLLIN | select.POLLPRI))
         self.rbuf = ''
+        self.caps = None  # ControllerCapabilities, see get_capabilities()
+        self.state = ControllerState()
+        self.inbox = collections.deque()  # parsed packets not yet received
+        self.link_inboxes = {}
+        self.capture = None
 
     def __del__(self):
         self.poll.unregister(self.sock)
@@ -51,39 +137,219 @@ class HCISock(object):
     def fileno(self):
         return self.sock.fileno()
 
+    def start_capture(self, path, fmt=FORMAT_BTSNOOP):
+        """Capture the packets sent and received to a btsnoop or pcap file.
+
+        The capture must be started in the process using the socket, since
+        its writer thread does not survive a fork.
+        """
+        self.stop_capture()
+        self.capture = HCICapture(path, fmt)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    @contextlib.contextmanager
+    def waiting_for(self, *cmds):
+        """Context of waiting for the command complete or status of cmds.
+
+        If the wait times out, cmds are forgotten by the controller state,
+        so that a later event of the same opcode is not taken for theirs.
+        """
+        try:
+            yield
+        except HCITimeoutError:
+            for cmd in cmds:
+                self.state.cmd_lost(cmd)
+            raise
+
     def send_hci_cmd(self, cmd):
+        self.state.cmd_sent(cmd)
         param = cmd.pack_param()
-        if param is not None:
+        if self.capture is not None:
+            self.capture.record_cmd(cmd.opcode(),
+                                    '' if param is None else param)
+        if self.transport is not None:
+            self.transport.send(pack_hci_cmd_pkt(cmd.opcode(), param))
+        elif param is not None:
             bluez.hci_send_cmd(self.sock, cmd.ogf, cmd.ocf, param)
         else:
             bluez.hci_send_cmd(self.sock, cmd.ogf, cmd.ocf)
 
     def send_acl_data(self, acl):
+        if self.capture is not None:
+            self.capture.record_acl(
+                acl.conn_handle | (acl.pb_flag << 12) | (acl.bc_flag << 14),
+                acl.data)
+        if self.transport is not None:
+            self.transport.send(pack_acl_data_pkt(acl))
+            return
         bluez.hci_send_acl(self.sock, acl.conn_handle, acl.pb_flag,
                            acl.bc_flag, acl.data)
 
     def recv_hci_pkt(self, timeout=None):
         """Receive a HCI packet.
 
-        This method waits for timeout milliseconds to receive a packet. If the
-        time is out, it raises HCITimeoutError exception. timeout is ignored
-        if timeout is None.
+        Args:
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+
+        Raises:
+            HCITimeoutError: Raised if no packet is received before the
+                deadline.
         """
+        deadline = Deadline.from_timeout(timeout)
         while True:
-            if len(self.rbuf) > 0:
-                pkt_size = get_hci_pkt_size(self.rbuf)
-                if pkt_size <= len(self.rbuf):
-                    break
-            if timeout is not None:
-                if len(self.poll.poll(timeout)) == 0:
-                    raise HCITimeoutError
-            buf = self.sock.recv(1024)
-            self.rbuf = ''.join((self.rbuf, buf))
+            ptype_pkt = self._pop_hci_pkt()
+            if ptype_pkt is not None:
+                return ptype_pkt
+            self._recv(deadline)
+
+    def _recv(self, deadline):
+        if deadline.expiry is not None or self.clock_key is not None:
+            if not wait_ready(self._poll, deadline, self.clock_key):
+                raise HCITimeoutError
+        buf = self.sock.recv(1024)
+        self.rbuf = ''.join((self.rbuf, buf))
+
+    def _poll(self, timeout):
+        return self.poll.poll(timeout_ms(timeout))
 
+    def read_hci_pkts(self):
+        """Read available data and return the list of complete HCI packets.
+
+        This method is intended to be called when the socket is readable, e.g.
+        by an event loop polling many sockets. Incomplete data is kept in the
+        receive buffer for the next call.
+        """
+        buf = self.sock.recv(4096)
+        self.rbuf = ''.join((self.rbuf, buf))
+        pkts = []
+        ptype_pkt = self._pop_hci_pkt()
+        while ptype_pkt is not None:
+            pkts.append(ptype_pkt)
+            ptype_pkt = self._pop_hci_pkt()
+        return pkts
+
+    def _pop_hci_pkt(self):
+        while True:
+            if self.inbox:
+                return self.inbox.popleft()
+            ptype_pkt = self._parse_hci_pkt()
+            if ptype_pkt is None:
+                return None
+            ptype_pkt = self._route_hci_pkt(ptype_pkt)
+            if ptype_pkt is not None:
+                return ptype_pkt
+
+    def _parse_hci_pkt(self):
+        if len(self.rbuf) == 0:
+            return None
+        pkt_size = get_hci_pkt_size(self.rbuf)
+        if pkt_size is None or pkt_size > len(self.rbuf):
+            # Read split within the packet
+            return None
         ptype_pkt = parse_hci_pkt(self.rbuf)
+        if self.capture is not None:
+            self.capture.record_received(self.rbuf[:pkt_size])
         self.rbuf = self.rbuf[pkt_size:]
+        if ptype_pkt[0] == bluez.HCI_EVENT_PKT:
+            self.state.update(ptype_pkt[1])
         return ptype_pkt
 
+    def _route_hci_pkt(self, ptype_pkt):
+        # Return the packet if it is not routed to a link inbox.
+        if not self.link_inboxes:
+            return ptype_pkt
+        ptype, pkt = ptype_pkt
+        if ptype == bluez.HCI_ACLDATA_PKT:
+            link_inbox = self.link_inboxes.get(pkt.conn_handle)
+            if link_inbox is None:
+                return ptype_pkt
+            link_inbox.acl.append(pkt)
+            return None
+        if ptype != bluez.HCI_EVENT_PKT:
+            return ptype_pkt
+        if pkt.__class__ is btevt.NumberOfCompletedPacketsEvent:
+            return self._route_nocp_evt(pkt)
+        if pkt.__class__ not in _link_evt_classes:
+            return ptype_pkt
+        link_inbox = self.link_inboxes.get(pkt.conn_handle)
+        if link_inbox is None:
+            return ptype_pkt
+        link_inbox.evts.append(pkt)
+        return None
+
+    def _route_nocp_evt(self, evt):
+        unrouted = []
+        for e in evt.split():
+            link_inbox = self.link_inboxes.get(e.conn_handle[0])
+            if link_inbox is None:
+                unrouted.append(e)
+            else:
+                link_inbox.evts.append(e)
+        if not unrouted:
+            return None
+        if len(unrouted) < evt.num_handles:
+            evt.num_handles = len(unrouted)
+            evt.conn_handle = [e.conn_handle[0] for e in unrouted]
+            evt.num_completed_pkts = [e.num_completed_pkts[0]
+                                      for e in unrouted]
+        return (bluez.HCI_EVENT_PKT, evt)
+
+    def route_link(self, conn_handle):
+        """Route the events and ACL data of conn_handle to its own inbox.
+
+        The packets are received by recv_link_evt() and recv_link_acl()
+        instead of recv_hci_pkt(). Routed events are the events of an
+        established connection, such as disconnection complete, encryption
+        change or connection update complete; Number Of Completed Packets
+        events are split by handle.
+        """
+        if conn_handle not in self.link_inboxes:
+            self.link_inboxes[conn_handle] = _LinkInbox()
+
+    def unroute_link(self, conn_handle):
+        """Stop routing conn_handle and drop the packets in its inbox."""
+        self.link_inboxes.pop(conn_handle, None)
+
+    def _recv_link_pkt(self, queue, timeout):
+        deadline = Deadline.from_timeout(timeout)
+        while True:
+            if queue:
+                return queue.popleft()
+            ptype_pkt = self._parse_hci_pkt()
+            if ptype_pkt is None:
+                self._recv(deadline)
+                continue
+            ptype_pkt = self._route_hci_pkt(ptype_pkt)
+            if ptype_pkt is not None:
+                self.inbox.append(ptype_pkt)
+
+    def recv_link_evt(self, conn_handle, timeout=None):
+        """Receive an event routed to conn_handle.
+
+        Packets of other links and unrouted packets received meanwhile are
+        queued for their receivers.
+
+        Args:
+            conn_handle: Connection handle passed to route_link().
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+        """
+        return self._recv_link_pkt(self.link_inboxes[conn_handle].evts,
+                                   timeout)
+
+    def recv_link_acl(self, conn_handle, timeout=None):
+        """Receive ACL data of conn_handle; see recv_link_evt()."""
+        return self._recv_link_pkt(self.link_inboxes[conn_handle].acl,
+                                   timeout)
+
     def recv_hci_evt(self, timeout=None):
         ptype, evt = self.recv_hci_pkt(timeout)
         if ptype != bluez.HCI_EVENT_PKT:
@@ -91,6 +357,29 @@ class HCISock(object):
         return evt
 
 
+class _LinkInbox(object):
+    def __init__(self):
+        super(_LinkInbox, self).__init__()
+        self.evts = collections.deque()
+        self.acl = collections.deque()
+
+
+# Events routed to the inbox of their connection handle.
+_link_evt_classes = frozenset((
+    btevt.DisconnectionCompleteEvent,
+    btevt.EncryptionChangeEvent,
+    btevt.ReadRemoteSupportedFeaturesCompleteEvent,
+    btevt.ReadRemoteVersionInformationCompleteEvent,
+    btevt.ModeChangeEvent,
+    btevt.MaxSlotsChangeEvent,
+    btevt.ReadRemoteExtendedFeaturesCompleteEvent,
+    btevt.LEConnectionUpdateCompleteEvent,
+    btevt.LELongTermKeyRequestEvent,
+    btevt.LEDataLengthChangeEvent,
+    btevt.LEChannelSelectionAlgorithmEvent,
+))
+
+
 class HCITask(object):
     def __init__(self, hci_sock):
         super(HCITask, self).__init__()
@@ -111,45 +400,130 @@ class HCITask(object):
         return self.sock.recv_hci_evt(timeout)
 
     def wait_hci_evt(self, evt_matcher, timeout=None):
+        """Wait for an event matched by evt_matcher.
+
+        Unmatched events are ignored. The wait ends at the deadline given by
+        timeout however many unmatched events are received.
+
+        Args:
+            evt_matcher: Function returning True for the awaited event.
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+        """
+        deadline = Deadline.from_timeout(timeout)
         while True:
-            evt = self.recv_hci_evt(timeout)
+            evt = self.recv_hci_evt(deadline)
             if evt_matcher(evt):
                 return evt
             self.log.info('ignore event: {}'.format(str(evt)))
 
-    def send_hci_cmd_wait_cmd_complt(self, cmd):
+    def send_hci_cmd_wait_cmd_complt(self, cmd, timeout=None):
         self.send_hci_cmd(cmd)
-        evt = self.wait_hci_evt(
-            lambda evt: (
-                evt.code == bluez.EVT_CMD_COMPLETE
-                and evt.cmd_opcode == cmd.opcode()))
+        with self.sock.waiting_for(cmd):
+            evt = self.wait_hci_evt(
+                lambda evt: (
+                    evt.code == bluez.EVT_CMD_COMPLETE
+                    and evt.cmd_opcode == cmd.opcode()),
+                timeout)
         return evt
 
-    def send_hci_cmd_wait_cmd_status(self, cmd):
+    def send_hci_cmd_wait_cmd_status(self, cmd, timeout=None):
         self.send_hci_cmd(cmd)
-        evt = self.wait_hci_evt(
-            lambda evt: (
-                evt.code == bluez.EVT_CMD_STATUS
-                and evt.cmd_opcode == cmd.opcode()))
+        with self.sock.waiting_for(cmd):
+            evt = self.wait_hci_evt(
+                lambda evt: (
+                    evt.code == bluez.EVT_CMD_STATUS
+                    and evt.cmd_opcode == cmd.opcode()),
+                timeout)
         return evt
 
+    def send_hci_cmds(self, cmds, window=4, timeout=None):
+        """Send commands pipelined and wait for their command complete or
+        command status events.
+
+        As many commands as the controller allows are outstanding at a
+        time instead of one, so a batch of commands does not pay a round
+        trip per command when the controller accepts several. The allowance
+        is the Num_HCI_Command_Packets of the last command complete or
+        command status event; a single command is sent before the first
+        one. The controller executes the commands in the order they are
+        sent.
+
+        Args:
+            cmds: Sequence of commands.
+            window: Maximum number of outstanding commands, whatever the
+                controller allows.
+            timeout: Maximum time in seconds to complete all commands, or a
+                Deadline.
+
+        Returns:
+            list: Events of cmds, in the same order.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        evts = [None] * len(cmds)
+        outstanding = collections.deque()
+        num_cmd_pkts = 1
+        next_cmd = 0
+        num_done = 0
+        while num_done < len(cmds):
+            while (next_cmd < len(cmds) and num_cmd_pkts > 0
+                   and len(outstanding) < window):
+                self.send_hci_cmd(cmds[next_cmd])
+                outstanding.append((cmds[next_cmd].opcode(), next_cmd))
+                next_cmd += 1
+                num_cmd_pkts -= 1
+            try:
+                evt = self.recv_hci_evt(deadline)
+            except HCITimeoutError:
+                for _, i in outstanding:
+                    self.sock.state.cmd_lost(cmds[i])
+                raise
+            if evt.code in (bluez.EVT_CMD_COMPLETE, bluez.EVT_CMD_STATUS):
+                num_cmd_pkts = evt.num_hci_cmd_pkt
+                for entry in outstanding:
+                    if entry[0] == evt.cmd_opcode:
+                        outstanding.remove(entry)
+                        evts[entry[1]] = evt
+                        num_done += 1
+                        break
+                else:
+                    self.log.info('ignore event: {}'.format(str(evt)))
+            else:
+                self.log.info('ignore event: {}'.format(str(evt)))
+        return evts
+
 
 class HCIWorker(HCITask, mp.Process):
     def __init__(self, hci_sock, coord, pipe):
         super(HCIWorker, self).__init__(hci_sock)
         self.coord = coord
         self.pipe = pipe
-        self.event = mp.Event()
+        # Signals are counted: a signal sent before the previous one was
+        # waited for is not lost.
+        self.signals = mp.Semaphore(0)
+        self.clock_ticket = None
+
+    def start(self):
+        # The worker takes part in virtual time from before it is forked.
+        self.clock_ticket = get_clock().reserve()
+        super(HCIWorker, self).start()
 
     def run(self):
-        try:
-            self.main()
-        except Exception as err:
-            self.log.warning(
-                '{}: {}'.format(err.__class__.__name__, str(err)),
-                exc_info=True)
-            self.coord.put_terminated_worker(self.pid)
-            os.kill(self.coord.pid, signal.SIGINT)
+        with get_clock().participant(self.clock_ticket):
+            try:
+                self.main()
+            except Exception as err:
+                self.log.warning(
+                    '{}: {}'.format(err.__class__.__name__, str(err)),
+                    exc_info=True)
+                self.coord.put_terminated_worker(self.pid)
+                os.kill(self.coord.pid, signal.SIGINT)
 
     def main(self):
         """Main function of worker object.
@@ -159,47 +533,304 @@ class HCIWorker(HCITask, mp.Process):
         raise NotImplementedError
 
     def wait(self, timeout=None):
-        if not self.event.wait(timeout):
+        """Wait to be signaled.
+
+        Args:
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+        """
+        if not wait_ready(self._acquire_signal, timeout, id(self.signals)):
             raise HCITimeoutError
-        self.event.clear()
+
+    def _acquire_signal(self, timeout):
+        return self.signals.acquire(True, timeout)
 
     def signal(self):
-        self.event.set()
+        self.signals.release()
+        notify(id(self.signals))
 
     def send(self, obj):
         """Send an object to the corresponding coordinator."""
         self.pipe.send(obj)
+        # The coordinator waits on the key of the worker.
+        notify(id(self))
 
     def recv(self, timeout=None):
         """Receive an object sent from the corresponding coordinator.
 
         Args:
-            timeout: Maximum time in seconds to block. If timeout is None,
-                then an infinite timeout is used.
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
 
         Raises:
             HCITimeoutError: Raised if timeout occurs.
         """
-        if timeout is not None:
-            if not self.pipe.poll(timeout):
-                raise HCITimeoutError
+        if not wait_ready(self.pipe.poll, timeout, id(self.pipe)):
+            raise HCITimeoutError
         return self.pipe.recv()
 
+    def barrier(self, name):
+        """Get the barrier added by the coordinator with add_barrier()."""
+        return self.coord.barriers[name]
+
+    def counter(self, name):
+        """Get the counter added by the coordinator with add_counter()."""
+        return self.coord.counters[name]
+
 
 class ReadBDAddrTask(HCITask):
     def __init__(self, hci_sock):
         super(ReadBDAddrTask, self).__init__(hci_sock)
 
-    def read_bd_addr(self):
+    def read_bd_addr(self, timeout=None):
         cmd = HCIReadBDAddr()
-        evt = self.send_hci_cmd_wait_cmd_complt(cmd)
+        evt = self.send_hci_cmd_wait_cmd_complt(cmd, timeout)
         return evt.bd_addr
 
 
+class HCILinkTask(HCITask):
+    """Task receiving the events and ACL data of one connection.
+
+    The connection is routed to its own inbox of the HCISock, so that
+    several tasks can drive their links from one worker without receiving
+    or dropping the packets of each other. Command complete and command
+    status events are not routed; they are awaited on the shared stream.
+    """
+
+    def __init__(self, hci_sock, conn_handle):
+        super(HCILinkTask, self).__init__(hci_sock)
+        self.conn_handle = conn_handle
+        self.cmd_task = HCITask(hci_sock)
+        hci_sock.route_link(conn_handle)
+
+    def close(self):
+        self.sock.unroute_link(self.conn_handle)
+
+    def send_hci_cmd_wait_cmd_complt(self, cmd, timeout=None):
+        return self.cmd_task.send_hci_cmd_wait_cmd_complt(cmd, timeout)
+
+    def send_hci_cmd_wait_cmd_status(self, cmd, timeout=None):
+        return self.cmd_task.send_hci_cmd_wait_cmd_status(cmd, timeout)
+
+    def recv_hci_evt(self, timeout=None):
+        return self.sock.recv_link_evt(self.conn_handle, timeout)
+
+    def recv_acl_data(self, timeout=None):
+        return self.sock.recv_link_acl(self.conn_handle, timeout)
+
+    def wait_disconnection_complete(self, timeout=None):
+        return self.wait_hci_evt(
+            lambda evt: evt.code == bluez.EVT_DISCONN_COMPLETE, timeout)
+
+
+class HCISession(object):
+    """HCI user channel of a device kept open across tests.
+
+    Closing the user channel of a device makes the kernel reset the
+    controller, and each test opening it again reads its BD_ADDR and
+    capabilities. A session is a transport of HCISock which stays open
+    instead; see open_hci_sessions(). Sessions are passed as the devices
+    of a test configuration, and a device brought up on a session is reset
+    and takes the BD_ADDR and capabilities of the session.
+
+    Tests use the sessions from processes forked while they are open, e.g.
+    by the bluetest daemon. The channel is only closed by shutdown(), not
+    by close() or the HCISocks using the session.
+
+    Args:
+        dev_id: HCI device id whose user channel is opened, or transport.
+
+    Attributes:
+        bd_addr: BD_ADDR of the device, or None until it is brought up.
+        caps: ControllerCapabilities of the device, or None.
+        error: Exception raised while bringing up the device, or None.
+    """
+
+    def __init__(self, dev_id):
+        super(HCISession, self).__init__()
+        self.dev_id = dev_id
+        if isinstance(dev_id, (int, long)):
+            self.sock = bluez.hci_new_user_channel(dev_id)
+        else:
+            self.sock = dev_id
+        self.bd_addr = None
+        self.caps = None
+        self.error = None
+
+    def __str__(self):
+        return dev_name(self.dev_id)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, pkt):
+        return self.sock.send(pkt)
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def close(self):
+        """Leave the channel open for the next test."""
+        pass
+
+    def shutdown(self):
+        """Close the channel."""
+        self.sock.close()
+
+
+class HCIDevice(object):
+    """HCI device brought up by init_hci_devices().
+
+    Attributes:
+        dev_id: HCI device id, transport or HCISession; see HCISock.
+        sock: Opened HCISock, or None if the device failed.
+        bd_addr: BD_ADDR of the device.
+        caps: ControllerCapabilities of the device.
+        error: Exception raised while bringing up the device, or None.
+        elapsed: Time in seconds taken to bring up the device.
+    """
+
+    def __init__(self, dev_id):
+        super(HCIDevice, self).__init__()
+        self.dev_id = dev_id
+        self.sock = None
+        self.bd_addr = None
+        self.caps = None
+        self.error = None
+        self.elapsed = None
+
+    def init(self, pre_reset=False, timeout=None):
+        start = get_clock().time()
+        deadline = Deadline(timeout)
+        try:
+            self.sock = HCISock(self.dev_id)
+            task = ReadBDAddrTask(self.sock)
+            session = self.dev_id
+            if isinstance(session, HCISession) and session.bd_addr is not None:
+                # The reset stands in for the one of closing the channel.
+                pre_reset = True
+                self.bd_addr = session.bd_addr
+                self.sock.caps = session.caps
+            else:
+                self.bd_addr = task.read_bd_addr(deadline)
+            if pre_reset:
+                evt = task.send_hci_cmd_wait_cmd_complt(
+                    btcmd.HCIReset(), deadline)
+                if evt.status != 0:
+                    raise HCICommandError(evt)
+            self.caps = get_capabilities(task, self.bd_addr, deadline)
+        except Exception as err:
+            self.error = err
+            self.sock = None
+        self.elapsed = get_clock().time() - start
+
+
+def init_hci_devices(dev_ids, pre_reset=False, timeout=None):
+    """Bring up HCI devices concurrently.
+
+    Each device is opened and its BD_ADDR and capabilities are read in its
+    own thread. If pre_reset is True, the device is also reset; devices of
+    an HCISession are always reset. A device failing or not responding
+    within timeout seconds does not delay the others; it is reported by
+    the error attribute of its HCIDevice.
+
+    Returns:
+        list: HCIDevice objects in the order of dev_ids.
+    """
+    log = logging.getLogger(__name__)
+    devs = [HCIDevice(dev_id) for dev_id in dev_ids]
+    clock = get_clock()
+
+    def init(dev, ticket):
+        with clock.participant(ticket):
+            dev.init(pre_reset, timeout)
+    threads = [threading.Thread(target=init, args=(dev, clock.reserve()))
+               for dev in devs]
+    for t in threads:
+        t.start()
+    with clock.blocked():
+        for t in threads:
+            t.join()
+    for dev in devs:
+        if dev.error is None:
+            log.info('%s: %s up in %.3f s', dev_name(dev.dev_id),
+                     bluez.ba2str(dev.bd_addr), dev.elapsed)
+        else:
+            log.warning('%s: failed in %.3f s: %s: %s',
+                        dev_name(dev.dev_id), dev.elapsed,
+                        dev.error.__class__.__name__, str(dev.error))
+    return devs
+
+
+def open_hci_sessions(dev_ids, timeout=None):
+    """Open HCISessions and bring up their devices concurrently.
+
+    The devices are reset, and their BD_ADDR and capabilities kept by the
+    sessions.
+
+    Returns:
+        list: HCISession objects in the order of dev_ids. A session whose
+            device failed to come up has its error attribute set.
+    """
+    sessions = [HCISession(dev_id) for dev_id in dev_ids]
+    devs = init_hci_devices(sessions, True, timeout)
+    for session, dev in zip(sessions, devs):
+        session.bd_addr = dev.bd_addr
+        session.caps = dev.caps
+        session.error = dev.error
+    return sessions
+
+
+def init_config_devices(cfg):
+    """Bring up the devices of all workers in a test configuration.
+
+    Devices are brought up concurrently by init_hci_devices(). The optional
+    'pre_reset' entry of cfg resets devices during bring-up, and the optional
+    'init_timeout' entry bounds the bring-up time of each device in seconds
+    (default: 5). The optional 'device' entry lists the HCI device ids,
+    transports or HCISessions of the workers (default: 0, 1, ...).
+
+    Returns:
+        list: HCIDevice objects in the order of workers.
+
+    Raises:
+        TestError: Raised if fewer devices than workers are given or any
+            device fails to come up.
+    """
+    num_workers = len(cfg['worker'])
+    if 'device' not in cfg:
+        dev_id = range(num_workers)
+    else:
+        dev_id = cfg['device']
+    if len(dev_id) < num_workers:
+        raise TestError('{} workers but {} devices'.format(
+            num_workers, len(dev_id)))
+    devs = init_hci_devices(
+        dev_id[:num_workers], cfg.get('pre_reset', False),
+        cfg.get('init_timeout', 5))
+    failed = [dev for dev in devs if dev.error is not None]
+    if len(failed) > 0:
+        raise TestError('failed to bring up devices: {}'.format(
+            ', '.join(dev_name(dev.dev_id) for dev in failed)))
+    return devs
+
+
 class HCIWorkerProxy(object):
-    def __init__(self, dev_id, coord, worker_type, *args):
-        self.sock = HCISock(dev_id)
-        self.bd_addr = ReadBDAddrTask(self.sock).read_bd_addr()
+    def __init__(self, dev, coord, worker_type, *args):
+        """Create a worker on a device.
+
+        dev is either a HCI device id, a transport (see HCISock) or a
+        HCIDevice already brought up.
+        """
+        if isinstance(dev, HCIDevice):
+            self.sock = dev.sock
+            self.bd_addr = dev.bd_addr
+        else:
+            self.sock = HCISock(dev)
+            self.bd_addr = ReadBDAddrTask(self.sock).read_bd_addr()
         self.pipe, pipe = mp.Pipe()
         self.worker = worker_type(self.sock, coord, pipe, *args)
 
@@ -216,27 +847,37 @@ class HCIWorkerProxy(object):
     def send(self, obj):
         """Send an object to the corresponding worker."""
         self.pipe.send(obj)
+        notify(id(self.worker.pipe))
 
     def recv(self, timeout=None):
         """Receive an object sent from the corresponding worker
 
         Args:
-            timeout: Maximum time in seconds to block. If timeout is None,
-                then an infinite timeout is used.
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
 
         Raises:
             HCITimeoutError: Raised if timeout occurs.
         """
-        if timeout is not None:
-            if not self.pipe.poll(timeout):
-                raise HCITimeoutError
+        if not wait_ready(self.pipe.poll, timeout, id(self.worker)):
+            raise HCITimeoutError
         return self.pipe.recv()
 
+    def barrier(self, name):
+        return self.worker.barrier(name)
+
+    def counter(self, name):
+        return self.worker.counter(name)
+
     def start(self):
         self.worker.start()
 
     def join(self):
-        self.worker.join()
+        clock = get_clock()
+        with clock.blocked():
+            self.worker.join()
+        # A terminated worker did not leave the clock.
+        clock.release(self.worker.clock_ticket)
 
     def terminate(self):
         self.worker.terminate()
@@ -246,51 +887,69 @@ class HCICoordinator(object):
     def __init__(self):
         super(HCICoordinator, self).__init__()
         self.worker = []
+        self.barriers = {}
+        self.counters = {}
         self.pid = os.getpid()
         self.term_worker_queue = mp.Queue()
         self.log = logging.getLogger(
             '{}.{}'.format(__name__, self.__class__.__name__))
 
     def run(self):
-        for w in self.worker:
-            w.start()
-        try:
-            ret = self.main()
-            if ret is None:
-                ret = 0
+        with get_clock().participant():
             for w in self.worker:
-                w.join()
-        except KeyboardInterrupt:
-            term_workers = self.get_terminated_workers()
-            for w in self.worker:
-                if w.pid not in term_workers:
-                    w.terminate()
-            for w in self.worker:
-                w.join()
-            ret = 1
+                w.start()
+            try:
+                ret = self.main()
+                if ret is None:
+                    ret = 0
+                for w in self.worker:
+                    w.join()
+            except KeyboardInterrupt:
+                term_workers = self.get_terminated_workers()
+                for w in self.worker:
+                    if w.pid not in term_workers:
+                        w.terminate()
+                for w in self.worker:
+                    w.join()
+                ret = 1
         return ret
 
-    def add_worker(self, name, dev_id, worker_type):
-        w = HCIWorkerProxy(dev_id, self, worker_type)
+    def add_worker(self, name, dev, worker_type):
+        w = HCIWorkerProxy(dev, self, worker_type)
         self.worker.append(w)
         setattr(self, name, w)
 
+    def add_barrier(self, name, parties):
+        """Add a named SharedBarrier for parties processes.
+
+        Barriers and counters must be added before run() starts workers.
+        Workers and worker proxies get them with barrier(name).
+        """
+        self.barriers[name] = SharedBarrier(parties)
+        return self.barriers[name]
+
+    def add_counter(self, name, value=0):
+        """Add a named SharedCounter.
+
+        Workers and worker proxies get it with counter(name).
+        """
+        self.counters[name] = SharedCounter(value)
+        return self.counters[name]
+
     def load(self, cfg):
-        workers = cfg['worker']
-        num_workers = len(workers)
-        if 'device' not in cfg:
-            dev_id = range(num_workers)
-        else:
-            dev_id = cfg['device']
-        i = 0
-        for w in workers:
-            self.add_worker(w[0], dev_id[i], w[1])
-            i += 1
+        """Load a test configuration.
+
+        See init_config_devices() for how devices are brought up.
+        """
+        self.devices = init_config_devices(cfg)
+        for w, dev in zip(cfg['worker'], self.devices):
+            self.add_worker(w[0], dev, w[1])
 
     def get_terminated_workers(self):
         """Get pids of terminated workers."""
         workers = set()
-        workers.add(self.term_worker_queue.get())
+        with get_clock().blocked():
+            workers.add(self.term_worker_queue.get())
         # Just make sure get one pid of terminated workers. If more than
         # one pid are put into queue, we don't care missing them.
         while not self.term_worker_queue.empty():
@@ -338,12 +997,13 @@ class HCIDataTransWorker(HCIWorker):
             timeout: Timeout value in seconds to block. If timeout is None,
                 then infinite timeout is used.
         """
-        timeout_ms = timeout * 1000
         num_acl_data = self.recv(timeout)
         i = 0
+        deadline = Deadline(timeout)
         while i < num_acl_data:
-            pkt_type, pkt = self.recv_hci_pkt(timeout_ms)
+            pkt_type, pkt = self.recv_hci_pkt(deadline)
             if pkt_type == bluez.HCI_ACLDATA_PKT:
+                deadline = Deadline(timeout)
                 self.send(pkt)
                 status = self.recv(timeout)
                 if status == HCI_DATA_TRANS_CONTINUED:
@@ -399,6 +1059,11 @@ class HCIDataTransCoordinator(HCICoordinator):
                     and acl_data == acl.data):
                 succeeded = True
                 recv_worker.send(HCI_DATA_TRANS_COMPLETED)
+            elif (acl_recv.conn_handle == recv_conn_handle
+                    and len(acl_data) >= len(acl.data)):
+                # No continuation can make corrupted data match.
+                succeeded = False
+                recv_worker.send(HCI_DATA_TRANS_FAILED)
             else:
                 while True:
                     recv_worker.send(HCI_DATA_TRANS_CONTINUED)
@@ -414,6 +1079,10 @@ class HCIDataTransCoordinator(HCICoordinator):
                         succeeded = True
                         recv_worker.send(HCI_DATA_TRANS_COMPLETED)
                         break
+                    if len(acl_data) >= len(acl.data):
+                        succeeded = False
+                        recv_worker.send(HCI_DATA_TRANS_FAILED)
+                        break
 
             send_worker.send(succeeded)
             if not succeeded:
@@ -424,178 +1093,202 @@ class HCIDataTransCoordinator(HCICoordinator):
         return succeeded
 
 
-class BTHelper(HCITask):
-    def __init__(self, hci_sock):
-        super(BTHelper, self).__init__(hci_sock)
+class _BTProcedures(object):
+    """Procedures shared by BTHelper and BTCoHelper.
+
+    The procedures are written once over the primitives of the helper they
+    are mixed into. A procedure of a single command or wait returns what the
+    primitive returns: the event for HCITask, or the wait object or
+    coroutine to be yielded for HCICoTask (see loop.py). A procedure of
+    several steps is a generator yielding the result of each primitive and
+    getting its event back; it is run by the _run() method of the helper.
+    Timeouts are in seconds, or a Deadline; a procedure of several steps is
+    bounded as a whole.
+    """
 
     def check_hci_evt_status(self, evt):
         if evt.status != 0:
             raise HCICommandError(evt)
 
-    def send_hci_cmd_wait_cmd_complt_check_status(self, cmd):
-        evt = self.send_hci_cmd_wait_cmd_complt(cmd)
-        self.check_hci_evt_status(evt)
-        return evt
+    def disconnect(self, conn_handle, reason, timeout=None):
+        cmd = btcmd.HCIDisconnect(conn_handle, reason)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
-    def send_hci_cmd_wait_cmd_status_check_status(self, cmd):
-        evt = self.send_hci_cmd_wait_cmd_status(cmd)
-        self.check_hci_evt_status(evt)
-        return evt
+    def wait_disconnection_complete(self, conn_handle=None, timeout=None):
+        return self.wait_hci_evt(
+            lambda evt: (
+                evt.code == bluez.EVT_DISCONN_COMPLETE
+                and (conn_handle is None or conn_handle == evt.conn_handle)),
+            timeout)
 
-    def disconnect(self, conn_handle, reason):
-        cmd = btcmd.HCIDisconnect(conn_handle, reason)
-        self.send_hci_cmd_wait_cmd_status_check_status(cmd)
 
+class _BREDRProcedures(object):
+    """Procedures shared by BREDRHelper and BREDRCoHelper.
 
-class BREDRHelper(BTHelper):
-    def __init__(self, hci_sock):
-        super(BREDRHelper, self).__init__(hci_sock)
+    See _BTProcedures.
+    """
+
+    def reset(self, timeout=None):
+        return self._run(self._reset(Deadline.from_timeout(timeout)))
 
-    def reset(self):
+    def _reset(self, deadline):
         cmd = btcmd.HCIReset()
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
         cmd = btcmd.HCISetEventMask(0x20001FFFFFFFFFFFL)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
         cmd = btcmd.HCIWritePageScanActivity(0x0800, 0x0012)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
         cmd = btcmd.HCIWriteScanEnable(0x02)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
-    def create_connection_by_peer_addr(self, peer_addr):
+    def create_connection_by_peer_addr(self, peer_addr, timeout=None):
         cmd = btcmd.HCICreateConnection(peer_addr, 0x0000, 0x01, 0x0000, 0x00)
-        self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
     def accept_connection(self, timeout=None):
-        evt = self.wait_hci_evt(
+        return self._run(
+            self._accept_connection(Deadline.from_timeout(timeout)))
+
+    def _accept_connection(self, deadline):
+        evt = yield self.wait_hci_evt(
             lambda evt: evt.code == bluez.EVT_CONN_REQUEST,
-            timeout)
+            deadline)
         cmd = btcmd.HCIAcceptConnectionRequest(evt.bd_addr, 0x01)
-        self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_status_check_status(cmd, deadline)
 
     def wait_connection_complete(self, timeout=None):
         return self.wait_hci_evt(
             lambda evt: evt.code == bluez.EVT_CONN_COMPLETE,
             timeout)
 
-    def wait_disconnection_complete(self, conn_handle=None, timeout=None):
-        return self.wait_hci_evt(
-            lambda evt: (
-                evt.code == bluez.EVT_DISCONN_COMPLETE
-                and (conn_handle is None or conn_handle == evt.conn_handle)),
-            timeout)
-
     def sniff_mode(self, conn_handle, sniff_max_intvl, sniff_min_intvl,
-                   sniff_attempt, sniff_timeout):
+                   sniff_attempt, sniff_timeout, timeout=None):
         cmd = btcmd.HCISniffMode(conn_handle, sniff_max_intvl, sniff_min_intvl,
                                  sniff_attempt, sniff_timeout)
-        return self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
-    def exit_sniff_mode(self, conn_handle):
+    def exit_sniff_mode(self, conn_handle, timeout=None):
         cmd = btcmd.HCIExitSniffMode(conn_handle)
-        return self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
-    def write_link_policy(self, conn_handle, policy):
+    def write_link_policy(self, conn_handle, policy, timeout=None):
         cmd = btcmd.HCIWriteLinkPolicySettings(conn_handle, policy)
-        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
-
-
-class LEHelper(BTHelper):
-    def __init__(self, hci_sock):
-        super(LEHelper, self).__init__(hci_sock)
-        self.init_scan_intvl = 96
-        self.init_scan_win = 24
-
-    def reset(self):
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+
+def le_evt_mask(le_features):
+    """Return the LE event mask enabling all events supported by le_features.
+    """
+    evt_mask = 0x000000000000001FL
+    if le_features & 0x2:  # conn param request procedure
+        evt_mask |= 0x20
+    if le_features & 0x20:  # LE data length extension
+        evt_mask |= 0x40
+    if le_features & 0x40:  # LL privacy
+        evt_mask |= 0x780
+    if le_features & 0x900:  # LE 2M or Coded PHY
+        evt_mask |= 0x800
+    if le_features & 0x1000:  # LE extended advertising
+        evt_mask |= 0x71000
+    if le_features & 0x2000:  # LE periodic advertising
+        evt_mask |= 0xE000
+    if le_features & 0x4000:  # channel selection algo 2
+        evt_mask |= 0x80000
+    return evt_mask
+
+
+class _LEProcedures(object):
+    """Procedures shared by LEHelper and LECoHelper.
+
+    See _BTProcedures. The helper provides _read_le_features(), a step
+    returning the LE features of the controller.
+    """
+
+    init_scan_intvl = 96
+    init_scan_win = 24
+
+    def reset(self, timeout=None):
+        return self._run(self._reset(Deadline.from_timeout(timeout)))
+
+    def _reset(self, deadline):
         cmd = btcmd.HCIReset()
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
         cmd = btcmd.HCISetEventMask(0x20001FFFFFFFFFFFL)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
-
-        evt_mask = 0x000000000000001FL
-        cmd = btcmd.HCILEReadLocalSupportedFeatures()
-        evt = self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
-        if evt.le_features & 0x2:  # conn param request procedure
-            evt_mask |= 0x20
-        if evt.le_features & 0x20:  # LE data length extension
-            evt_mask |= 0x40
-        if evt.le_features & 0x40:  # LL privacy
-            evt_mask |= 0x780
-        if evt.le_features & 0x900:  # LE 2M or Coded PHY
-            evt_mask |= 0x800
-        if evt.le_features & 0x1000:  # LE extended advertising
-            evt_mask |= 0x71000
-        if evt.le_features & 0x2000:  # LE periodic advertising
-            evt_mask |= 0xE000
-        if evt.le_features & 0x4000:  # channel selection algo 2
-            evt_mask |= 0x80000
-        cmd = btcmd.HCILESetEventMask(evt_mask)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
-
-        cmd = btcmd.HCILEClearWhiteList()
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
-    def read_buffer_size(self):
-        cmd = btcmd.HCILEReadBufferSize()
-        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        le_features = yield self._read_le_features(deadline)
+        cmd = btcmd.HCILESetEventMask(le_evt_mask(le_features))
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
-    def add_device_to_white_list(self, peer_addr_type, peer_addr):
+        if not self.sock.state.is_white_list_empty():
+            cmd = btcmd.HCILEClearWhiteList()
+            yield self.send_hci_cmd_wait_cmd_complt_check_status(
+                cmd, deadline)
+
+    def add_device_to_white_list(self, peer_addr_type, peer_addr,
+                                 timeout=None):
         cmd = btcmd.HCILEAddDeviceToWhiteList(peer_addr_type, peer_addr)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
 
-    def remove_device_from_white_list(self, peer_addr_type, peer_addr):
+    def remove_device_from_white_list(self, peer_addr_type, peer_addr,
+                                      timeout=None):
         cmd = btcmd.HCILERemoveDeviceFromWhiteList(peer_addr_type, peer_addr)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
 
     def create_connection_by_peer_addr(self, peer_addr_type, peer_addr,
                                        conn_intvl, conn_latency, supv_to,
-                                       ce_len):
+                                       ce_len, timeout=None):
         cmd = btcmd.HCILECreateConnection(
             self.init_scan_intvl, self.init_scan_win, 0, peer_addr_type,
             peer_addr, 0, conn_intvl, conn_intvl, conn_latency, supv_to,
             ce_len, ce_len)
-        self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
     def create_connection_by_white_list(self, conn_intvl, conn_latency,
-                                        supv_to, ce_len):
+                                        supv_to, ce_len, timeout=None):
         cmd = btcmd.HCILECreateConnection(
             self.init_scan_intvl, self.init_scan_win, 1, 0, '\x00'*6, 0,
             conn_intvl, conn_intvl, conn_latency, supv_to, ce_len, ce_len)
-        self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
-    def create_connect_cancel(self):
+    def create_connect_cancel(self, timeout=None):
         cmd = btcmd.HCILECreateConnectionCancel()
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
 
     def connection_update(self, conn_handle, conn_intvl, conn_latency,
-                          supv_timeout, ce_len):
+                          supv_timeout, ce_len, timeout=None):
         cmd = btcmd.HCILEConnectionUpdate(
             conn_handle, conn_intvl, conn_intvl, conn_latency, supv_timeout,
             ce_len, ce_len)
-        self.send_hci_cmd_wait_cmd_status_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_status_check_status(cmd, timeout)
 
-    def set_host_classification(self, channel_map):
+    def set_host_classification(self, channel_map, timeout=None):
         cmd = btcmd.HCILESetHostChannelClassification(channel_map)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
 
-    def set_advertising_data(self, data):
+    def set_advertising_data(self, data, timeout=None):
         cmd = btcmd.HCILESetAdvertisingData(data)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def start_advertising(self, intvl, timeout=None):
+        return self._run(
+            self._start_advertising(intvl, Deadline.from_timeout(timeout)))
 
-    def start_advertising(self, intvl):
+    def _start_advertising(self, intvl, deadline):
         cmd = btcmd.HCILESetAdvertisingParameters(
             intvl, intvl, 0, 0, 0, '\x00'*6, 0x7, 0)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
         cmd = btcmd.HCILESetAdvertiseEnable(1)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd, deadline)
 
-    def stop_advertising(self):
+    def stop_advertising(self, timeout=None):
         cmd = btcmd.HCILESetAdvertiseEnable(0)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
 
     def wait_le_event(self, subevt_code, timeout=None):
         return self.wait_hci_evt(
@@ -619,13 +1312,6 @@ class LEHelper(BTHelper):
                 and evt.subevt_code == bluez.EVT_LE_CONN_UPDATE_COMPLETE),
             timeout)
 
-    def wait_disconnection_complete(self, conn_handle=None, timeout=None):
-        return self.wait_hci_evt(
-            lambda evt: (
-                evt.code == bluez.EVT_DISCONN_COMPLETE
-                and (conn_handle is None or conn_handle == evt.conn_handle)),
-            timeout)
-
     def wait_encryption_change(self, conn_handle=None, timeout=None):
         return self.wait_hci_evt(
             lambda evt: (
@@ -633,8 +1319,438 @@ class LEHelper(BTHelper):
                 and (conn_handle is None or conn_handle == evt.conn_handle)),
             timeout)
 
-    def set_data_len(self, conn_handle, tx_octets):
+    def set_data_len(self, conn_handle, tx_octets, timeout=None):
         # 14 = 1(Preamble) + 4(Access Code) + 2(PDU Header) + 4(MIC) + 3(CRC)
         tx_time = (tx_octets + 14) * 8
         cmd = btcmd.HCILESetDataLength(conn_handle, tx_octets, tx_time)
-        self.send_hci_cmd_wait_cmd_complt_check_status(cmd)
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+
+class BTHelper(_BTProcedures, HCITask):
+    def __init__(self, hci_sock):
+        super(BTHelper, self).__init__(hci_sock)
+
+    def _run(self, steps):
+        # Each step is done by the time it is yielded.
+        result = None
+        while True:
+            try:
+                result = steps.send(result)
+            except StopIteration:
+                return
+
+    def send_hci_cmd_wait_cmd_complt_check_status(self, cmd, timeout=None):
+        evt = self.send_hci_cmd_wait_cmd_complt(cmd, timeout)
+        self.check_hci_evt_status(evt)
+        return evt
+
+    def send_hci_cmd_wait_cmd_status_check_status(self, cmd, timeout=None):
+        evt = self.send_hci_cmd_wait_cmd_status(cmd, timeout)
+        self.check_hci_evt_status(evt)
+        return evt
+
+    def send_hci_cmds_check_status(self, cmds, window=4, timeout=None):
+        """Send commands pipelined and check their status.
+
+        The status is checked once all commands are done, so that no event
+        of the batch is left behind when a command fails.
+        """
+        evts = self.send_hci_cmds(cmds, window, timeout)
+        for evt in evts:
+            self.check_hci_evt_status(evt)
+        return evts
+
+    def read_capabilities(self, timeout=None):
+        """Return the ControllerCapabilities of the controller.
+
+        The capabilities are cached, so usually no command is sent.
+        """
+        return get_capabilities(self, None, timeout)
+
+
+class BREDRHelper(_BREDRProcedures, BTHelper):
+    def __init__(self, hci_sock):
+        super(BREDRHelper, self).__init__(hci_sock)
+
+
+class LEHelper(_LEProcedures, BTHelper):
+    def __init__(self, hci_sock):
+        super(LEHelper, self).__init__(hci_sock)
+
+    def _read_le_features(self, deadline):
+        return self.read_capabilities(deadline).le_features or 0
+
+    def read_buffer_size(self):
+        """Return the LE buffer size.
+
+        The returned object has the hc_le_acl_data_pkt_len and
+        hc_total_num_le_acl_data_pkts attributes.
+        """
+        return self.read_capabilities()
+
+    def read_max_adv_data_len(self):
+        return self.read_capabilities().max_adv_data_len
+
+    def read_num_supported_adv_sets(self):
+        return self.read_capabilities().num_supported_adv_sets
+
+    def set_scan_parameters(self, scan_type, scan_intvl, scan_window,
+                            own_addr_type=0, scan_filter_policy=0,
+                            timeout=None):
+        cmd = btcmd.HCILESetScanParameters(
+            scan_type, scan_intvl, scan_window, own_addr_type,
+            scan_filter_policy)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def start_scan(self, filter_duplicate=0, timeout=None):
+        cmd = btcmd.HCILESetScanEnable(1, filter_duplicate)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def stop_scan(self, timeout=None):
+        cmd = btcmd.HCILESetScanEnable(0, 0)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def _disable_scan(self, cmd, process, timeout=None):
+        """Send a scan disable command and wait for its command complete.
+
+        Args:
+            cmd: HCILESetScanEnable or HCILESetExtendedScanEnable.
+            process: Function called with each event received before the
+                command complete, returning True if it is a report consumed.
+            timeout: Timeout in seconds or a Deadline.
+        """
+        # Keep the reports received until scanning is disabled, rather than
+        # ignoring them while waiting for command complete.
+        deadline = Deadline.from_timeout(timeout)
+        opcode = cmd.opcode()
+        self.send_hci_cmd(cmd)
+        with self.sock.waiting_for(cmd):
+            while True:
+                evt = self.recv_hci_evt(deadline)
+                if process(evt):
+                    continue
+                if (evt.code == bluez.EVT_CMD_COMPLETE
+                        and evt.cmd_opcode == opcode):
+                    self.check_hci_evt_status(evt)
+                    return evt
+                self.log.info('ignore event: {}'.format(str(evt)))
+
+    def scan(self, duration, aggregator=None, filter_duplicate=0,
+             stop_timeout=5):
+        """Scan for duration seconds with the current scan parameters.
+
+        Advertising reports are added to aggregator, including those
+        received while scanning is being disabled; other events are ignored.
+
+        Args:
+            duration: Time in seconds to scan.
+            aggregator: ScanResultAggregator to add reports to.
+            filter_duplicate: Filter duplicates in the controller.
+            stop_timeout: Maximum time in seconds to disable scanning after
+                duration.
+
+        Returns:
+            ScanResultAggregator: The aggregator.
+
+        Raises:
+            HCITimeoutError: Scanning was not enabled within duration or not
+                disabled within stop_timeout.
+        """
+        if aggregator is None:
+            aggregator = ScanResultAggregator()
+
+        def process(evt):
+            if evt.__class__ is btevt.LEAdvertisingReportEvent:
+                aggregator.add_evt(evt)
+                return True
+            return False
+
+        deadline = Deadline(duration)
+        self.start_scan(filter_duplicate, deadline)
+        try:
+            while True:
+                evt = self.recv_hci_evt(deadline)
+                if not process(evt):
+                    self.log.info('ignore event: {}'.format(str(evt)))
+        except HCITimeoutError:
+            pass
+        self._disable_scan(btcmd.HCILESetScanEnable(0, 0), process,
+                           stop_timeout)
+        return aggregator
+
+    def set_ext_scan_parameters(self, own_addr_type, scan_filter_policy,
+                                scan_phys, *args, **kwargs):
+        timeout = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: {}'.format(
+                ', '.join(sorted(kwargs))))
+        cmd = btcmd.HCILESetExtendedScanParameters(
+            own_addr_type, scan_filter_policy, scan_phys, *args)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def start_ext_scan(self, filter_duplicate=0, duration=0, period=0,
+                       timeout=None):
+        cmd = btcmd.HCILESetExtendedScanEnable(
+            1, filter_duplicate, duration, period)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def stop_ext_scan(self, timeout=None):
+        cmd = btcmd.HCILESetExtendedScanEnable(0, 0, 0, 0)
+        self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+    def iter_ext_adv(self, duration=None, reassembler=None,
+                     filter_duplicate=0, stop_timeout=5):
+        """Scan with the current extended scan parameters and yield
+        ExtAdvertisements as they are reassembled.
+
+        Scanning stops after duration seconds or when the generator is
+        closed. The advertisements completed while scanning is disabled
+        after duration are yielded as well. Other events are ignored.
+
+        Args:
+            duration: Time in seconds to scan, or None to scan until the
+                generator is closed.
+            reassembler: ExtAdvReassembler to add reports to.
+            filter_duplicate: Filter duplicates in the controller.
+            stop_timeout: Maximum time in seconds to disable scanning.
+
+        Raises:
+            HCITimeoutError: Scanning was not enabled within duration or not
+                disabled within stop_timeout.
+        """
+        if reassembler is None:
+            reassembler = ExtAdvReassembler()
+        advs = []
+
+        def process(evt):
+            if evt.__class__ is btevt.LEExtendedAdvertisingReportEvent:
+                advs.extend(reassembler.add_evt(evt))
+                return True
+            return False
+
+        deadline = Deadline(duration)
+        self.start_ext_scan(filter_duplicate, timeout=deadline)
+        stopped = False
+        try:
+            while True:
+                try:
+                    evt = self.recv_hci_evt(deadline)
+                except HCITimeoutError:
+                    break
+                if process(evt):
+                    for adv in advs:
+                        yield adv
+                    del advs[:]
+                else:
+                    self.log.info('ignore event: {}'.format(str(evt)))
+            stopped = True
+            self._disable_scan(btcmd.HCILESetExtendedScanEnable(0, 0, 0, 0),
+                               process, stop_timeout)
+            for adv in advs:
+                yield adv
+        finally:
+            if not stopped:
+                # Closed early: nothing can be yielded any more
+                self._disable_scan(
+                    btcmd.HCILESetExtendedScanEnable(0, 0, 0, 0), process,
+                    stop_timeout)
+
+
+class LEConnectionManager(LEHelper):
+    """Establish LE connections to a set of peers concurrently.
+
+    The peers are loaded into the white list and the controller initiates to
+    all of them at once. After each connection complete the initiator is
+    restarted by the white list until every peer is connected, so each link
+    takes about one connection setup instead of a whole blocking procedure.
+    Links failing to be established (0x3E) are retried up to max_retries
+    times per peer. A failed connection complete does not tell which peer
+    failed, so the initiation is retried for all pending peers, up to
+    max_retries failed initiations in a row.
+
+    Attributes:
+        links: Dict of LinkState of connected peers keyed by
+            (peer_addr_type, peer_addr).
+    """
+
+    def __init__(self, hci_sock, conn_intvl, conn_latency, supv_timeout,
+                 ce_len, max_retries=3):
+        super(LEConnectionManager, self).__init__(hci_sock)
+        self.conn_intvl = conn_intvl
+        self.conn_latency = conn_latency
+        self.supv_timeout = supv_timeout
+        self.ce_len = ce_len
+        self.max_retries = max_retries
+        self.links = {}
+        self.pending = set()
+        self.retries = {}
+        self.init_retries = 0
+        self.initiating = False
+
+    def _is_conn_evt(self, evt):
+        return (
+            evt.code == bluez.EVT_DISCONN_COMPLETE
+            or (evt.code == bluez.EVT_LE_META_EVENT and (
+                evt.subevt_code == bluez.EVT_LE_CONN_COMPLETE or
+                evt.subevt_code == bluez.EVT_LE_ENHANCED_CONN_COMPLETE)))
+
+    def _send_hci_cmd_wait(self, cmd, evt_handler, timeout):
+        # Connection events received while waiting for the command status or
+        # command complete are passed to evt_handler instead of being
+        # dropped.
+        opcode = cmd.opcode()
+        self.send_hci_cmd(cmd)
+        with self.sock.waiting_for(cmd):
+            while True:
+                evt = self.wait_hci_evt(
+                    lambda evt: (
+                        self._is_conn_evt(evt)
+                        or (evt.code in (bluez.EVT_CMD_STATUS,
+                                         bluez.EVT_CMD_COMPLETE)
+                            and evt.cmd_opcode == opcode)),
+                    timeout)
+                if self._is_conn_evt(evt):
+                    evt_handler(evt)
+                    continue
+                return evt
+
+    def _retry(self, peer, status):
+        n = self.retries.get(peer, 0) + 1
+        if n > self.max_retries:
+            raise TestError(
+                'connect {} failed: status 0x{:02x}'.format(
+                    bluez.ba2str(peer[1]), status))
+        self.retries[peer] = n
+        self.pending.add(peer)
+        self.log.info('retry %s: status 0x%02x', bluez.ba2str(peer[1]),
+                      status)
+
+    def _remove_link(self, conn_handle):
+        for peer, link in self.links.items():
+            if link.conn_handle == conn_handle:
+                del self.links[peer]
+                return peer
+        return None
+
+    def process_evt(self, evt, retry=True):
+        """Update links from a connection or disconnection complete event.
+
+        If retry is False, failures are not retried.
+        """
+        if evt.code == bluez.EVT_DISCONN_COMPLETE:
+            peer = self._remove_link(evt.conn_handle)
+            if peer is None:
+                return
+            if evt.reason == 0x3E and retry:
+                self._retry(peer, evt.reason)
+            else:
+                self.log.info('%s disconnected: reason 0x%02x',
+                              bluez.ba2str(peer[1]), evt.reason)
+            return
+
+        self.initiating = False
+        if evt.status != 0:
+            if not retry or not self.pending:
+                return
+            # The peer is unknown: the initiation is restarted for all
+            # pending peers.
+            self.init_retries += 1
+            if self.init_retries > self.max_retries:
+                raise TestError(
+                    'connect {} failed: status 0x{:02x}'.format(
+                        ', '.join(bluez.ba2str(peer[1])
+                                  for peer in sorted(self.pending)),
+                        evt.status))
+            self.log.info('retry initiation: status 0x%02x', evt.status)
+            return
+        self.init_retries = 0
+        peer = (evt.peer_addr_type, evt.peer_addr)
+        self.pending.discard(peer)
+        self.links[peer] = self.sock.state.get_link(evt.conn_handle)
+        self.log.info('connect to %s', bluez.ba2str(evt.peer_addr))
+
+    def connect(self, peers, timeout=None, settle=0):
+        """Connect to peers.
+
+        Args:
+            peers: Iterable of (peer_addr_type, peer_addr).
+            timeout: Maximum time in seconds to connect all peers, or a
+                Deadline.
+            settle: Time in seconds to keep watching for links failing to
+                be established after the last peer is connected.
+
+        Returns:
+            dict: LinkState of connected peers keyed by
+            (peer_addr_type, peer_addr).
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+            TestError: Raised if a peer fails more than max_retries times.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        self.init_retries = 0
+        for peer in peers:
+            if not self.sock.state.in_white_list(*peer):
+                self.add_device_to_white_list(*peer)
+            if peer not in self.links:
+                self.pending.add(peer)
+
+        while True:
+            if self.pending and not self.initiating:
+                cmd = btcmd.HCILECreateConnection(
+                    self.init_scan_intvl, self.init_scan_win, 1, 0,
+                    '\x00'*6, 0, self.conn_intvl, self.conn_intvl,
+                    self.conn_latency, self.supv_timeout, self.ce_len,
+                    self.ce_len)
+                evt = self._send_hci_cmd_wait(cmd, self.process_evt,
+                                              deadline)
+                self.check_hci_evt_status(evt)
+                self.initiating = True
+            if self.pending:
+                evt = self.wait_hci_evt(self._is_conn_evt, deadline)
+            else:
+                remaining = deadline.remaining()
+                if remaining is not None:
+                    settle = min(settle, remaining)
+                try:
+                    evt = self.wait_hci_evt(self._is_conn_evt, settle)
+                except HCITimeoutError:
+                    return self.links
+            self.process_evt(evt)
+
+    def disconnect_all(self, reason=0x13, timeout=None):
+        """Disconnect all links.
+
+        A connection completed while cancelling the initiation is
+        disconnected as well.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        process_evt = lambda evt: self.process_evt(evt, False)
+        self.pending.clear()
+        if self.initiating:
+            evt = self._send_hci_cmd_wait(
+                btcmd.HCILECreateConnectionCancel(), process_evt, deadline)
+            if self.initiating:
+                # Otherwise the initiation completed before the command.
+                self.check_hci_evt_status(evt)
+            while self.initiating:
+                process_evt(self.wait_hci_evt(self._is_conn_evt, deadline))
+        disconnecting = set()
+        while self.links:
+            # Links are removed by disconnection completes received while
+            # disconnecting others.
+            for link in self.links.values():
+                if link.conn_handle not in disconnecting:
+                    break
+            else:
+                process_evt(self.wait_hci_evt(self._is_conn_evt, deadline))
+                continue
+            disconnecting.add(link.conn_handle)
+            evt = self._send_hci_cmd_wait(
+                btcmd.HCIDisconnect(link.conn_handle, reason), process_evt,
+                deadline)
+            if evt.status == 0x02:
+                # Unknown connection: disconnected before the command
+                self._remove_link(link.conn_handle)
+            else:
+                self.check_hci_evt_status(evt)
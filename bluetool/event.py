@@ -168,8 +168,11 @@ _cmd_complt_evt_param_parser = _gen_cmd_complt_evt_param_parser_table(
     btcmd.HCIWritePageScanActivity,
     btcmd.HCIReadInquiryMode,
     btcmd.HCIWriteInquiryMode,
+    btcmd.HCIReadLocalVersionInformation,
+    btcmd.HCIReadLocalSupportedCommands,
     btcmd.HCIReadLocalSupportedFeatures,
     btcmd.HCIReadLocalExtendedFeatures,
+    btcmd.HCIReadBufferSize,
     btcmd.HCIReadBDAddr,
     btcmd.HCILESetEventMask,
     btcmd.HCILEReadBufferSize,
@@ -192,6 +195,7 @@ _cmd_complt_evt_param_parser = _gen_cmd_complt_evt_param_parser_table(
     btcmd.HCILESetDataLength,
     btcmd.HCILEReadSuggestedDefaultDataLength,
     btcmd.HCILEWriteSuggestedDefaultDataLength,
+    btcmd.HCILESetAdvertisingSetRandomAddress,
     btcmd.HCILESetExtendedAdvertisingParameters,
     btcmd.HCILESetExtendedAdvertisingData,
     btcmd.HCILESetExtendedScanResponseData,
@@ -202,6 +206,12 @@ _cmd_complt_evt_param_parser = _gen_cmd_complt_evt_param_parser_table(
     btcmd.HCILEClearAdvertisingSets,
     btcmd.HCILESetExtendedScanParameters,
     btcmd.HCILESetExtendedScanEnable,
+    btcmd.HCILEPeriodicAdvertisingCreateSyncCancel,
+    btcmd.HCILEPeriodicAdvertisingTerminateSync,
+    btcmd.HCILEAddDeviceToPeriodicAdvertiserList,
+    btcmd.HCILERemoveDeviceFromPeriodicAdvertiserList,
+    btcmd.HCILEClearPeriodicAdvertiserList,
+    btcmd.HCILEReadPeriodicAdvertiserListSize,
 )
 
 
@@ -220,6 +230,9 @@ class CommandCompleteEvent(HCIEvent):
         offset += 1
         self.cmd_opcode = letoh16(buf, offset)
         offset += 2
+        if self.cmd_opcode == 0:
+            # No command: the controller only allows commands to be sent.
+            return
         try:
             _cmd_complt_evt_param_parser[self.cmd_opcode].unpack_ret_param(
                 self, buf, offset)
@@ -263,6 +276,18 @@ class NumberOfCompletedPacketsEvent(HCIEvent):
             self.num_completed_pkts[i] = letoh16(buf, offset)
             offset += 2
 
+    def split(self):
+        """Return a NumberOfCompletedPacketsEvent for each handle."""
+        evts = []
+        for conn_handle, num_pkts in zip(self.conn_handle,
+                                         self.num_completed_pkts):
+            evt = NumberOfCompletedPacketsEvent()
+            evt.num_handles = 1
+            evt.conn_handle = [conn_handle]
+            evt.num_completed_pkts = [num_pkts]
+            evts.append(evt)
+        return evts
+
 
 class ModeChangeEvent(HCIEvent):
     code = bluez.EVT_MODE_CHANGE
@@ -368,6 +393,35 @@ class LEConnectionCompleteEvent(LEMetaEvent):
         self.master_clk_accuracy = letoh8(buf, offset)
 
 
+class LEAdvertisingReportEvent(LEMetaEvent):
+    subevt_code = bluez.EVT_LE_ADVERTISING_REPORT
+
+    def unpack_param(self, buf, offset):
+        num_reports = letoh8(buf, offset)
+        offset += 1
+        self.num_reports = num_reports
+        self.evt_type = [0]*num_reports
+        self.addr_type = [0]*num_reports
+        self.addr = [None]*num_reports
+        self.data = [None]*num_reports
+        self.rssi = [0]*num_reports
+        i = 0
+        while i < num_reports:
+            self.evt_type[i] = letoh8(buf, offset)
+            offset += 1
+            self.addr_type[i] = letoh8(buf, offset)
+            offset += 1
+            self.addr[i] = buf[offset:offset+6]
+            offset += 6
+            data_len = letoh8(buf, offset)
+            offset += 1
+            self.data[i] = buf[offset:offset+data_len]
+            offset += data_len
+            self.rssi[i] = letohs8(buf, offset)
+            offset += 1
+            i += 1
+
+
 class LEConnectionUpdateCompleteEvent(LEMetaEvent):
     subevt_code = bluez.EVT_LE_CONN_UPDATE_COMPLETE
 
@@ -436,6 +490,129 @@ class LEEnhancedConnectionCompleteEvent(LEMetaEvent):
         self.master_clk_accuracy = letoh8(buf, offset)
 
 
+class LEExtendedAdvertisingReportEvent(LEMetaEvent):
+    subevt_code = bluez.EVT_LE_EXT_ADVERTISING_REPORT
+
+    def unpack_param(self, buf, offset):
+        num_reports = letoh8(buf, offset)
+        offset += 1
+        self.num_reports = num_reports
+        self.evt_type = [0]*num_reports
+        self.addr_type = [0]*num_reports
+        self.addr = [None]*num_reports
+        self.primary_phy = [0]*num_reports
+        self.secondary_phy = [0]*num_reports
+        self.adv_sid = [0]*num_reports
+        self.tx_power = [0]*num_reports
+        self.rssi = [0]*num_reports
+        self.periodic_adv_intvl = [0]*num_reports
+        self.direct_addr_type = [0]*num_reports
+        self.direct_addr = [None]*num_reports
+        self.data = [None]*num_reports
+        i = 0
+        while i < num_reports:
+            self.evt_type[i] = letoh16(buf, offset)
+            offset += 2
+            self.addr_type[i] = letoh8(buf, offset)
+            offset += 1
+            self.addr[i] = buf[offset:offset+6]
+            offset += 6
+            self.primary_phy[i] = letoh8(buf, offset)
+            offset += 1
+            self.secondary_phy[i] = letoh8(buf, offset)
+            offset += 1
+            self.adv_sid[i] = letoh8(buf, offset)
+            offset += 1
+            self.tx_power[i] = letohs8(buf, offset)
+            offset += 1
+            self.rssi[i] = letohs8(buf, offset)
+            offset += 1
+            self.periodic_adv_intvl[i] = letoh16(buf, offset)
+            offset += 2
+            self.direct_addr_type[i] = letoh8(buf, offset)
+            offset += 1
+            self.direct_addr[i] = buf[offset:offset+6]
+            offset += 6
+            data_len = letoh8(buf, offset)
+            offset += 1
+            self.data[i] = buf[offset:offset+data_len]
+            offset += data_len
+            i += 1
+
+
+class LEPeriodicAdvertisingSyncEstablishedEvent(LEMetaEvent):
+    subevt_code = bluez.EVT_LE_PERIODIC_ADVERTISING_SYNC_ESTABLISHED
+
+    def unpack_param(self, buf, offset):
+        self.status = letoh8(buf, offset)
+        offset += 1
+        self.sync_handle = letoh16(buf, offset)
+        offset += 2
+        self.adv_sid = letoh8(buf, offset)
+        offset += 1
+        self.adv_addr_type = letoh8(buf, offset)
+        offset += 1
+        self.adv_addr = buf[offset:offset+6]
+        offset += 6
+        self.adv_phy = letoh8(buf, offset)
+        offset += 1
+        self.periodic_adv_intvl = letoh16(buf, offset)
+        offset += 2
+        self.adv_clk_accuracy = letoh8(buf, offset)
+
+
+class LEPeriodicAdvertisingReportEvent(LEMetaEvent):
+    """Periodic advertising report.
+
+    data is a read-only memoryview into the received packet rather than a
+    copy; call tobytes() to keep it.
+    """
+
+    subevt_code = bluez.EVT_LE_PERIODIC_ADVERTISING_REPORT
+
+    def unpack_param(self, buf, offset):
+        self.sync_handle = letoh16(buf, offset)
+        offset += 2
+        self.tx_power = letohs8(buf, offset)
+        offset += 1
+        self.rssi = letohs8(buf, offset)
+        offset += 1
+        self.cte_type = letoh8(buf, offset)
+        offset += 1
+        self.data_status = letoh8(buf, offset)
+        offset += 1
+        data_len = letoh8(buf, offset)
+        offset += 1
+        self.data = memoryview(buf)[offset:offset+data_len]
+
+
+class LEPeriodicAdvertisingSyncLostEvent(LEMetaEvent):
+    subevt_code = bluez.EVT_LE_PERIODIC_ADVERTISING_SYNC_LOST
+
+    def unpack_param(self, buf, offset):
+        self.sync_handle = letoh16(buf, offset)
+
+
+class LEScanTimeoutEvent(LEMetaEvent):
+    subevt_code = bluez.EVT_LE_SCAN_TIMEOUT
+
+    def unpack_param(self, buf, offset):
+        pass
+
+
+class LEAdvertisingSetTerminatedEvent(LEMetaEvent):
+    subevt_code = bluez.EVT_LE_ADVERTISING_SET_TERM
+
+    def unpack_param(self, buf, offset):
+        self.status = letoh8(buf, offset)
+        offset += 1
+        self.adv_handle = letoh8(buf, offset)
+        offset += 1
+        self.conn_handle = letoh16(buf, offset)
+        offset += 2
+        self.num_completed_ext_adv_evts = letoh8(buf, offset)
+
+
 class LEChannelSelectionAlgorithmEvent(LEMetaEvent):
     subevt_code = bluez.EVT_LE_CH_SEL_ALGO
 
@@ -489,10 +666,17 @@ def _gen_le_evt_table(*args):
 
 _le_evt_table = _gen_le_evt_table(
     LEConnectionCompleteEvent,
+    LEAdvertisingReportEvent,
     LEConnectionUpdateCompleteEvent,
     LELongTermKeyRequestEvent,
     LEDataLengthChangeEvent,
     LEEnhancedConnectionCompleteEvent,
+    LEExtendedAdvertisingReportEvent,
+    LEPeriodicAdvertisingSyncEstablishedEvent,
+    LEPeriodicAdvertisingReportEvent,
+    LEPeriodicAdvertisingSyncLostEvent,
+    LEScanTimeoutEvent,
+    LEAdvertisingSetTerminatedEvent,
     LEChannelSelectionAlgorithmEvent
 )
 
@@ -0,0 +1,347 @@
+"""Fault injection between an HCISock and its controller.
+
+FaultTransport wraps the transport of an HCISock, or the HCI user channel of
+a device, and delays, drops, duplicates, reorders or corrupts the packets
+passing in either direction, and splits the packets received into several
+reads:
+
+    hci_sock = HCISock(FaultTransport(
+        medium.add_controller(),
+        received=FaultPlan(drop=0.01, split=0.5), seed=3))
+
+Faults are drawn per packet from a random generator per direction seeded by
+seed, and can be forced on given packets with the schedule of a FaultPlan,
+so that a run is reproduced as long as the same packets pass. Corruption
+flips a bit after the header of a packet, so that the framing of the stream
+is kept. Delays are latencies: the packets of a direction keep their order
+unless reordered.
+
+Packets received are passed to the host through a socket pair by a thread,
+which keeps running in the coordinator if the transport is opened before
+bluetest forks workers, as the statistics are.
+"""
+import collections
+import errno
+import logging
+import os
+import random
+import select
+import socket
+import threading
+
+from . import bluez
+from .capture import DIR_RECEIVED, DIR_SENT
+from .clock import monotonic
+from .error import HCIError
+
+FAULT_DELAY = 'delay'
+FAULT_DROP = 'drop'
+FAULT_DUPLICATE = 'duplicate'
+FAULT_REORDER = 'reorder'
+FAULT_CORRUPT = 'corrupt'
+FAULT_SPLIT = 'split'
+
+# Faults in the order they are drawn for a packet
+FAULTS = (FAULT_DROP, FAULT_CORRUPT, FAULT_DUPLICATE, FAULT_DELAY,
+          FAULT_REORDER, FAULT_SPLIT)
+
+# Size of the header of each packet type, including the packet type octet
+_hdr_size = {
+    bluez.HCI_COMMAND_PKT: 4,
+    bluez.HCI_ACLDATA_PKT: 5,
+    bluez.HCI_SCODATA_PKT: 4,
+    bluez.HCI_EVENT_PKT: 3,
+}
+
+# Size of the largest H4 packet read from the wrapped transport
+_MAX_PKT_SIZE = 65536
+
+
+class FaultPlan(object):
+    """Faults injected in one direction.
+
+    Args:
+        drop, duplicate, reorder, corrupt, split, delay: Probability of each
+            fault per packet.
+        delay_max: Maximum time in seconds a delayed packet is held; the
+            delay is drawn uniformly.
+        reorder_timeout: Time in seconds a reordered packet waits for the
+            next packet to pass it.
+        max_splits: Maximum number of reads a split packet is received in.
+        schedule: Dict of faults forced on packets, keyed by the number of
+            the packet in the direction, from 0; a value is a fault or a
+            tuple of faults. Scheduled packets draw no other fault.
+        ptypes: Packet types subject to faults, or None for all.
+    """
+
+    def __init__(self, drop=0.0, duplicate=0.0, reorder=0.0, corrupt=0.0,
+                 split=0.0, delay=0.0, delay_max=0.1, reorder_timeout=0.1,
+                 max_splits=4, schedule=None, ptypes=None):
+        super(FaultPlan, self).__init__()
+        self.rates = {
+            FAULT_DROP: drop,
+            FAULT_DUPLICATE: duplicate,
+            FAULT_REORDER: reorder,
+            FAULT_CORRUPT: corrupt,
+            FAULT_SPLIT: split,
+            FAULT_DELAY: delay,
+        }
+        self.delay_max = delay_max
+        self.reorder_timeout = reorder_timeout
+        self.max_splits = max_splits
+        self.schedule = {}
+        for num, faults in (schedule or {}).iteritems():
+            if isinstance(faults, basestring):
+                faults = (faults,)
+            for fault in faults:
+                if fault not in self.rates:
+                    raise ValueError('unknown fault: {}'.format(fault))
+            self.schedule[num] = frozenset(faults)
+        self.ptypes = None if ptypes is None else frozenset(ptypes)
+
+    def uses(self, fault):
+        return (self.rates[fault] > 0
+                or any(fault in faults
+                       for faults in self.schedule.itervalues()))
+
+    def draw(self, num, ptype, rng):
+        """Return the set of faults of packet num."""
+        faults = self.schedule.get(num)
+        if faults is not None:
+            return faults
+        if self.ptypes is not None and ptype not in self.ptypes:
+            return frozenset()
+        rates = self.rates
+        return frozenset(fault for fault in FAULTS
+                         if rates[fault] and rng.random() < rates[fault])
+
+
+class FaultStats(object):
+    """Faults injected in one direction.
+
+    Attributes:
+        num_pkts: Number of packets passed to the transport.
+        num_out: Number of packets passed on, duplicates included.
+        counts: Number of packets of each fault.
+    """
+
+    def __init__(self):
+        super(FaultStats, self).__init__()
+        self.num_pkts = 0
+        self.num_out = 0
+        self.counts = collections.Counter()
+
+    def __str__(self):
+        return '{} packets, {} out, {}'.format(
+            self.num_pkts, self.num_out,
+            ', '.join('{} {}'.format(self.counts[fault], fault)
+                      for fault in FAULTS))
+
+
+class FaultTransport(object):
+    """Transport injecting faults into another one.
+
+    Args:
+        transport: Wrapped transport (see HCISock), or an HCI device id
+            whose user channel is opened.
+        sent: FaultPlan of the packets sent by the host, or None.
+        received: FaultPlan of the packets received by the host, or None.
+        seed: Seed of the faults drawn.
+
+    Attributes:
+        stats: FaultStats keyed by DIR_SENT and DIR_RECEIVED.
+        error: Exception raised by the wrapped transport, or None.
+    """
+
+    def __init__(self, transport, sent=None, received=None, seed=0):
+        super(FaultTransport, self).__init__()
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+        if isinstance(transport, (int, long)):
+            transport = bluez.hci_new_user_channel(transport)
+        self.transport = transport
+        self.plans = {
+            DIR_SENT: FaultPlan() if sent is None else sent,
+            DIR_RECEIVED: FaultPlan() if received is None else received,
+        }
+        if self.plans[DIR_SENT].uses(FAULT_SPLIT):
+            raise ValueError('packets sent cannot be split')
+        self.stats = {DIR_SENT: FaultStats(), DIR_RECEIVED: FaultStats()}
+        self.error = None
+        self._rngs = {DIR_SENT: random.Random(seed * 2),
+                      DIR_RECEIVED: random.Random(seed * 2 + 1)}
+        # Packets (release time, chunks) waiting to be passed on, and the
+        # packet held by a reorder with its timeout
+        self._pending = {DIR_SENT: collections.deque(),
+                         DIR_RECEIVED: collections.deque()}
+        self._held = {DIR_SENT: None, DIR_RECEIVED: None}
+        self._lock = threading.Lock()
+        self._out_locks = {DIR_SENT: threading.Lock(),
+                           DIR_RECEIVED: threading.Lock()}
+        self._closed = False
+        self._host, self._ctl = socket.socketpair(socket.AF_UNIX,
+                                                  socket.SOCK_SEQPACKET)
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target=self._run,
+                                        name='FaultTransport')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        return 'fault:{}'.format(self.transport)
+
+    def report(self):
+        """Return the statistics of both directions as a string."""
+        return 'sent: {}; received: {}'.format(self.stats[DIR_SENT],
+                                               self.stats[DIR_RECEIVED])
+
+    # Transport of HCISock
+
+    def fileno(self):
+        return self._host.fileno()
+
+    def send(self, pkt):
+        self._inject(DIR_SENT, pkt)
+        if self._flush(DIR_SENT) is not None:
+            # Packets held back are passed on by the thread.
+            os.write(self._wake_w, '\x00')
+        return len(pkt)
+
+    def recv(self, bufsize):
+        buf = self._host.recv(bufsize)
+        if not buf:
+            if self.error is not None:
+                raise self.error
+            raise HCIError('{}: transport closed'.format(self))
+        return buf
+
+    def close(self):
+        """Close the transport and the wrapped one."""
+        if self._closed:
+            return
+        self._closed = True
+        os.write(self._wake_w, '\x00')
+        self._thread.join()
+        self._host.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self.transport.close()
+        self.log.info('%s: %s', self, self.report())
+
+    # Faults
+
+    def _corrupt(self, pkt, rng):
+        hdr_size = _hdr_size.get(ord(pkt[0]), 1)
+        if len(pkt) <= hdr_size:
+            return pkt
+        i = rng.randrange(hdr_size, len(pkt))
+        return ''.join((pkt[:i], chr(ord(pkt[i]) ^ (1 << rng.randrange(8))),
+                        pkt[i + 1:]))
+
+    def _split(self, pkt, rng, max_splits):
+        if len(pkt) < 2:
+            return [pkt]
+        n = rng.randint(2, min(max_splits, len(pkt)))
+        cuts = sorted(rng.sample(xrange(1, len(pkt)), n - 1))
+        return [pkt[i:j] for i, j in zip([0] + cuts, cuts + [len(pkt)])]
+
+    def _inject(self, direction, pkt):
+        plan = self.plans[direction]
+        stats = self.stats[direction]
+        rng = self._rngs[direction]
+        with self._lock:
+            faults = plan.draw(stats.num_pkts, ord(pkt[0]), rng)
+            stats.num_pkts += 1
+            for fault in faults:
+                stats.counts[fault] += 1
+            if FAULT_DROP in faults:
+                return
+            if FAULT_CORRUPT in faults:
+                pkt = self._corrupt(pkt, rng)
+            if FAULT_SPLIT in faults:
+                chunks = self._split(pkt, rng, plan.max_splits)
+            else:
+                chunks = [pkt]
+            now = monotonic()
+            release = now
+            if FAULT_DELAY in faults:
+                release += rng.uniform(0, plan.delay_max)
+            pending = self._pending[direction]
+            if pending:
+                # Delays do not reorder packets.
+                release = max(release, pending[-1][0])
+            entries = [(release, chunks)]
+            if FAULT_DUPLICATE in faults:
+                entries.append((release, chunks))
+            held = self._held[direction]
+            if FAULT_REORDER in faults and held is None:
+                self._held[direction] = (now + plan.reorder_timeout,
+                                         entries)
+                entries = []
+            elif held is not None:
+                # The held packet is passed by this one.
+                self._held[direction] = None
+                entries.extend(held[1])
+            pending.extend(entries)
+
+    def _flush(self, direction):
+        # Pass on the packets due; returns the time of the next one, or
+        # None.
+        pending = self._pending[direction]
+        with self._out_locks[direction]:
+            while True:
+                with self._lock:
+                    now = monotonic()
+                    held = self._held[direction]
+                    if held is not None and held[0] <= now:
+                        self._held[direction] = None
+                        pending.extend(held[1])
+                        held = None
+                    if not pending or pending[0][0] > now:
+                        due = pending[0][0] if pending else None
+                        if held is not None:
+                            due = held[0] if due is None else min(due,
+                                                                  held[0])
+                        return due
+                    chunks = pending.popleft()[1]
+                    self.stats[direction].num_out += 1
+                if direction == DIR_SENT:
+                    self.transport.send(chunks[0])
+                else:
+                    for chunk in chunks:
+                        self._ctl.send(chunk)
+
+    def _run(self):
+        poll = select.poll()
+        poll.register(self._wake_r, select.POLLIN)
+        poll.register(self.transport, select.POLLIN)
+        try:
+            while not self._closed:
+                due = [t for t in (self._flush(DIR_SENT),
+                                   self._flush(DIR_RECEIVED))
+                       if t is not None]
+                timeout = None
+                if due:
+                    timeout = max(0, int((min(due) - monotonic()) * 1000)
+                                  + 1)
+                for fd, event in poll.poll(timeout):
+                    if fd == self._wake_r:
+                        os.read(self._wake_r, 4096)
+                        continue
+                    pkt = self.transport.recv(_MAX_PKT_SIZE)
+                    if not pkt:
+                        return
+                    self._inject(DIR_RECEIVED, pkt)
+        except Exception as err:
+            if not self._closed:
+                self.error = err
+                self.log.warning('%s: %s', self, err)
+        finally:
+            # Shut down rather than close: workers forked by bluetest hold
+            # copies of the socket.
+            try:
+                self._ctl.shutdown(socket.SHUT_RDWR)
+            except socket.error as err:
+                if err.errno != errno.ENOTCONN:
+                    raise
+            self._ctl.close()
@@ -0,0 +1,375 @@
+"""Synthetic advertising load.
+
+A target advertising rate is spread over the advertising sets of several
+controllers. FloodAdvertiser runs the sets of one controller in rounds: each
+set is enabled for a fixed number of advertising events, and the time the
+controller takes to complete them gives the achieved on-air rate, which is
+used to adjust the advertising interval of the next round. FloodScanner
+counts the flood advertisements received by a scanner.
+
+Flood payloads start with manufacturer specific data carrying FLOOD_MAGIC, so
+that the scanner can tell them from other advertisers. Address churn gives a
+fraction of the sets a new random static address every round.
+"""
+import random
+
+from . import bluez
+from . import command as btcmd
+from . import event as btevt
+from .advertiser import AdvSetManager
+from .clock import Deadline, get_clock
+from .core import LEHelper
+from .error import HCITimeoutError
+
+FLOOD_MAGIC = 'BTFL'
+
+# Manufacturer specific data of the flood, with company ID 0xFFFF
+_FLOOD_AD_HDR = '\xff\xff\xff' + FLOOD_MAGIC
+
+# Minimum payload holding the flood marker
+MIN_FLOOD_PAYLOAD = 1 + len(_FLOOD_AD_HDR)
+
+# Minimum advertising interval of non-connectable extended advertising
+# (0.625 ms units), and mean of the random advDelay added to each interval
+MIN_ADV_INTVL = 0x20
+ADV_DELAY_MEAN = 5e-3
+
+OWN_ADDR_TYPE_RANDOM = 1
+
+
+def flood_payload(size):
+    """Return advertising data of size bytes carrying the flood marker.
+
+    Data larger than one AD structure is filled with further manufacturer
+    specific data structures.
+    """
+    size = max(size, MIN_FLOOD_PAYLOAD)
+    first = min(size, 256)
+    ads = [chr(first - 1), _FLOOD_AD_HDR,
+           '\x00' * (first - 1 - len(_FLOOD_AD_HDR))]
+    remaining = size - first
+    while remaining > 0:
+        n = min(remaining, 256)
+        if n < 4:
+            # Too short for another structure; pad with zero octets
+            ads.append('\x00' * n)
+            break
+        ads.extend((chr(n - 1), '\xff\xff\xff', '\x00' * (n - 4)))
+        remaining -= n
+    return ''.join(ads)
+
+
+def is_flood_payload(data):
+    return data[1:1 + len(_FLOOD_AD_HDR)] == _FLOOD_AD_HDR
+
+
+def adv_intvl_for_rate(rate):
+    """Return the advertising interval (0.625 ms units) giving rate
+    advertising events per second, allowing for advDelay."""
+    intvl = int(round((1.0 / rate - ADV_DELAY_MEAN) / 0.625e-3))
+    return max(intvl, MIN_ADV_INTVL)
+
+
+def max_set_rate():
+    """Return the maximum rate of one advertising set."""
+    return 1.0 / (MIN_ADV_INTVL * 0.625e-3 + ADV_DELAY_MEAN)
+
+
+def plan_flood(rate, num_sets):
+    """Spread a target rate over controllers.
+
+    Args:
+        rate: Target advertising events per second in total.
+        num_sets: List of the number of advertising sets of each
+            controller.
+
+    Returns:
+        tuple: (set_rate, expected_rate), the target rate of each set and
+        the total rate expected, which is less than rate if the sets cannot
+        reach it.
+    """
+    total = sum(num_sets)
+    if total == 0:
+        return (0.0, 0.0)
+    set_rate = min(float(rate) / total, max_set_rate())
+    return (set_rate, set_rate * total)
+
+
+def random_static_addr(rng):
+    addr = [rng.randint(0, 255) for _ in xrange(0, 6)]
+    addr[5] |= 0xC0
+    return ''.join(chr(b) for b in addr)
+
+
+def choose_payload_size(rng, payload_sizes):
+    """Choose a size from a sequence of (size, weight)."""
+    total = sum(w for _, w in payload_sizes)
+    r = rng.uniform(0, total)
+    for size, weight in payload_sizes:
+        r -= weight
+        if r <= 0:
+            return size
+    return payload_sizes[-1][0]
+
+
+class FloodRound(object):
+    """Result of a flood round of one controller.
+
+    Attributes:
+        num_sets: Number of advertising sets.
+        num_events: Number of advertising events completed.
+        elapsed: Time in seconds the sets were enabled.
+        target_rate: Target advertising events per second.
+        rate: Achieved on-air events per second.
+        num_new_addrs: Number of sets given a new address.
+        num_unterminated: Number of sets not terminated by the end of the
+            round, which failed if any.
+    """
+
+    def __init__(self, num_sets, target_rate):
+        super(FloodRound, self).__init__()
+        self.num_sets = num_sets
+        self.num_events = 0
+        self.elapsed = 0.0
+        self.target_rate = target_rate
+        self.rate = 0.0
+        self.num_new_addrs = 0
+        self.num_unterminated = 0
+
+    @property
+    def failed(self):
+        return self.num_unterminated > 0
+
+    def __str__(self):
+        s = ('{:.1f}/s of {:.1f}/s ({} events, {} sets, '
+             '{} new addrs)').format(
+                 self.rate, self.target_rate, self.num_events,
+                 self.num_sets, self.num_new_addrs)
+        if self.failed:
+            s += ', {} sets not terminated'.format(self.num_unterminated)
+        return s
+
+
+class FloodAdvertiser(AdvSetManager):
+    """Advertise a share of the flood on one controller.
+
+    Args:
+        hci_sock: HCISock of the advertiser.
+        seed: Seed of payload sizes and addresses, for reproducible loads.
+    """
+
+    def __init__(self, hci_sock, seed=0, window=4):
+        super(FloodAdvertiser, self).__init__(hci_sock, window)
+        self.rng = random.Random(seed)
+        self.set_rate = None
+
+    def setup(self, num_sets, set_rate, payload_sizes=((31, 1),),
+              timeout=None):
+        """Add and program the advertising sets.
+
+        Args:
+            num_sets: Number of advertising sets.
+            set_rate: Target advertising events per second of each set.
+            payload_sizes: Sequence of (size, weight) of payload sizes.
+            timeout: Maximum time in seconds to program the sets, or a
+                Deadline.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        self.set_rate = set_rate
+        intvl = adv_intvl_for_rate(set_rate)
+        max_len = self.max_adv_data_len or 31
+        for _ in xrange(0, num_sets):
+            size = min(choose_payload_size(self.rng, payload_sizes), max_len)
+            self.add_set(adv_intvl=intvl, data=flood_payload(size),
+                         own_addr_type=OWN_ADDR_TYPE_RANDOM)
+        cmds = [btcmd.HCILESetAdvertisingSetRandomAddress(
+            h, random_static_addr(self.rng)) for h in sorted(self.adv_sets)]
+        self.program(None, deadline)
+        self.send_hci_cmds_check_status(cmds, self.window, deadline)
+
+    def _churn(self, churn, timeout):
+        # Give a fraction of the sets a new address.
+        adv_sets = [s for s in self.adv_sets.itervalues()
+                    if self.rng.random() < churn]
+        cmds = [btcmd.HCILESetAdvertisingSetRandomAddress(
+            s.adv_handle, random_static_addr(self.rng)) for s in adv_sets]
+        if cmds:
+            self.send_hci_cmds_check_status(cmds, self.window, timeout)
+        return len(cmds)
+
+    def _adjust(self, adv_set, rate):
+        # The measured period minus the interval is the overhead of the
+        # controller (advDelay, scheduling), assumed to stay the same.
+        if rate <= 0:
+            return None
+        overhead = 1.0 / rate - adv_set.adv_intvl * 0.625e-3
+        intvl = int(round((1.0 / self.set_rate - overhead) / 0.625e-3))
+        intvl = max(intvl, MIN_ADV_INTVL)
+        if intvl == adv_set.adv_intvl:
+            return None
+        adv_set.adv_intvl = intvl
+        return adv_set.param_cmd()
+
+    def _disable_all(self, on_terminated, timeout):
+        # Sets terminating before the command complete are counted in the
+        # round rather than ignored, so that no event is left to a later
+        # round.
+        cmd = btcmd.HCILESetExtendedAdvertisingEnable(0, 0)
+        opcode = cmd.opcode()
+        deadline = Deadline.from_timeout(timeout)
+        self.send_hci_cmd(cmd)
+        with self.sock.waiting_for(cmd):
+            while True:
+                evt = self.recv_hci_evt(deadline)
+                if evt.__class__ is btevt.LEAdvertisingSetTerminatedEvent:
+                    on_terminated(evt)
+                elif (evt.code == bluez.EVT_CMD_COMPLETE
+                        and evt.cmd_opcode == opcode):
+                    self.check_hci_evt_status(evt)
+                    return
+                else:
+                    self.log.info('ignore event: {}'.format(str(evt)))
+
+    def run_round(self, duration, churn=0.0, cmd_timeout=None):
+        """Advertise for about duration seconds and measure the rate.
+
+        Each set is enabled for the number of events of its target rate in
+        duration, at most 255. Sets not terminated within twice duration
+        are disabled and the round is failed. Intervals are adjusted for
+        the next round.
+
+        Args:
+            duration: Time in seconds to advertise.
+            churn: Fraction of the sets given a new address.
+            cmd_timeout: Maximum time in seconds to complete each batch of
+                commands.
+
+        Returns:
+            FloodRound: The result of the round.
+        """
+        result = FloodRound(len(self.adv_sets),
+                            self.set_rate * len(self.adv_sets))
+        result.num_new_addrs = self._churn(churn, cmd_timeout)
+        max_evts = max(1, min(255, int(round(self.set_rate * duration))))
+        for adv_set in self.adv_sets.itervalues():
+            adv_set.max_ext_adv_events = max_evts
+        self.enable(None, cmd_timeout)
+        start = get_clock().time()
+        remaining = set(self.adv_sets)
+        rates = {}
+
+        def on_terminated(evt):
+            if evt.adv_handle not in remaining:
+                self.log.info('ignore event: {}'.format(str(evt)))
+                return
+            elapsed = get_clock().time() - start
+            remaining.discard(evt.adv_handle)
+            result.num_events += evt.num_completed_ext_adv_evts
+            result.elapsed = max(result.elapsed, elapsed)
+            # The first event is sent at enable, so n events span n - 1
+            # periods.
+            rates[evt.adv_handle] = (
+                max(evt.num_completed_ext_adv_evts - 1, 1) / elapsed)
+
+        deadline = Deadline(2 * duration + 1)
+        try:
+            while remaining:
+                evt = self.recv_hci_evt(deadline)
+                if evt.__class__ is btevt.LEAdvertisingSetTerminatedEvent:
+                    on_terminated(evt)
+                else:
+                    self.log.info('ignore event: {}'.format(str(evt)))
+        except HCITimeoutError:
+            self._disable_all(on_terminated, cmd_timeout)
+            result.num_unterminated = len(remaining)
+            self.log.warning('%d sets did not terminate', len(remaining))
+        if result.elapsed > 0:
+            result.rate = sum(rates.itervalues())
+        cmds = []
+        for adv_handle, rate in rates.iteritems():
+            cmd = self._adjust(self.adv_sets[adv_handle], rate)
+            if cmd is not None:
+                cmds.append(cmd)
+        if cmds:
+            self.send_hci_cmds_check_status(cmds, self.window, cmd_timeout)
+        return result
+
+
+class FloodScanStats(object):
+    """Flood advertisements received by a scanner.
+
+    Attributes:
+        num_advs: Number of flood advertisements received.
+        num_reports: Number of advertising reports received.
+        elapsed: Scan time in seconds.
+        addrs: Set of flood advertiser addresses seen.
+    """
+
+    def __init__(self):
+        super(FloodScanStats, self).__init__()
+        self.num_advs = 0
+        self.num_reports = 0
+        self.elapsed = 0.0
+        self.addrs = set()
+
+    @property
+    def rate(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.num_advs / self.elapsed
+
+    def __str__(self):
+        return '{:.1f}/s ({} advs, {} reports, {} addrs)'.format(
+            self.rate, self.num_advs, self.num_reports, len(self.addrs))
+
+
+class FloodScanner(LEHelper):
+    """Measure the received rate of a flood."""
+
+    def configure(self, scan_intvl=0x10, scan_window=0x10, timeout=None):
+        """Set continuous passive extended scanning on LE 1M PHY."""
+        self.set_ext_scan_parameters(0, 0, 1, 0, scan_intvl, scan_window,
+                                     timeout=timeout)
+
+    def measure(self, duration, stop_timeout=5):
+        """Scan for duration seconds and count flood advertisements.
+
+        Only the first report of a fragmented advertisement carries the
+        flood marker, so each advertisement is counted once. Reports
+        received while scanning is disabled are counted as well.
+
+        Args:
+            duration: Time in seconds to scan.
+            stop_timeout: Maximum time in seconds to disable scanning.
+
+        Returns:
+            FloodScanStats: The counts of the scan.
+        """
+        stats = FloodScanStats()
+
+        def process(evt):
+            if evt.__class__ is not btevt.LEExtendedAdvertisingReportEvent:
+                return False
+            stats.num_reports += evt.num_reports
+            for i in xrange(0, evt.num_reports):
+                if is_flood_payload(evt.data[i]):
+                    stats.num_advs += 1
+                    stats.addrs.add(evt.addr[i])
+            return True
+
+        deadline = Deadline(duration)
+        self.start_ext_scan(timeout=deadline)
+        start = get_clock().time()
+        try:
+            while True:
+                try:
+                    evt = self.recv_hci_evt(deadline)
+                except HCITimeoutError:
+                    break
+                process(evt)
+        finally:
+            stats.elapsed = get_clock().time() - start
+            self._disable_scan(btcmd.HCILESetExtendedScanEnable(0, 0, 0, 0),
+                               process, stop_timeout)
+        self.log.info('received %s', stats)
+        return stats
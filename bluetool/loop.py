@@ -0,0 +1,521 @@
+"""Single-process event loop for driving many HCI devices.
+
+HCICoordinator runs every device in its own worker process, each blocked in
+its own poll. With dozens of controllers the per-process memory and context
+switches cost more than the HCI traffic itself, so HCILoop puts the HCISock
+of every device into one epoll set and runs the per-device logic as
+coroutines in the calling process.
+
+A coroutine is a generator. It waits by yielding one of the wait objects
+returned by the primitives of HCICoTask (e.g. wait_hci_evt()), or calls a
+sub-procedure by yielding another coroutine. A coroutine returns a value to
+its caller by raising Return. The procedures of LEHelper and BREDRHelper are
+shared with LECoHelper and BREDRCoHelper, where they are called with the same
+names and their results are yielded:
+
+    class LEMaster(HCILoopWorker):
+        def main(self):
+            helper = LECoHelper(self.sock)
+            yield helper.reset()
+            peer_addr = yield self.recv()
+            yield helper.create_connection_by_peer_addr(
+                0, peer_addr, 12, 0, 1000, 6)
+            evt = yield helper.wait_connection_complete()
+"""
+import collections
+import errno
+import heapq
+import logging
+import select
+import sys
+import types
+
+from . import bluez
+from . import command as btcmd
+from .clock import Deadline, get_clock, now, wait_ready
+from .core import (HCIDevice, HCISock, ReadBDAddrTask, _BREDRProcedures,
+                   _BTProcedures, _LEProcedures, init_config_devices)
+from .error import Error, HCIParseError, HCITimeoutError
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value to its caller."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+_PENDING = object()
+
+
+class _Wait(object):
+    """Base wait object yielded by a coroutine.
+
+    poll() returns the result of the wait if it can complete, or _PENDING.
+    """
+
+    raise_on_deadline = True  # raise HCITimeoutError at deadline
+
+    def __init__(self, timeout=None):
+        self.deadline = Deadline.from_timeout(timeout)
+
+    def poll(self, task):
+        raise NotImplementedError
+
+
+class _WaitPkt(_Wait):
+    def __init__(self, pkt_matcher=None, timeout=None):
+        super(_WaitPkt, self).__init__(timeout)
+        self.pkt_matcher = pkt_matcher
+
+    def poll(self, task):
+        while len(task.inbox) > 0:
+            ptype_pkt = task.inbox.popleft()
+            if self.pkt_matcher is None or self.pkt_matcher(*ptype_pkt):
+                return ptype_pkt
+            task.log.info('ignore packet: {}, {}'.format(
+                ptype_pkt[0], str(ptype_pkt[1])))
+        return _PENDING
+
+
+class _WaitEvt(_WaitPkt):
+    def __init__(self, evt_matcher, timeout=None):
+        super(_WaitEvt, self).__init__(
+            lambda ptype, pkt: (
+                ptype == bluez.HCI_EVENT_PKT and evt_matcher(pkt)),
+            timeout)
+
+    def poll(self, task):
+        ptype_pkt = super(_WaitEvt, self).poll(task)
+        if ptype_pkt is _PENDING:
+            return _PENDING
+        return ptype_pkt[1]
+
+
+class _Sleep(_Wait):
+    raise_on_deadline = False
+
+    def poll(self, task):
+        return _PENDING
+
+
+class _WaitCond(_Wait):
+    def __init__(self, cond, timeout=None):
+        super(_WaitCond, self).__init__(timeout)
+        self.cond = cond
+
+    def poll(self, task):
+        return self.cond()
+
+
+class _Task(object):
+    def __init__(self, coro, hci_sock=None, name=None):
+        self.stack = [coro]
+        self.sock = hci_sock
+        self.name = name
+        self.inbox = collections.deque()
+        self.wait = None
+        self.done = False
+        self.result = None
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, name if name else 'task'))
+
+
+class HCILoop(object):
+    """Event loop running HCI coroutines over one epoll set."""
+
+    def __init__(self):
+        super(HCILoop, self).__init__()
+        self.epoll = select.epoll()
+        self.tasks = []
+        self.fd_task = {}
+        self.timers = []
+        self.timer_seq = 0
+        self.failed = False
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+
+    def spawn(self, coro, hci_sock=None, name=None):
+        """Add a coroutine to the loop.
+
+        Packets received from hci_sock are delivered to this coroutine. Each
+        HCISock can be owned by one coroutine only.
+        """
+        task = _Task(coro, hci_sock, name)
+        if hci_sock is not None:
+            fd = hci_sock.fileno()
+            if fd in self.fd_task:
+                raise Error('HCI socket is already owned by a task')
+            self.fd_task[fd] = task
+            self.epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        """Run all coroutines until they are done.
+
+        Returns:
+            int: 0 if all coroutines succeeded; otherwise, 1. The loop stops
+                as soon as one coroutine fails.
+        """
+        for task in self.tasks:
+            self._advance(task, None)
+        # A task may have completed the wait of a task started before it.
+        self._poll_waits()
+        while not self.failed and not all(t.done for t in self.tasks):
+            expiry = self._next_expiry()
+            if expiry is None and len(self.fd_task) == 0:
+                raise Error('all tasks are blocked')
+            try:
+                events = wait_ready(self._poll, Deadline.at(expiry),
+                                    self._clock_keys())
+            except IOError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, mask in events:
+                task = self.fd_task.get(fd)
+                if task is None:
+                    continue
+                task.inbox.extend(task.sock.read_hci_pkts())
+            self._fire_timers()
+            self._poll_waits()
+        if self.failed:
+            for task in self.tasks:
+                if not task.done:
+                    self._finish(task)
+                    for gen in reversed(task.stack):
+                        gen.close()
+            return 1
+        return 0
+
+    def _poll(self, timeout):
+        return self.epoll.poll(-1 if timeout is None else timeout)
+
+    def _clock_keys(self):
+        # The sockets are waited on in virtual time if all their transports
+        # notify the clock.
+        keys = [task.sock.clock_key for task in self.fd_task.itervalues()]
+        if None in keys:
+            return None
+        return keys
+
+    def _next_expiry(self):
+        while len(self.timers) > 0:
+            deadline, seq, task, wait = self.timers[0]
+            if task.wait is not wait:
+                heapq.heappop(self.timers)
+                continue
+            return deadline
+        return None
+
+    def _fire_timers(self):
+        t = now()
+        while (not self.failed and len(self.timers) > 0
+               and self.timers[0][0] <= t):
+            deadline, seq, task, wait = heapq.heappop(self.timers)
+            if task.wait is wait:
+                task.wait = None
+                if not wait.raise_on_deadline:
+                    self._advance(task, None)
+                    continue
+                try:
+                    raise HCITimeoutError
+                except HCITimeoutError:
+                    self._advance(task, None, sys.exc_info())
+
+    def _poll_waits(self):
+        progressed = True
+        while progressed and not self.failed:
+            progressed = False
+            for task in self.tasks:
+                if task.wait is None:
+                    continue
+                result = task.wait.poll(task)
+                if result is not _PENDING:
+                    task.wait = None
+                    self._advance(task, result)
+                    progressed = True
+
+    def _finish(self, task):
+        task.done = True
+        task.wait = None
+        if task.sock is not None:
+            fd = task.sock.fileno()
+            if self.fd_task.get(fd) is task:
+                self.epoll.unregister(fd)
+                del self.fd_task[fd]
+
+    def _advance(self, task, value, exc_info=None):
+        while True:
+            gen = task.stack[-1]
+            try:
+                if exc_info is not None:
+                    exc, exc_info = exc_info, None
+                    yielded = gen.throw(*exc)
+                else:
+                    yielded = gen.send(value)
+            except (Return, StopIteration) as ret:
+                task.stack.pop()
+                value = getattr(ret, 'value', None)
+                if len(task.stack) == 0:
+                    task.result = value
+                    self._finish(task)
+                    return
+                continue
+            except Exception as err:
+                task.stack.pop()
+                if len(task.stack) == 0:
+                    task.log.warning(
+                        '{}: {}'.format(err.__class__.__name__, str(err)),
+                        exc_info=True)
+                    self._finish(task)
+                    self.failed = True
+                    return
+                exc_info = sys.exc_info()
+                continue
+
+            value = None
+            if isinstance(yielded, types.GeneratorType):
+                task.stack.append(yielded)
+            elif isinstance(yielded, _Wait):
+                result = yielded.poll(task)
+                if result is not _PENDING:
+                    value = result
+                    continue
+                task.wait = yielded
+                if yielded.deadline.expiry is not None:
+                    self.timer_seq += 1
+                    heapq.heappush(
+                        self.timers,
+                        (yielded.deadline.expiry, self.timer_seq, task,
+                         yielded))
+                return
+            else:
+                try:
+                    raise TypeError(
+                        'unsupported object yielded: {}'.format(yielded))
+                except TypeError:
+                    exc_info = sys.exc_info()
+
+
+class HCICoTask(object):
+    """Coroutine counterpart of HCITask.
+
+    Methods either return a wait object or a coroutine. In both cases the
+    caller should yield the returned value. Timeouts are in seconds, or a
+    Deadline, as in HCITask.
+    """
+
+    def __init__(self, hci_sock):
+        super(HCICoTask, self).__init__()
+        self.sock = hci_sock
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+
+    def send_hci_cmd(self, cmd):
+        self.sock.send_hci_cmd(cmd)
+
+    def send_acl_data(self, data):
+        self.sock.send_acl_data(data)
+
+    def recv_hci_pkt(self, timeout=None):
+        return _WaitPkt(None, timeout)
+
+    def recv_hci_evt(self, timeout=None):
+        ptype, evt = yield self.recv_hci_pkt(timeout)
+        if ptype != bluez.HCI_EVENT_PKT:
+            raise HCIParseError('not an event: ptype: {}'.format(ptype))
+        raise Return(evt)
+
+    def wait_hci_evt(self, evt_matcher, timeout=None):
+        return _WaitEvt(evt_matcher, timeout)
+
+    def sleep(self, secs):
+        return _Sleep(secs)
+
+    def send_hci_cmd_wait_cmd_complt(self, cmd, timeout=None):
+        self.send_hci_cmd(cmd)
+        with self.sock.waiting_for(cmd):
+            evt = yield self.wait_hci_evt(
+                lambda evt: (
+                    evt.code == bluez.EVT_CMD_COMPLETE
+                    and evt.cmd_opcode == cmd.opcode()),
+                timeout)
+        raise Return(evt)
+
+    def send_hci_cmd_wait_cmd_status(self, cmd, timeout=None):
+        self.send_hci_cmd(cmd)
+        with self.sock.waiting_for(cmd):
+            evt = yield self.wait_hci_evt(
+                lambda evt: (
+                    evt.code == bluez.EVT_CMD_STATUS
+                    and evt.cmd_opcode == cmd.opcode()),
+                timeout)
+        raise Return(evt)
+
+
+class BTCoHelper(_BTProcedures, HCICoTask):
+    def __init__(self, hci_sock):
+        super(BTCoHelper, self).__init__(hci_sock)
+
+    def _run(self, steps):
+        # The steps are a coroutine yielding coroutines and wait objects.
+        return steps
+
+    def send_hci_cmd_wait_cmd_complt_check_status(self, cmd, timeout=None):
+        evt = yield self.send_hci_cmd_wait_cmd_complt(cmd, timeout)
+        self.check_hci_evt_status(evt)
+        raise Return(evt)
+
+    def send_hci_cmd_wait_cmd_status_check_status(self, cmd, timeout=None):
+        evt = yield self.send_hci_cmd_wait_cmd_status(cmd, timeout)
+        self.check_hci_evt_status(evt)
+        raise Return(evt)
+
+
+class BREDRCoHelper(_BREDRProcedures, BTCoHelper):
+    def __init__(self, hci_sock):
+        super(BREDRCoHelper, self).__init__(hci_sock)
+
+
+class LECoHelper(_LEProcedures, BTCoHelper):
+    def __init__(self, hci_sock):
+        super(LECoHelper, self).__init__(hci_sock)
+
+    def _read_le_features(self, deadline):
+        if self.sock.caps is not None:
+            raise Return(self.sock.caps.le_features or 0)
+        cmd = btcmd.HCILEReadLocalSupportedFeatures()
+        evt = yield self.send_hci_cmd_wait_cmd_complt_check_status(cmd,
+                                                                   deadline)
+        raise Return(evt.le_features)
+
+    def read_buffer_size(self, timeout=None):
+        cmd = btcmd.HCILEReadBufferSize()
+        return self.send_hci_cmd_wait_cmd_complt_check_status(cmd, timeout)
+
+
+class HCILoopWorker(HCICoTask):
+    """Coroutine counterpart of HCIWorker.
+
+    wait() and recv() return wait objects to be yielded.
+    """
+
+    def __init__(self, hci_sock, coord):
+        super(HCILoopWorker, self).__init__(hci_sock)
+        self.coord = coord
+        # Signals are counted as in HCIWorker.
+        self.signals = 0
+        self.worker_queue = collections.deque()
+        self.coord_queue = collections.deque()
+
+    def main(self):
+        """Main coroutine of worker object.
+
+        Subclass should implement this method to provide main coroutine.
+        """
+        raise NotImplementedError
+
+    def _take_signal(self):
+        if self.signals == 0:
+            return _PENDING
+        self.signals -= 1
+        return None
+
+    def wait(self, timeout=None):
+        return _WaitCond(self._take_signal, timeout)
+
+    def signal(self):
+        self.signals += 1
+
+    def send(self, obj):
+        """Send an object to the corresponding coordinator."""
+        self.coord_queue.append(obj)
+
+    def recv(self, timeout=None):
+        """Receive an object sent from the corresponding coordinator."""
+        return _WaitCond(
+            lambda: (self.worker_queue.popleft()
+                     if len(self.worker_queue) > 0 else _PENDING),
+            timeout)
+
+
+class HCILoopWorkerProxy(object):
+    def __init__(self, dev, coord, worker_type, *args):
+        """Create a worker on a device.
+
+        dev is either a HCI device id or a HCIDevice already brought up.
+        """
+        if isinstance(dev, HCIDevice):
+            self.sock = dev.sock
+            self.bd_addr = dev.bd_addr
+        else:
+            self.sock = HCISock(dev)
+            self.bd_addr = ReadBDAddrTask(self.sock).read_bd_addr()
+        self.worker = worker_type(self.sock, coord, *args)
+
+    def wait(self, timeout=None):
+        return self.worker.wait(timeout)
+
+    def signal(self):
+        self.worker.signal()
+
+    def send(self, obj):
+        """Send an object to the corresponding worker."""
+        self.worker.worker_queue.append(obj)
+
+    def recv(self, timeout=None):
+        """Receive an object sent from the corresponding worker."""
+        queue = self.worker.coord_queue
+        return _WaitCond(
+            lambda: queue.popleft() if len(queue) > 0 else _PENDING,
+            timeout)
+
+
+class HCILoopCoordinator(object):
+    """Coroutine counterpart of HCICoordinator.
+
+    Workers are HCILoopWorker coroutines run by one HCILoop in the calling
+    process. The coordinator main() is run as a coroutine as well. It accepts
+    the same configuration as HCICoordinator.
+    """
+
+    def __init__(self):
+        super(HCILoopCoordinator, self).__init__()
+        self.worker = []
+        self.loop = HCILoop()
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+
+    def run(self):
+        for i, w in enumerate(self.worker):
+            self.loop.spawn(w.worker.main(), w.sock,
+                            '{}{}'.format(w.worker.__class__.__name__, i))
+        main_task = self.loop.spawn(self.main(), None,
+                                    self.__class__.__name__)
+        with get_clock().participant():
+            ret = self.loop.run()
+        if ret == 0 and main_task.result is not None:
+            ret = main_task.result
+        return ret
+
+    def add_worker(self, name, dev, worker_type):
+        w = HCILoopWorkerProxy(dev, self, worker_type)
+        self.worker.append(w)
+        setattr(self, name, w)
+
+    def load(self, cfg):
+        self.devices = init_config_devices(cfg)
+        for w, dev in zip(cfg['worker'], self.devices):
+            self.add_worker(w[0], dev, w[1])
+
+    def main(self):
+        """Main coroutine of coordinator object.
+
+        Subclass should implement this method to provide main coroutine. The
+        coroutine can return zero as success and non-zero value as failure
+        by raising Return. If no value is returned, it is considered zero.
+        """
+        raise NotImplementedError
@@ -0,0 +1,352 @@
+"""Periodic advertising synchronization.
+
+PeriodicSyncManager keeps several periodic advertising trains synchronized at
+once and streams their reports. Report payloads are memoryviews into the
+received packets, so reports can be counted and inspected without copying
+their data.
+"""
+from . import bluez
+from . import command as btcmd
+from . import event as btevt
+from .adv import DATA_STATUS_INCOMPLETE, DATA_STATUS_TRUNCATED
+from .clock import Deadline, get_clock
+from .core import LEHelper
+from .error import HCITimeoutError, TestError
+
+# Create sync options
+CREATE_SYNC_USE_LIST = 0x01
+CREATE_SYNC_REPORTING_DISABLED = 0x02
+
+# Status of sync established when the host cancels the create sync
+_STATUS_CANCELLED = 0x44
+
+
+class PeriodicSync(object):
+    """Synchronized periodic advertising train and its counters.
+
+    A periodic advertising event is reported in one or more reports, the
+    last of which is complete or truncated. Missed events are estimated from
+    the gaps between received events and the advertising interval.
+
+    Attributes:
+        adv_addr_type, adv_addr, adv_sid: Advertiser of the train.
+        sync_handle: Sync handle, or None while not synchronized.
+        adv_phy: PHY of the train.
+        periodic_adv_intvl: Periodic advertising interval (1.25 ms units).
+        num_reports: Number of reports received.
+        num_bytes: Number of payload bytes received.
+        num_events: Number of advertising events received.
+        num_truncated: Number of events received truncated.
+        num_missed: Estimated number of events missed while synchronized.
+        num_lost: Number of times the sync was lost.
+        first_seen, last_seen: Clock time of the first and last report.
+    """
+
+    def __init__(self, adv_addr_type, adv_addr, adv_sid):
+        super(PeriodicSync, self).__init__()
+        self.adv_addr_type = adv_addr_type
+        self.adv_addr = adv_addr
+        self.adv_sid = adv_sid
+        self.sync_handle = None
+        self.adv_phy = None
+        self.periodic_adv_intvl = None
+        self.num_reports = 0
+        self.num_bytes = 0
+        self.num_events = 0
+        self.num_truncated = 0
+        self.num_missed = 0
+        self.num_lost = 0
+        self.first_seen = None
+        self.last_seen = None
+        self._event_start = None
+        self._in_event = False
+
+    def __str__(self):
+        return ('{}({}, sid {}: {} events, {} missed, {} lost, '
+                '{:.0f} B/s)').format(
+                    self.__class__.__name__, bluez.ba2str(self.adv_addr),
+                    self.adv_sid, self.num_events, self.num_missed,
+                    self.num_lost, self.throughput)
+
+    @property
+    def key(self):
+        return (self.adv_addr_type, self.adv_addr, self.adv_sid)
+
+    @property
+    def throughput(self):
+        """Payload bytes per second received since the first report."""
+        if self.first_seen is None or self.last_seen == self.first_seen:
+            return 0.0
+        return self.num_bytes / (self.last_seen - self.first_seen)
+
+    def established(self, evt):
+        self.sync_handle = evt.sync_handle
+        self.adv_phy = evt.adv_phy
+        self.periodic_adv_intvl = evt.periodic_adv_intvl
+        self._event_start = None
+        self._in_event = False
+
+    def lost(self):
+        self.sync_handle = None
+        self.num_lost += 1
+
+    def add_report(self, evt, now):
+        if self.first_seen is None:
+            self.first_seen = now
+        self.last_seen = now
+        self.num_reports += 1
+        self.num_bytes += len(evt.data)
+        if not self._in_event:
+            # First report of an event
+            if self._event_start is not None:
+                n = int(round((now - self._event_start)
+                              / (self.periodic_adv_intvl * 1.25e-3))) - 1
+                if n > 0:
+                    self.num_missed += n
+            self._event_start = now
+        if evt.data_status == DATA_STATUS_INCOMPLETE:
+            self._in_event = True
+            return
+        self._in_event = False
+        self.num_events += 1
+        if evt.data_status == DATA_STATUS_TRUNCATED:
+            self.num_truncated += 1
+
+
+class PeriodicSyncManager(LEHelper):
+    """Keep periodic advertising trains synchronized.
+
+    Advertisers are loaded into the periodic advertiser list and synced one
+    create sync at a time, in whatever order the controller finds them. A
+    sync can only be created while extended scanning is enabled; scanning
+    is started if needed.
+
+    Args:
+        hci_sock: HCISock of the scanner.
+        skip: Number of periodic advertising events the controller may
+            skip.
+        sync_timeout: Sync timeout (10 ms units).
+        max_retries: Maximum number of failed create syncs in a row.
+
+    Attributes:
+        syncs: Dict of PeriodicSync keyed by (adv_addr_type, adv_addr,
+            adv_sid).
+    """
+
+    def __init__(self, hci_sock, skip=0, sync_timeout=300, max_retries=3):
+        super(PeriodicSyncManager, self).__init__(hci_sock)
+        self.skip = skip
+        self.sync_timeout = sync_timeout
+        self.max_retries = max_retries
+        self.syncs = {}
+        self.handles = {}
+        self.pending = set()
+        self.adv_list = set()
+        self.creating = False
+        self.retries = 0
+        self.resync = False
+        self.scan_started = False
+
+    def _send_hci_cmd_wait(self, cmd, deadline):
+        # Periodic advertising events received while waiting for the
+        # command complete or status are processed instead of dropped.
+        opcode = cmd.opcode()
+        self.send_hci_cmd(cmd)
+        with self.sock.waiting_for(cmd):
+            while True:
+                evt = self.recv_hci_evt(deadline)
+                if (evt.code in (bluez.EVT_CMD_COMPLETE,
+                                 bluez.EVT_CMD_STATUS)
+                        and evt.cmd_opcode == opcode):
+                    self.check_hci_evt_status(evt)
+                    return evt
+                self.process_evt(evt)
+
+    def _update_adv_list(self, deadline):
+        # The list cannot be changed while a create sync is pending.
+        for key in self.adv_list - self.pending:
+            self._send_hci_cmd_wait(
+                btcmd.HCILERemoveDeviceFromPeriodicAdvertiserList(*key),
+                deadline)
+            self.adv_list.discard(key)
+        for key in self.pending - self.adv_list:
+            self._send_hci_cmd_wait(
+                btcmd.HCILEAddDeviceToPeriodicAdvertiserList(*key), deadline)
+            self.adv_list.add(key)
+
+    def _create_sync(self, deadline):
+        if self.creating or not self.pending:
+            return
+        self._update_adv_list(deadline)
+        if not self.sock.state.le_scan_enabled:
+            self._send_hci_cmd_wait(
+                btcmd.HCILESetExtendedScanEnable(1, 0, 0, 0), deadline)
+            self.scan_started = True
+        self._send_hci_cmd_wait(
+            btcmd.HCILEPeriodicAdvertisingCreateSync(
+                CREATE_SYNC_USE_LIST, 0, 0, '\x00'*6, self.skip,
+                self.sync_timeout), deadline)
+        self.creating = True
+
+    def _on_established(self, evt):
+        self.creating = False
+        if evt.status != 0:
+            if evt.status != _STATUS_CANCELLED:
+                self.retries += 1
+                if self.retries > self.max_retries:
+                    raise TestError(
+                        'create sync failed: status 0x{:02x}'.format(
+                            evt.status))
+                self.log.info('retry create sync: status 0x%02x',
+                              evt.status)
+            return
+        self.retries = 0
+        key = (evt.adv_addr_type, evt.adv_addr, evt.adv_sid)
+        sync = self.syncs.get(key)
+        if sync is None:
+            sync = PeriodicSync(*key)
+            self.syncs[key] = sync
+        sync.established(evt)
+        self.handles[evt.sync_handle] = sync
+        self.pending.discard(key)
+        self.log.info('sync to %s sid %d: handle 0x%04x',
+                      bluez.ba2str(evt.adv_addr), evt.adv_sid,
+                      evt.sync_handle)
+
+    def _on_lost(self, evt):
+        sync = self.handles.pop(evt.sync_handle, None)
+        if sync is None:
+            return
+        sync.lost()
+        self.log.info('sync to %s sid %d lost', bluez.ba2str(sync.adv_addr),
+                      sync.adv_sid)
+        if self.resync:
+            self.pending.add(sync.key)
+
+    def process_evt(self, evt, now=None):
+        """Process a periodic advertising event.
+
+        Returns:
+            PeriodicSync: The sync of a report, or None.
+        """
+        cls = evt.__class__
+        if cls is btevt.LEPeriodicAdvertisingReportEvent:
+            sync = self.handles.get(evt.sync_handle)
+            if sync is not None:
+                if now is None:
+                    now = get_clock().time()
+                sync.add_report(evt, now)
+            return sync
+        if cls is btevt.LEPeriodicAdvertisingSyncEstablishedEvent:
+            self._on_established(evt)
+        elif cls is btevt.LEPeriodicAdvertisingSyncLostEvent:
+            self._on_lost(evt)
+        else:
+            self.log.info('ignore event: {}'.format(str(evt)))
+        return None
+
+    def sync_all(self, advertisers, timeout=None, cancel_timeout=5):
+        """Synchronize to periodic advertising trains.
+
+        Args:
+            advertisers: Iterable of (adv_addr_type, adv_addr, adv_sid).
+            timeout: Maximum time in seconds to sync all advertisers, or a
+                Deadline.
+            cancel_timeout: Maximum time in seconds to cancel the pending
+                create sync once timeout occurs, or a Deadline.
+
+        Returns:
+            dict: PeriodicSync of all advertisers.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+            TestError: Raised if create sync fails more than max_retries
+                times in a row.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        for key in advertisers:
+            sync = self.syncs.get(key)
+            if sync is None or sync.sync_handle is None:
+                self.pending.add(key)
+        while self.pending:
+            try:
+                self._create_sync(deadline)
+                evt = self.recv_hci_evt(deadline)
+            except HCITimeoutError:
+                self._cancel_create_sync(
+                    Deadline.from_timeout(cancel_timeout))
+                raise
+            self.process_evt(evt)
+        return self.syncs
+
+    def iter_reports(self, duration=None, resync=False):
+        """Yield (PeriodicSync, LEPeriodicAdvertisingReportEvent) of the
+        synchronized trains.
+
+        The data of a report is a memoryview into the received packet; call
+        data.tobytes() to keep it beyond the next iteration.
+
+        Args:
+            duration: Time in seconds to receive reports, or None.
+            resync: Synchronize again to trains whose sync is lost.
+
+        Raises:
+            HCITimeoutError: Raised if a command to synchronize again is not
+                completed within duration.
+        """
+        deadline = Deadline(duration)
+        self.resync = resync
+        try:
+            while True:
+                if resync:
+                    self._create_sync(deadline)
+                try:
+                    evt = self.recv_hci_evt(deadline)
+                except HCITimeoutError:
+                    return
+                now = get_clock().time()
+                sync = self.process_evt(evt, now)
+                if sync is not None:
+                    yield (sync, evt)
+        finally:
+            self.resync = False
+
+    def _cancel_create_sync(self, deadline):
+        if not self.creating:
+            return
+        self._send_hci_cmd_wait(
+            btcmd.HCILEPeriodicAdvertisingCreateSyncCancel(), deadline)
+        # The sync may have been established before the cancel.
+        while self.creating:
+            self.process_evt(self.recv_hci_evt(deadline))
+
+    def terminate_all(self, timeout=None):
+        """Terminate all syncs and stop the scanning started for them.
+
+        Args:
+            timeout: Maximum time in seconds to terminate all syncs, or a
+                Deadline.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        self._cancel_create_sync(deadline)
+        self.pending.clear()
+        for sync_handle in self.handles.keys():
+            sync = self.handles.pop(sync_handle, None)
+            if sync is None:
+                # Lost while terminating another sync
+                continue
+            sync.sync_handle = None
+            self._send_hci_cmd_wait(
+                btcmd.HCILEPeriodicAdvertisingTerminateSync(sync_handle),
+                deadline)
+        if self.adv_list:
+            self._send_hci_cmd_wait(
+                btcmd.HCILEClearPeriodicAdvertiserList(), deadline)
+            self.adv_list.clear()
+        if self.scan_started:
+            self._send_hci_cmd_wait(
+                btcmd.HCILESetExtendedScanEnable(0, 0, 0, 0), deadline)
+            self.scan_started = False
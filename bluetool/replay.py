@@ -0,0 +1,220 @@
+"""Replay of btsnoop captures as the controller side of an HCISock.
+
+ReplayTransport plays back a capture recorded by HCISock.start_capture(), so
+that LEHelper and BREDRHelper procedures and bluetest workers can be run
+again without Bluetooth hardware:
+
+    hci_sock = HCISock(ReplayTransport('scan.btsnoop', speed=10))
+
+or, for a bluetest configuration, with the transports as the 'device' entry.
+
+A player thread checks every packet sent by the host against the next
+recorded sent packet, and releases the recorded received packets following
+it. Received packets keep their recorded spacing divided by speed, or are
+released at once if speed is None, which measures the host side alone.
+Host timeouts are not scaled: a procedure waiting for a deadline waits as
+long as it did when recorded. Host state deciding which commands are sent
+must also be as recorded; e.g. the capabilities of a controller are only
+queried on a miss of the capability cache (see BLUETOOL_CAP_CACHE).
+
+On a mismatch or at the end of the capture, the host gets ReplayError from
+its next receive or send. Transports opened before bluetest forks workers
+keep their player in the coordinator process, so the details of a mismatch
+are logged and kept by the transport there.
+"""
+import logging
+import socket
+import threading
+import time
+
+from . import bluez
+from .btsnoop import BtsnoopReader
+from .capture import DIR_SENT
+from .clock import monotonic
+from .core import parse_hci_pkt
+from .error import HCIError
+from .utils import letoh16
+
+# Size of the largest H4 packet received by the player
+_MAX_PKT_SIZE = 65536
+
+
+class ReplayError(HCIError):
+    def __init__(self, msg=''):
+        super(ReplayError, self).__init__(msg)
+
+
+def _describe(pkt):
+    ptype = ord(pkt[0])
+    if ptype == bluez.HCI_COMMAND_PKT:
+        return 'command 0x{:04x} ({} bytes)'.format(letoh16(pkt, 1),
+                                                     len(pkt))
+    try:
+        return str(parse_hci_pkt(pkt)[1])
+    except Exception:
+        return 'packet type {} ({} bytes)'.format(ptype, len(pkt))
+
+
+def _same_pkt(sent, recorded, strict):
+    # Without strict, commands are matched by opcode and ACL data by
+    # header.
+    if strict or len(sent) < 5:
+        return sent == recorded
+    if ord(sent[0]) == bluez.HCI_COMMAND_PKT:
+        return sent[:3] == recorded[:3]
+    return sent[:5] == recorded[:5]
+
+
+class ReplayTransport(object):
+    """Controller side played back from a btsnoop capture.
+
+    Args:
+        path: btsnoop file recorded by HCISock.start_capture().
+        speed: Factor the recorded timing is accelerated by, or None to
+            release received packets as soon as they are due.
+        strict: If False, commands are only checked by opcode and ACL data
+            by header, for procedures sending random parameters.
+        timeout: Time in seconds the player waits for a packet of the host
+            before failing the replay.
+        index: Index sidecar of the capture; see BtsnoopReader.
+
+    Attributes:
+        error: ReplayError of a failed replay, or None.
+        num_sent: Number of packets sent by the host and checked.
+        num_received: Number of packets released to the host.
+        elapsed: Time in seconds of the replay so far.
+    """
+
+    def __init__(self, path, speed=1.0, strict=True, timeout=10.0,
+                 index=None):
+        super(ReplayTransport, self).__init__()
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+        self.path = path
+        self.speed = speed
+        self.strict = strict
+        self.timeout = timeout
+        self.error = None
+        self.num_sent = 0
+        self.num_received = 0
+        self._closed = False
+        self._start = None
+        self._end = None
+        self._reader = BtsnoopReader(path, index)
+        self._host, self._ctl = socket.socketpair(socket.AF_UNIX,
+                                                  socket.SOCK_SEQPACKET)
+        self._ctl.settimeout(timeout)
+        self._thread = threading.Thread(target=self._run,
+                                        name='ReplayTransport')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        return 'replay:{}'.format(self.path)
+
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0.0
+        return (monotonic() if self._end is None else self._end) - self._start
+
+    def fileno(self):
+        return self._host.fileno()
+
+    def send(self, pkt):
+        try:
+            return self._host.send(pkt)
+        except socket.error:
+            raise self._stopped_error()
+
+    def recv(self, bufsize):
+        buf = self._host.recv(bufsize)
+        if not buf:
+            raise self._stopped_error()
+        return buf
+
+    def _stopped_error(self):
+        if self.error is not None:
+            return self.error
+        return ReplayError('{}: replay stopped'.format(self))
+
+    def close(self):
+        """Stop the replay and close the transport."""
+        self._closed = True
+        try:
+            self._host.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._host.close()
+        self._thread.join()
+
+    def wait(self, timeout=None):
+        """Wait for the end of the replay.
+
+        Raises:
+            ReplayError: Raised if the replay failed or did not end within
+                timeout seconds.
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise ReplayError('{}: replay not ended'.format(self))
+        if self.error is not None:
+            raise self.error
+
+    def _fail(self, msg):
+        self.error = ReplayError('{}: {}'.format(self, msg))
+        self.log.error('%s', self.error.msg)
+
+    def _run(self):
+        reader = self._reader
+        ctl = self._ctl
+        speed = self.speed
+        self._start = monotonic()
+        # The recorded and real times of the last packet sent or released
+        last_ts = reader.timestamp(0) if len(reader) else 0.0
+        last_t = self._start
+        try:
+            for rec in reader:
+                pkt = str(rec.pkt)
+                if rec.direction == DIR_SENT:
+                    try:
+                        sent = ctl.recv(_MAX_PKT_SIZE)
+                    except socket.timeout:
+                        self._fail('#{}: no packet sent in {} s, expected '
+                                   '{}'.format(rec.num, self.timeout,
+                                               _describe(pkt)))
+                        return
+                    if not sent:
+                        # Closed by the host
+                        return
+                    if not _same_pkt(sent, pkt, self.strict):
+                        self._fail('#{}: sent {}, expected {}'.format(
+                            rec.num, _describe(sent), _describe(pkt)))
+                        return
+                    self.num_sent += 1
+                    last_ts = rec.timestamp
+                    last_t = monotonic()
+                else:
+                    if speed is not None:
+                        last_t += max(rec.timestamp - last_ts, 0.0) / speed
+                        last_ts = rec.timestamp
+                        delay = last_t - monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                    ctl.send(pkt)
+                    self.num_received += 1
+        except socket.error as err:
+            if self.error is None and not self._closed:
+                self._fail('transport: {}'.format(err))
+        finally:
+            self._end = monotonic()
+            # Shut down rather than close: workers forked by bluetest hold
+            # copies of the socket.
+            try:
+                ctl.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            ctl.close()
+            reader.close()
+            self.log.info('%s: %d sent, %d received in %.3f s', self,
+                          self.num_sent, self.num_received, self.elapsed)
@@ -0,0 +1,359 @@
+"""High-rate LE scanner streaming reports to disk.
+
+LEScanner writes every legacy or extended advertising report to an
+append-only binary file instead of keeping reports in memory, so a scan can
+run for hours with flat memory. The file consists of a header followed by
+records:
+
+    time (double), evt_type (u16), addr_type (u8), addr (6 bytes),
+    rssi (s8), primary_phy (u8), secondary_phy (u8), adv_sid (u8),
+    tx_power (s8), data_len (u16), data (data_len bytes)
+
+Extended reports are recorded fragment by fragment as received; the data
+status is kept in evt_type. Use read_scan_file() or export_jsonl() to read a
+file back.
+"""
+import binascii
+import json
+import math
+import os
+import struct
+
+from . import bluez
+from . import command as btcmd
+from . import event as btevt
+from .adv import DATA_STATUS_COMPLETE, ext_adv_data_status
+from .clock import Deadline, get_clock
+from .core import LEHelper
+from .error import HCITimeoutError
+
+SCAN_FILE_MAGIC = 'BTSCAN\x00\x01'
+
+_record = struct.Struct('<dHB6sbBBBbH')
+
+# Values recorded for fields legacy reports do not have
+_LEGACY_PHY = 1
+_NO_SID = 0xFF
+_NO_TX_POWER = 127
+
+# Flag set in evt_type of legacy reports, as in extended reports
+_EVT_TYPE_LEGACY = 0x10
+
+PHY_LE_1M = 0x01
+PHY_LE_CODED = 0x04
+
+
+class ScanRecord(object):
+    """Report read from a scan file."""
+
+    __slots__ = ('time', 'evt_type', 'addr_type', 'addr', 'rssi',
+                 'primary_phy', 'secondary_phy', 'adv_sid', 'tx_power',
+                 'data')
+
+    def to_dict(self):
+        return {
+            'time': self.time,
+            'evt_type': self.evt_type,
+            'addr_type': self.addr_type,
+            'addr': bluez.ba2str(self.addr),
+            'rssi': self.rssi,
+            'primary_phy': self.primary_phy,
+            'secondary_phy': self.secondary_phy,
+            'adv_sid': self.adv_sid,
+            'tx_power': self.tx_power,
+            'data': binascii.hexlify(self.data),
+        }
+
+
+def read_scan_file(path):
+    """Iterate over the ScanRecords of a scan file.
+
+    A truncated last record, e.g. of a scan that was killed, is ignored.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(SCAN_FILE_MAGIC)) != SCAN_FILE_MAGIC:
+            raise ValueError('not a scan file: {}'.format(path))
+        while True:
+            hdr = f.read(_record.size)
+            if len(hdr) < _record.size:
+                return
+            rec = ScanRecord()
+            (rec.time, rec.evt_type, rec.addr_type, rec.addr, rec.rssi,
+             rec.primary_phy, rec.secondary_phy, rec.adv_sid, rec.tx_power,
+             data_len) = _record.unpack(hdr)
+            rec.data = f.read(data_len)
+            if len(rec.data) < data_len:
+                return
+            yield rec
+
+
+def export_jsonl(path, out_path):
+    """Export a scan file as JSON lines.
+
+    Returns:
+        int: Number of records exported.
+    """
+    n = 0
+    with open(out_path, 'w') as out:
+        for rec in read_scan_file(path):
+            out.write(json.dumps(rec.to_dict(), sort_keys=True))
+            out.write('\n')
+            n += 1
+    return n
+
+
+class UniqueCounter(object):
+    """Count distinct keys in bounded memory.
+
+    Keys are counted exactly up to max_exact distinct keys. Beyond that,
+    linear counting over a bitmap of num_bits bits is used; its estimate
+    assumes well-spread hashes, as for random addresses, and is accurate to
+    about 1% up to several times num_bits distinct keys.
+    """
+
+    def __init__(self, num_bits=1 << 20, max_exact=1 << 16):
+        super(UniqueCounter, self).__init__()
+        self.num_bits = num_bits
+        self.max_exact = max_exact
+        self.exact = set()
+        self.bitmap = None
+        self.num_set = 0
+
+    def _set_bit(self, key):
+        h = hash(key) % self.num_bits
+        byte = self.bitmap[h >> 3]
+        mask = 1 << (h & 7)
+        if not byte & mask:
+            self.bitmap[h >> 3] = byte | mask
+            self.num_set += 1
+
+    def add(self, key):
+        if self.bitmap is not None:
+            self._set_bit(key)
+            return
+        self.exact.add(key)
+        if len(self.exact) > self.max_exact:
+            self.bitmap = bytearray(self.num_bits >> 3)
+            for k in self.exact:
+                self._set_bit(k)
+            self.exact = None
+
+    def estimate(self):
+        if self.bitmap is None:
+            return len(self.exact)
+        num_zero = self.num_bits - self.num_set
+        if num_zero == 0:
+            return self.num_set
+        return int(round(-self.num_bits * math.log(
+            float(num_zero) / self.num_bits)))
+
+
+class ScanStats(object):
+    """Live counters of LEScanner.
+
+    Attributes:
+        num_reports: Number of reports recorded.
+        num_complete: Number of reports completing an advertisement.
+        num_bytes: Number of bytes written.
+        rate: Reports per second in the last stats interval.
+        elapsed: Time in seconds since the scan started.
+    """
+
+    def __init__(self):
+        super(ScanStats, self).__init__()
+        self.num_reports = 0
+        self.num_complete = 0
+        self.num_bytes = 0
+        self.rate = 0.0
+        self.elapsed = 0.0
+        self.unique = UniqueCounter()
+
+    @property
+    def unique_devices(self):
+        return self.unique.estimate()
+
+    def __str__(self):
+        return ('{} reports ({:.0f}/s), ~{} devices, {} bytes in '
+                '{:.1f} s').format(self.num_reports, self.rate,
+                                   self.unique_devices, self.num_bytes,
+                                   self.elapsed)
+
+
+class LEScanner(LEHelper):
+    """LE scanner streaming every report to a scan file.
+
+    Args:
+        hci_sock: HCISock of the scanner.
+        path: Scan file; records are appended if it exists.
+        extended: Use extended scanning commands and reports.
+        flush_size: Bytes of records buffered before a write.
+        flush_intvl: Maximum time in seconds records stay buffered.
+        stats_intvl: Interval in seconds of on_stats callbacks.
+    """
+
+    def __init__(self, hci_sock, path, extended=False, flush_size=1 << 16,
+                 flush_intvl=1.0, stats_intvl=1.0):
+        super(LEScanner, self).__init__(hci_sock)
+        self.path = path
+        self.extended = extended
+        self.flush_size = flush_size
+        self.flush_intvl = flush_intvl
+        self.stats_intvl = stats_intvl
+        self.stats = ScanStats()
+        self._batch = []
+        self._batch_size = 0
+
+    def configure(self, scan_type=1, scan_intvl=0x10, scan_window=0x10,
+                  phys=None, own_addr_type=0, scan_filter_policy=0):
+        """Set scan parameters.
+
+        Args:
+            scan_type, scan_intvl, scan_window: Parameters of legacy
+                scanning, or of LE 1M PHY if phys is None.
+            phys: Dict of (scan_type, scan_intvl, scan_window) keyed by
+                PHY_LE_1M and PHY_LE_CODED for extended scanning.
+        """
+        if not self.extended:
+            self.set_scan_parameters(scan_type, scan_intvl, scan_window,
+                                     own_addr_type, scan_filter_policy)
+            return
+        if phys is None:
+            phys = {PHY_LE_1M: (scan_type, scan_intvl, scan_window)}
+        scan_phys = 0
+        args = []
+        for phy in sorted(phys):
+            scan_phys |= phy
+            args.extend(phys[phy])
+        self.set_ext_scan_parameters(own_addr_type, scan_filter_policy,
+                                     scan_phys, *args)
+
+    def _flush(self, f):
+        if self._batch:
+            f.write(''.join(self._batch))
+            self.stats.num_bytes += self._batch_size
+            self._batch = []
+            self._batch_size = 0
+
+    def _record_legacy(self, evt, now):
+        stats = self.stats
+        batch = self._batch
+        for i in xrange(0, evt.num_reports):
+            data = evt.data[i]
+            addr_type = evt.addr_type[i]
+            addr = evt.addr[i]
+            batch.append(_record.pack(
+                now, evt.evt_type[i] | _EVT_TYPE_LEGACY, addr_type, addr,
+                evt.rssi[i], _LEGACY_PHY, 0, _NO_SID, _NO_TX_POWER,
+                len(data)))
+            batch.append(data)
+            self._batch_size += _record.size + len(data)
+            stats.unique.add((addr_type, addr))
+        stats.num_reports += evt.num_reports
+        stats.num_complete += evt.num_reports
+
+    def _record_ext(self, evt, now):
+        stats = self.stats
+        batch = self._batch
+        for i in xrange(0, evt.num_reports):
+            data = evt.data[i]
+            addr_type = evt.addr_type[i]
+            addr = evt.addr[i]
+            evt_type = evt.evt_type[i]
+            batch.append(_record.pack(
+                now, evt_type, addr_type, addr, evt.rssi[i],
+                evt.primary_phy[i], evt.secondary_phy[i], evt.adv_sid[i],
+                evt.tx_power[i], len(data)))
+            batch.append(data)
+            self._batch_size += _record.size + len(data)
+            stats.unique.add((addr_type, addr))
+            if ext_adv_data_status(evt_type) == DATA_STATUS_COMPLETE:
+                stats.num_complete += 1
+        stats.num_reports += evt.num_reports
+
+    def _process(self, evt, now):
+        # Return True if evt is an advertising report.
+        if evt.__class__ is btevt.LEAdvertisingReportEvent:
+            self._record_legacy(evt, now)
+        elif evt.__class__ is btevt.LEExtendedAdvertisingReportEvent:
+            self._record_ext(evt, now)
+        else:
+            return False
+        return True
+
+    def _stop(self, f, deadline):
+        if self.extended:
+            cmd = btcmd.HCILESetExtendedScanEnable(0, 0, 0, 0)
+        else:
+            cmd = btcmd.HCILESetScanEnable(0, 0)
+        clock = get_clock()
+        self._disable_scan(cmd, lambda evt: self._process(evt, clock.time()),
+                           deadline)
+        self._flush(f)
+
+    def run(self, duration=None, filter_duplicate=0, scan_duration=0,
+            scan_period=0, on_stats=None, stop_timeout=5):
+        """Scan and record reports.
+
+        Args:
+            duration: Time in seconds to scan, or None to scan until an
+                extended scan ends by scan_duration.
+            filter_duplicate: Filter duplicates in the controller.
+            scan_duration, scan_period: Duration (10 ms units) and period
+                (1.28 s units) of extended scanning.
+            on_stats: Function called with ScanStats every stats interval.
+            stop_timeout: Maximum time in seconds to disable scanning at the
+                end, or a Deadline.
+
+        Returns:
+            ScanStats: The counters at the end of the scan.
+
+        Raises:
+            HCITimeoutError: Raised if scanning is not disabled in time.
+        """
+        is_new = not os.path.exists(self.path) or (
+            os.path.getsize(self.path) == 0)
+        with open(self.path, 'ab') as f:
+            if is_new:
+                f.write(SCAN_FILE_MAGIC)
+            start = get_clock().time()
+            deadline = Deadline(duration)
+            if self.extended:
+                self.start_ext_scan(filter_duplicate, scan_duration,
+                                    scan_period)
+            else:
+                self.start_scan(filter_duplicate)
+            stats = self.stats
+            next_flush = start + self.flush_intvl
+            next_stats = start + self.stats_intvl
+            last_reports = stats.num_reports
+            last_stats = start
+            try:
+                while True:
+                    try:
+                        evt = self.recv_hci_evt(deadline)
+                        now = get_clock().time()
+                    except HCITimeoutError:
+                        break
+                    if (not self._process(evt, now)
+                            and evt.__class__ is btevt.LEScanTimeoutEvent):
+                        if scan_period == 0:
+                            break
+                    if (self._batch_size >= self.flush_size
+                            or now >= next_flush):
+                        self._flush(f)
+                        next_flush = now + self.flush_intvl
+                    if now >= next_stats:
+                        stats.rate = ((stats.num_reports - last_reports)
+                                      / (now - last_stats))
+                        stats.elapsed = now - start
+                        last_reports = stats.num_reports
+                        last_stats = now
+                        next_stats = now + self.stats_intvl
+                        if on_stats is not None:
+                            on_stats(stats)
+            finally:
+                self._flush(f)
+                self._stop(f, Deadline.from_timeout(stop_timeout))
+            stats.elapsed = get_clock().time() - start
+        self.log.info('%s: %s', self.path, stats)
+        return stats
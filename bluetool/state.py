@@ -0,0 +1,290 @@
+"""Host-side mirror of controller state.
+
+ControllerState is updated by HCISock from every command sent and every event
+parsed, so the state of a controller can be queried without another HCI
+round trip. The mirror is only complete after a reset of the controller has
+been observed; see ControllerState.synced.
+"""
+import collections
+
+from . import bluez
+from . import command as btcmd
+from . import event as btevt
+
+
+# Event masks in effect after HCI_Reset.
+DEFAULT_EVT_MASK = 0x00001FFFFFFFFFFFL
+DEFAULT_LE_EVT_MASK = 0x1FL
+
+LINK_TYPE_BREDR = 0
+LINK_TYPE_LE = 1
+
+ROLE_MASTER = 0
+ROLE_SLAVE = 1
+
+
+class LinkState(object):
+    """State of a connection.
+
+    Attributes:
+        conn_handle: Connection handle.
+        link_type: LINK_TYPE_BREDR or LINK_TYPE_LE.
+        role: ROLE_MASTER or ROLE_SLAVE.
+        peer_addr_type: Peer address type, or None for BR/EDR links.
+        peer_addr: Peer address.
+        conn_intvl, conn_latency, supv_timeout: Connection parameters of LE
+            links.
+        max_tx_octets, max_tx_time, max_rx_octets, max_rx_time: Data length
+            of LE links, or None until a data length change is reported.
+    """
+
+    def __init__(self, conn_handle, link_type, role, peer_addr_type,
+                 peer_addr):
+        super(LinkState, self).__init__()
+        self.conn_handle = conn_handle
+        self.link_type = link_type
+        self.role = role
+        self.peer_addr_type = peer_addr_type
+        self.peer_addr = peer_addr
+        self.conn_intvl = None
+        self.conn_latency = None
+        self.supv_timeout = None
+        self.max_tx_octets = None
+        self.max_tx_time = None
+        self.max_rx_octets = None
+        self.max_rx_time = None
+
+    def __str__(self):
+        return '{}(0x{:04x}, {})'.format(
+            self.__class__.__name__, self.conn_handle,
+            bluez.ba2str(self.peer_addr))
+
+
+class ControllerState(object):
+    """Mirror of the state of a controller.
+
+    Attributes:
+        synced: True if a reset has been observed, so that the mirror
+            reflects the whole state of the controller.
+        links: Dict of LinkState of open connections keyed by handle.
+        white_list: Set of (addr_type, addr) in the white list.
+        evt_mask: Event mask.
+        le_evt_mask: LE event mask.
+        scan_enable: BR/EDR scan enable.
+        adv_enabled: True if legacy advertising is enabled.
+        ext_adv_enabled: Set of handles of enabled advertising sets.
+        le_scan_enabled: True if LE scanning is enabled.
+    """
+
+    def __init__(self):
+        super(ControllerState, self).__init__()
+        self.synced = False
+        self._pending_cmds = {}
+        self._clear()
+
+    def _clear(self):
+        self.links = {}
+        self.white_list = set()
+        self.evt_mask = DEFAULT_EVT_MASK
+        self.le_evt_mask = DEFAULT_LE_EVT_MASK
+        self.scan_enable = 0
+        self.adv_enabled = False
+        self.ext_adv_enabled = set()
+        self.le_scan_enabled = False
+
+    def is_connected(self, conn_handle):
+        return conn_handle in self.links
+
+    def get_link(self, conn_handle):
+        """Return the LinkState of conn_handle, or None if not connected."""
+        return self.links.get(conn_handle)
+
+    def in_white_list(self, addr_type, addr):
+        return (addr_type, addr) in self.white_list
+
+    def is_white_list_empty(self):
+        """Return True only if the white list is known to be empty."""
+        return self.synced and not self.white_list
+
+    def cmd_sent(self, cmd):
+        """Record cmd so that its effect is applied on command complete.
+
+        Commands with the same opcode may be pipelined; they complete in the
+        order they are sent.
+        """
+        self._pending_cmds.setdefault(
+            cmd.opcode(), collections.deque()).append(cmd)
+
+    def cmd_lost(self, cmd):
+        """Forget cmd, whose command complete or status was not received.
+
+        Otherwise the next event of the same opcode would be taken for the
+        completion of cmd and apply its effect.
+        """
+        cmds = self._pending_cmds.get(cmd.opcode())
+        if not cmds:
+            return
+        for i, pending_cmd in enumerate(cmds):
+            if pending_cmd is cmd:
+                del cmds[i]
+                break
+        if not cmds:
+            del self._pending_cmds[cmd.opcode()]
+
+    def _pop_pending_cmd(self, opcode):
+        cmds = self._pending_cmds.get(opcode)
+        if not cmds:
+            return None
+        cmd = cmds.popleft()
+        if not cmds:
+            del self._pending_cmds[opcode]
+        return cmd
+
+    def update(self, evt):
+        """Update the state from a received event."""
+        handler = _evt_handlers.get(evt.__class__)
+        if handler is not None:
+            handler(self, evt)
+
+    def _on_cmd_complete(self, evt):
+        cmd = self._pop_pending_cmd(evt.cmd_opcode)
+        if cmd is None or getattr(evt, 'status', 0) != 0:
+            return
+        handler = _cmd_handlers.get(cmd.__class__)
+        if handler is not None:
+            handler(self, cmd)
+
+    def _on_cmd_status(self, evt):
+        self._pop_pending_cmd(evt.cmd_opcode)
+
+    def _on_reset(self, cmd):
+        # Commands sent before the reset will not complete.
+        self._pending_cmds.clear()
+        self._clear()
+        self.synced = True
+
+    def _on_set_evt_mask(self, cmd):
+        self.evt_mask = cmd.event_mask
+
+    def _on_le_set_evt_mask(self, cmd):
+        self.le_evt_mask = cmd.le_evt_mask
+
+    def _on_write_scan_enable(self, cmd):
+        self.scan_enable = cmd.scan_enable
+
+    def _on_set_adv_enable(self, cmd):
+        self.adv_enabled = bool(cmd.adv_enable)
+
+    def _on_set_ext_adv_enable(self, cmd):
+        handles = set(o.adv_handle for o in cmd.adv_set)
+        if cmd.enable:
+            self.ext_adv_enabled |= handles
+        elif cmd.num_sets == 0:
+            self.ext_adv_enabled.clear()
+        else:
+            self.ext_adv_enabled -= handles
+
+    def _on_remove_adv_set(self, cmd):
+        self.ext_adv_enabled.discard(cmd.adv_handle)
+
+    def _on_clear_adv_sets(self, cmd):
+        self.ext_adv_enabled.clear()
+
+    def _on_set_scan_enable(self, cmd):
+        self.le_scan_enabled = bool(cmd.enable)
+
+    def _on_clear_white_list(self, cmd):
+        self.white_list.clear()
+
+    def _on_add_to_white_list(self, cmd):
+        self.white_list.add((cmd.addr_type, cmd.addr))
+
+    def _on_remove_from_white_list(self, cmd):
+        self.white_list.discard((cmd.addr_type, cmd.addr))
+
+    def _on_conn_complete(self, evt):
+        if evt.status != 0:
+            return
+        # The role may be changed later by RoleChangeEvent.
+        self.links[evt.conn_handle] = LinkState(
+            evt.conn_handle, LINK_TYPE_BREDR, None, None, evt.bd_addr)
+
+    def _on_role_change(self, evt):
+        if evt.status != 0:
+            return
+        for link in self.links.itervalues():
+            if (link.link_type == LINK_TYPE_BREDR
+                    and link.peer_addr == evt.bd_addr):
+                link.role = evt.new_role
+
+    def _on_disconn_complete(self, evt):
+        if evt.status == 0:
+            self.links.pop(evt.conn_handle, None)
+
+    def _on_le_conn_complete(self, evt):
+        if evt.status != 0:
+            return
+        link = LinkState(evt.conn_handle, LINK_TYPE_LE, evt.role,
+                         evt.peer_addr_type, evt.peer_addr)
+        link.conn_intvl = evt.conn_intvl
+        link.conn_latency = evt.conn_latency
+        link.supv_timeout = evt.supv_timeout
+        self.links[evt.conn_handle] = link
+        if evt.role == ROLE_SLAVE:
+            # Legacy advertising stops once a connection is created.
+            self.adv_enabled = False
+
+    def _on_le_conn_update_complete(self, evt):
+        link = self.links.get(evt.conn_handle)
+        if evt.status != 0 or link is None:
+            return
+        link.conn_intvl = evt.conn_intvl
+        link.conn_latency = evt.conn_latency
+        link.supv_timeout = evt.supv_timeout
+
+    def _on_adv_set_terminated(self, evt):
+        self.ext_adv_enabled.discard(evt.adv_handle)
+
+    def _on_le_data_len_change(self, evt):
+        link = self.links.get(evt.conn_handle)
+        if link is None:
+            return
+        link.max_tx_octets = evt.max_tx_octets
+        link.max_tx_time = evt.max_tx_time
+        link.max_rx_octets = evt.max_rx_octets
+        link.max_rx_time = evt.max_rx_time
+
+
+_evt_handlers = {
+    btevt.CommandCompleteEvent: ControllerState._on_cmd_complete,
+    btevt.CommandStatusEvent: ControllerState._on_cmd_status,
+    btevt.ConnectionCompleteEvent: ControllerState._on_conn_complete,
+    btevt.RoleChangeEvent: ControllerState._on_role_change,
+    btevt.DisconnectionCompleteEvent: ControllerState._on_disconn_complete,
+    btevt.LEConnectionCompleteEvent: ControllerState._on_le_conn_complete,
+    btevt.LEEnhancedConnectionCompleteEvent:
+        ControllerState._on_le_conn_complete,
+    btevt.LEConnectionUpdateCompleteEvent:
+        ControllerState._on_le_conn_update_complete,
+    btevt.LEDataLengthChangeEvent: ControllerState._on_le_data_len_change,
+    btevt.LEAdvertisingSetTerminatedEvent:
+        ControllerState._on_adv_set_terminated,
+}
+
+_cmd_handlers = {
+    btcmd.HCIReset: ControllerState._on_reset,
+    btcmd.HCISetEventMask: ControllerState._on_set_evt_mask,
+    btcmd.HCILESetEventMask: ControllerState._on_le_set_evt_mask,
+    btcmd.HCIWriteScanEnable: ControllerState._on_write_scan_enable,
+    btcmd.HCILESetAdvertiseEnable: ControllerState._on_set_adv_enable,
+    btcmd.HCILESetExtendedAdvertisingEnable:
+        ControllerState._on_set_ext_adv_enable,
+    btcmd.HCILERemoveAdvertisingSet: ControllerState._on_remove_adv_set,
+    btcmd.HCILEClearAdvertisingSets: ControllerState._on_clear_adv_sets,
+    btcmd.HCILESetScanEnable: ControllerState._on_set_scan_enable,
+    btcmd.HCILESetExtendedScanEnable: ControllerState._on_set_scan_enable,
+    btcmd.HCILEClearWhiteList: ControllerState._on_clear_white_list,
+    btcmd.HCILEAddDeviceToWhiteList: ControllerState._on_add_to_white_list,
+    btcmd.HCILERemoveDeviceFromWhiteList:
+        ControllerState._on_remove_from_white_list,
+}
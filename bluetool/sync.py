@@ -0,0 +1,137 @@
+"""Synchronization primitives shared by coordinator and workers.
+
+The primitives keep their state in shared memory and sleep on semaphores,
+which are futex based on Linux, so a lock-step handshake costs a few
+microseconds instead of a pipe round trip. They must be created before the
+worker processes are started; see HCICoordinator.add_barrier() and
+HCICoordinator.add_counter(). Their waits follow the clock of bluetool.clock.
+"""
+import ctypes
+import multiprocessing as mp
+
+from .clock import Deadline, notify, wait_ready
+from .error import HCITimeoutError
+
+
+class SharedCounter(object):
+    """Monotonically increasing counter in shared memory.
+
+    A counter can be used as a sequence number: one side increments it for
+    every step done and the other side waits until it reaches a value.
+    """
+
+    def __init__(self, value=0):
+        super(SharedCounter, self).__init__()
+        self._value = mp.RawValue(ctypes.c_ulonglong, value)
+        self._cond = mp.Condition(mp.Lock())
+
+    @property
+    def value(self):
+        return self._value.value
+
+    def increment(self, n=1):
+        """Add n to the counter and wake up waiters.
+
+        Returns:
+            int: The new value of the counter.
+        """
+        with self._cond:
+            self._value.value += n
+            value = self._value.value
+            self._cond.notify_all()
+        notify(id(self))
+        return value
+
+    def wait_ge(self, value, timeout=None):
+        """Wait until the counter is greater than or equal to value.
+
+        Args:
+            value: Value to wait for.
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+
+        Returns:
+            int: The value of the counter.
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs.
+        """
+        cur_value = self._value.value
+        if cur_value >= value:
+            return cur_value
+        if not wait_ready(lambda timeout: self._wait_ge(value, timeout),
+                          timeout, id(self)):
+            raise HCITimeoutError
+        return self._value.value
+
+    def _wait_ge(self, value, timeout):
+        deadline = Deadline(timeout)
+        with self._cond:
+            while self._value.value < value:
+                remaining = deadline.remaining()
+                if remaining == 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+
+class SharedBarrier(object):
+    """Barrier for a fixed number of parties in shared memory.
+
+    The barrier is reusable: once all parties arrived, it is reset for the
+    next round.
+    """
+
+    def __init__(self, parties):
+        super(SharedBarrier, self).__init__()
+        self.parties = parties
+        self._count = mp.RawValue(ctypes.c_uint, 0)
+        self._generation = mp.RawValue(ctypes.c_ulonglong, 0)
+        self._cond = mp.Condition(mp.Lock())
+
+    def wait(self, timeout=None):
+        """Wait until all parties arrive at the barrier.
+
+        Args:
+            timeout: Maximum time in seconds to block, or a Deadline. If
+                timeout is None, then an infinite timeout is used.
+
+        Returns:
+            int: Arrival index of the caller in range(parties).
+
+        Raises:
+            HCITimeoutError: Raised if timeout occurs. The caller is
+                withdrawn from the barrier in this case.
+        """
+        deadline = Deadline.from_timeout(timeout)
+        with self._cond:
+            generation = self._generation.value
+            index = self._count.value
+            self._count.value += 1
+            last = self._count.value == self.parties
+            if last:
+                self._count.value = 0
+                self._generation.value += 1
+                self._cond.notify_all()
+        if last:
+            notify(id(self))
+            return index
+        if wait_ready(lambda timeout: self._wait_gen(generation, timeout),
+                      deadline, id(self)):
+            return index
+        with self._cond:
+            if self._generation.value != generation:
+                # The last party arrived meanwhile.
+                return index
+            self._count.value -= 1
+        raise HCITimeoutError
+
+    def _wait_gen(self, generation, timeout):
+        deadline = Deadline(timeout)
+        with self._cond:
+            while self._generation.value == generation:
+                remaining = deadline.remaining()
+                if remaining == 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
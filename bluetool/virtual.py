@@ -0,0 +1,1464 @@
+"""Virtual HCI controllers.
+
+VirtualController is a software LE controller standing in for a Bluetooth
+dongle. It is a transport of HCISock, so procedures and bluetest workers run
+without hardware:
+
+    medium = VirtualMedium()
+    hci_sock = HCISock(medium.add_controller())
+
+Controllers added to the same VirtualMedium see each other's advertising and
+can connect and exchange ACL data. All controllers of a medium are run by a
+single thread of the process adding them; for a bluetest configuration, the
+controllers are listed in the 'device' entry and keep running in the
+coordinator after workers are forked.
+
+Data is exchanged in connection events: every connection interval, the
+master and the slave exchange PDUs of at most their maximum transmit octets
+until both are empty, the event length is used up, or an exchange is lost.
+The radio time of a controller is shared by its links, so that a master of
+many links serves fewer PDUs per link and events colliding with an earlier
+one are shortened or skipped. LinkConditions set the loss, latency,
+throughput limit and event length of links. Idle links have no events run,
+so a medium of hundreds of controllers costs only their traffic.
+
+The medium follows the clock set with bluetool.clock.set_clock() when it is
+created. With a VirtualClock, set before the medium, the thread of the
+medium takes part in virtual time and the controllers notify their hosts,
+so that a test jumps over the time its controllers and hosts are idle.
+
+The controllers implement Reset, the event masks, local version, commands and
+features, BD_ADDR, LE buffer size, white list, legacy advertising, scanning
+and initiating, Disconnect, Connection Update, data length, encryption with
+the LTK of the host, and ACL data with credits returned by Number Of
+Completed Packets events. Extended advertising and scanning commands are
+accepted, so that mixing them with legacy commands is disallowed as by real
+controllers, but have no effect on the medium. Other commands complete with
+Unknown HCI Command.
+"""
+import atexit
+import collections
+import ctypes
+import errno
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing as mp
+import os
+import random
+import select
+import socket
+import struct
+import threading
+
+from . import bluez
+from . import command as btcmd
+from .clock import Deadline, get_clock, timeout_ms
+from .state import DEFAULT_EVT_MASK, DEFAULT_LE_EVT_MASK
+
+# Status codes
+STATUS_SUCCESS = 0x00
+STATUS_UNKNOWN_CMD = 0x01
+STATUS_UNKNOWN_CONN_ID = 0x02
+STATUS_KEY_MISSING = 0x06
+STATUS_MEM_CAPACITY_EXCEEDED = 0x07
+STATUS_CONN_TIMEOUT = 0x08
+STATUS_CMD_DISALLOWED = 0x0C
+STATUS_INVALID_PARAM = 0x12
+STATUS_LOCAL_HOST_TERM = 0x16
+STATUS_ADV_TIMEOUT = 0x3C
+STATUS_MIC_FAILURE = 0x3D
+
+# Legacy advertising types
+ADV_IND = 0x00
+ADV_DIRECT_IND_HIGH = 0x01
+ADV_SCAN_IND = 0x02
+ADV_NONCONN_IND = 0x03
+ADV_DIRECT_IND_LOW = 0x04
+
+# Advertising report event type of each advertising type, and of scan
+# responses
+_report_evt_type = {
+    ADV_IND: 0x00,
+    ADV_DIRECT_IND_HIGH: 0x01,
+    ADV_SCAN_IND: 0x02,
+    ADV_NONCONN_IND: 0x03,
+    ADV_DIRECT_IND_LOW: 0x01,
+}
+_REPORT_SCAN_RSP = 0x04
+
+_CONNECTABLE = frozenset((ADV_IND, ADV_DIRECT_IND_HIGH, ADV_DIRECT_IND_LOW))
+_SCANNABLE = frozenset((ADV_IND, ADV_SCAN_IND))
+_DIRECTED = frozenset((ADV_DIRECT_IND_HIGH, ADV_DIRECT_IND_LOW))
+
+# Advertising interval and duration of high duty cycle directed advertising
+_HIGH_DUTY_INTVL = 3.75e-3
+_HIGH_DUTY_TIMEOUT = 1.28
+
+# Maximum of the random advDelay added to each advertising interval
+_ADV_DELAY_MAX = 10e-3
+
+# Inter frame space in microseconds
+_T_IFS = 150
+
+# Connection events from a Connection Update to its instant
+_UPDATE_INSTANT = 6
+
+# Transmit window offset of new connections, before a random part of the
+# connection interval
+_TRANSMIT_WINDOW_DELAY = 1.25e-3
+
+VERSION = (0x09, 0x0000, 0x09, 0xFFFF, 0x0000)
+LMP_FEATURES = '\x00\x00\x00\x00\x60\x00\x00\x00'  # LE, no BR/EDR
+LE_FEATURES = 0x21  # encryption, data length extension
+MAX_OCTETS = 251
+MIN_OCTETS = 27
+
+# Advertising reports queued for a host not reading its socket are dropped
+# beyond this many packets.
+MAX_BACKLOG = 1024
+
+# Vendor command of the controllers used by test/ts, setting the maximum
+# number of octets received per data channel PDU
+OCF_VENDOR_WRITE_LOCAL_MAX_RX_OCTETS = 0x85
+
+
+def octets_time(octets):
+    """Return the time in microseconds of a PDU of octets on LE 1M PHY."""
+    # 14 = 1(Preamble) + 4(Access Code) + 2(PDU Header) + 4(MIC) + 3(CRC)
+    return (octets + 14) * 8
+
+
+def random_addr(rng):
+    return ''.join(chr(rng.randint(0, 255)) for _ in xrange(0, 6))
+
+
+class _Timer(object):
+    __slots__ = ('expiry', 'fn', 'args', 'cancelled')
+
+    def __init__(self, expiry, fn, args):
+        self.expiry = expiry
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class LinkConditions(object):
+    """Radio conditions of connections.
+
+    Args:
+        loss: Probability an exchange of PDUs in a connection event is lost.
+            A lost exchange closes the event and its PDUs are sent again in
+            the next one; a link without a successful exchange for its
+            supervision timeout is disconnected with Connection Timeout.
+        latency: Time in seconds added to the delivery of received ACL data
+            to the host.
+        max_rate: Maximum throughput in octets per second in each direction
+            of a link, or None.
+        ce_len: Maximum length in seconds of connection events, or None for
+            the connection interval.
+    """
+
+    def __init__(self, loss=0.0, latency=0.0, max_rate=None, ce_len=None):
+        super(LinkConditions, self).__init__()
+        if not 0.0 <= loss < 1.0:
+            raise ValueError('loss out of range: {}'.format(loss))
+        self.loss = loss
+        self.latency = latency
+        self.max_rate = max_rate
+        self.ce_len = ce_len
+
+    def __str__(self):
+        return ('{}(loss={}, latency={}, max_rate={}, ce_len={})'.format(
+            self.__class__.__name__, self.loss, self.latency, self.max_rate,
+            self.ce_len))
+
+
+class VirtualMedium(object):
+    """Radio medium shared by virtual controllers.
+
+    Advertising is delivered at each advertising event and connections are
+    established at once; data is exchanged in connection events.
+
+    Args:
+        seed: Seed of addresses, advertising delays, connection anchors and
+            losses, for reproducible runs.
+        speed: Factor all intervals and timeouts of the controllers are
+            accelerated by.
+        conditions: Default LinkConditions of connections; see
+            set_conditions().
+    """
+
+    def __init__(self, seed=0, speed=1.0, conditions=None):
+        super(VirtualMedium, self).__init__()
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+        self.rng = random.Random(seed)
+        self._addr_rng = random.Random(seed)
+        self.speed = float(speed)
+        self.conditions = (LinkConditions() if conditions is None
+                           else conditions)
+        self._link_conditions = {}
+        self.controllers = []
+        # Controllers scanning or initiating, in the order they started
+        self._listeners = collections.OrderedDict()
+        self._fds = {}
+        self._timers = []
+        self._seq = itertools.count()
+        self._completed = set()
+        self._lock = threading.Lock()
+        self._calls = collections.deque()
+        # Controllers which sent packets to their host since the clock was
+        # last notified
+        self._notified = set()
+        self.clock = get_clock()
+        self.clock_key = id(self)
+        self._t0 = self.clock.time()
+        self._wake_r, self._wake_w = os.pipe()
+        self._poll = select.poll()
+        self._poll.register(self._wake_r, select.POLLIN)
+        self._running = True
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(self.clock.reserve(),),
+                                        name='VirtualMedium')
+        self._thread.daemon = True
+        self._thread.start()
+        # The thread must not outlive the modules it uses at exit.
+        atexit.register(self.close)
+
+    def add_controller(self, bd_addr=None, **kwargs):
+        """Add a VirtualController; kwargs are passed to its constructor.
+
+        Returns:
+            VirtualController: The controller, to be passed to HCISock.
+        """
+        if bd_addr is None:
+            bd_addr = random_addr(self._addr_rng)
+        ctl = VirtualController(self, bd_addr, **kwargs)
+        self.call_soon(self._attach, ctl)
+        return ctl
+
+    def set_conditions(self, conditions, ctl=None, peer=None):
+        """Set the LinkConditions of connections established afterwards.
+
+        Without ctl, conditions become the default of the medium. With ctl,
+        they apply to the connections of ctl, or with peer only to those
+        between ctl and peer, in either role.
+        """
+        if ctl is None:
+            self.conditions = conditions
+        else:
+            self._link_conditions[(ctl, peer)] = conditions
+
+    def _conditions_of(self, a, b):
+        get = self._link_conditions.get
+        for key in ((a, b), (b, a), (a, None), (b, None)):
+            conditions = get(key)
+            if conditions is not None:
+                return conditions
+        return self.conditions
+
+    def close(self):
+        """Stop the controllers."""
+        if self._closed:
+            return
+        self.call_soon(self._stop)
+        with self.clock.blocked():
+            self._thread.join()
+        self._closed = True
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def call_soon(self, fn, *args):
+        """Call fn(*args) in the thread of the medium."""
+        if self._closed:
+            return
+        with self._lock:
+            self._calls.append((fn, args))
+        os.write(self._wake_w, '\x00')
+        self.clock.notify(self.clock_key)
+
+    def time(self):
+        """Return the time of the medium in seconds.
+
+        The time of the medium runs speed times faster than the clock of
+        the medium; intervals and timeouts of the controllers are in this
+        time.
+        """
+        return (self.clock.time() - self._t0) * self.speed
+
+    def call_at(self, t, fn, *args):
+        """Call fn(*args) at time t of the medium.
+
+        Must be called in the thread of the medium.
+
+        Returns:
+            Object whose cancel() method cancels the call.
+        """
+        timer = _Timer(self._t0 + t / self.speed, fn, args)
+        heapq.heappush(self._timers, (timer.expiry, next(self._seq), timer))
+        return timer
+
+    def call_later(self, delay, fn, *args):
+        """Call fn(*args) after delay seconds of the medium."""
+        return self.call_at(self.time() + delay, fn, *args)
+
+    def _attach(self, ctl):
+        self.controllers.append(ctl)
+        self._fds[ctl._ctl.fileno()] = ctl
+        self._poll.register(ctl._ctl, select.POLLIN)
+
+    def _detach(self, ctl):
+        if ctl not in self.controllers:
+            return
+        ctl.reset(STATUS_CONN_TIMEOUT)
+        self.controllers.remove(ctl)
+        self._listeners.pop(ctl, None)
+        fd = ctl._ctl.fileno()
+        del self._fds[fd]
+        self._poll.unregister(fd)
+        ctl._ctl.close()
+
+    def _stop(self):
+        for ctl in list(self.controllers):
+            self._detach(ctl)
+        self._running = False
+
+    def _poll_fds(self, timeout):
+        return self._poll.poll(timeout_ms(timeout))
+
+    def _run(self, ticket):
+        with self.clock.participant(ticket):
+            self._loop()
+
+    def _loop(self):
+        clock = self.clock
+        timers = self._timers
+        notified = self._notified
+        while self._running:
+            deadline = Deadline.at(timers[0][0] if timers else None)
+            for fd, event in clock.wait_ready(self._poll_fds, deadline,
+                                              self.clock_key):
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    self._run_calls()
+                    continue
+                ctl = self._fds.get(fd)
+                if ctl is None:
+                    continue
+                if event & select.POLLOUT:
+                    ctl._write_backlog()
+                if event & (select.POLLIN | select.POLLHUP):
+                    ctl._read_host()
+            now = clock.time()
+            while timers and timers[0][0] <= now:
+                timer = heapq.heappop(timers)[2]
+                if not timer.cancelled:
+                    timer.fn(*timer.args)
+            while self._completed:
+                self._completed.pop()._flush_completed()
+            while notified:
+                clock.notify(notified.pop().clock_key)
+
+    def _run_calls(self):
+        while True:
+            with self._lock:
+                if not self._calls:
+                    return
+                fn, args = self._calls.popleft()
+            fn(*args)
+
+    def _want_write(self, ctl, want):
+        events = select.POLLIN
+        if want:
+            events |= select.POLLOUT
+        self._poll.modify(ctl._ctl, events)
+
+    def listen(self, ctl):
+        """Update whether ctl receives advertising."""
+        if ctl.scanning or ctl.initiating:
+            self._listeners[ctl] = None
+        else:
+            self._listeners.pop(ctl, None)
+
+    def advertise(self, adv):
+        """Deliver an advertising event of adv to the other controllers."""
+        # Connections made in the loop stop listeners.
+        for ctl in list(self._listeners):
+            if ctl is adv:
+                continue
+            if (adv.adv_type in _DIRECTED
+                    and ctl.own_addr(ctl.init_own_addr_type if ctl.initiating
+                                     else ctl.scan_own_addr_type)[1]
+                    != adv.adv_peer_addr):
+                continue
+            if ctl.initiating and ctl.accepts_initiation(adv):
+                self.connect(ctl, adv)
+                if not adv.advertising:
+                    return
+                continue
+            if ctl.scanning:
+                ctl.report_adv(adv)
+
+    def connect(self, init, adv):
+        """Establish a connection from init to the advertiser adv."""
+        params = init.init_params
+        init_addr = init.own_addr(init.init_own_addr_type)
+        adv_addr = adv.own_addr(adv.adv_own_addr_type)
+        init.stop_initiating()
+        adv.stop_advertising()
+        m = init.new_link(0, adv_addr, params)
+        s = adv.new_link(1, init_addr, params)
+        m.peer = s
+        s.peer = m
+        conn = _VirtualConnection(m, s, self._conditions_of(init, adv))
+        conn.anchor = (self.time() + _TRANSMIT_WINDOW_DELAY
+                       + self.rng.uniform(0, conn.intvl))
+        conn.last_rx = conn.anchor
+        m.conn = s.conn = conn
+        if conn.conditions.loss:
+            self.call_at(conn.anchor + conn.supv_timeout, self._supervise,
+                         conn)
+        for link in (m, s):
+            link.ctl.le_evt(bluez.EVT_LE_CONN_COMPLETE, struct.pack(
+                '<BHBB6sHHHB', STATUS_SUCCESS, link.conn_handle, link.role,
+                link.peer_addr[0], link.peer_addr[1], link.conn_intvl,
+                link.conn_latency, link.supv_timeout, 0))
+        self.update_data_len(m)
+
+    def update_data_len(self, link):
+        """Run the data length update procedure on both ends of link."""
+        for l in (link, link.peer):
+            tx = max(MIN_OCTETS, min(l.tx_pref, l.peer.ctl.max_rx_octets))
+            rx = max(MIN_OCTETS, min(l.ctl.max_rx_octets, l.peer.tx_pref))
+            if (tx, rx) == (l.max_tx_octets, l.max_rx_octets):
+                continue
+            l.max_tx_octets = tx
+            l.max_rx_octets = rx
+            l.ctl.le_evt(bluez.EVT_LE_DATA_LEN_CHANGE, struct.pack(
+                '<HHHHH', l.conn_handle, tx, octets_time(tx), rx,
+                octets_time(rx)))
+
+    def send_acl(self, link, pb_flag, data):
+        """Queue ACL data sent on link for the next connection events.
+
+        The data is split into PDUs of the maximum transmit octets of the
+        link, delivered to the peer host as separate packets.
+        """
+        link.tx_queue.append((pb_flag, data))
+        self._schedule(link.conn)
+
+    def disconnect(self, link, reason, local_reason=STATUS_LOCAL_HOST_TERM):
+        """Terminate link in its next connection event; the peer is told
+        reason."""
+        conn = link.conn
+        if conn.closed:
+            # The peer is gone; there is nobody to acknowledge.
+            link.ctl.drop_link(link, local_reason)
+            return
+        if conn.terminate is not None:
+            return
+        conn.terminate = (link, reason, local_reason)
+        self._schedule(conn)
+
+    def update_connection(self, link, params):
+        """Apply (conn_intvl, conn_latency, supv_timeout) to link and its
+        peer at the instant of a Connection Update."""
+        conn = link.conn
+        self._advance(conn)
+        self.call_at(conn.anchor + _UPDATE_INSTANT * conn.intvl,
+                     self._update_instant, conn, params)
+
+    def _update_instant(self, conn, params):
+        if conn.closed:
+            return
+        intvl, latency, supv_timeout = params
+        for l in (conn.master, conn.slave):
+            l.conn_intvl = intvl
+            l.conn_latency = latency
+            l.supv_timeout = supv_timeout
+            l.ctl.le_evt(bluez.EVT_LE_CONN_UPDATE_COMPLETE, struct.pack(
+                '<BHHHH', STATUS_SUCCESS, l.conn_handle, intvl, latency,
+                supv_timeout))
+        # The events of the new parameters start at the instant.
+        if conn.timer is not None:
+            conn.timer.cancel()
+            conn.timer = None
+        conn.anchor = conn.last_rx = self.time()
+        self._schedule(conn)
+
+    def _advance(self, conn):
+        # Move the anchor of an idle connection to its next event.
+        if conn.timer is not None:
+            return
+        now = self.time()
+        if conn.anchor < now:
+            intvl = conn.intvl
+            conn.anchor += math.ceil((now - conn.anchor) / intvl) * intvl
+            # Idle events are exchanges of empty PDUs; losses are left to
+            # _supervise().
+            conn.last_rx = max(conn.last_rx, conn.anchor - intvl)
+
+    def _schedule(self, conn):
+        if conn.closed or conn.timer is not None:
+            return
+        self._advance(conn)
+        conn.timer = self.call_at(conn.anchor, self._conn_event, conn)
+
+    def _close(self, conn, master_reason, slave_reason):
+        conn.closed = True
+        if conn.timer is not None:
+            conn.timer.cancel()
+            conn.timer = None
+        conn.master.ctl.drop_link(conn.master, master_reason)
+        conn.slave.ctl.drop_link(conn.slave, slave_reason)
+
+    def _supervise(self, conn):
+        # Supervision of idle links with losses: the link times out if
+        # every event of a supervision timeout was lost.
+        if conn.closed:
+            return
+        supv_timeout = conn.supv_timeout
+        if conn.timer is None:
+            num_events = max(1, int(supv_timeout / conn.intvl))
+            if self.rng.random() < conn.conditions.loss ** num_events:
+                self._close(conn, STATUS_CONN_TIMEOUT, STATUS_CONN_TIMEOUT)
+                return
+        self.call_later(supv_timeout, self._supervise, conn)
+
+    def _conn_event(self, conn):
+        conn.timer = None
+        m = conn.master
+        s = conn.slave
+        conditions = conn.conditions
+        loss = conditions.loss
+        rng = self.rng
+        intvl = conn.intvl
+        anchor = conn.anchor
+        # The event starts when the radios of both controllers are free and
+        # ends at the next anchor or after the event length.
+        t = max(anchor, m.ctl.radio_free, s.ctl.radio_free)
+        end = anchor + (intvl if conditions.ce_len is None
+                        else min(conditions.ce_len, intvl))
+        conn.num_events += 1
+        m.refill(t, conditions.max_rate)
+        s.refill(t, conditions.max_rate)
+        exchanged = False
+        while True:
+            m_len = m.next_pdu_len()
+            s_len = s.next_pdu_len()
+            duration = (octets_time(m_len or 0) + octets_time(s_len or 0)
+                        + 2 * _T_IFS) * 1e-6
+            if t + duration > end:
+                break
+            t += duration
+            if loss and rng.random() < loss:
+                conn.num_lost += 1
+                break
+            exchanged = True
+            conn.last_rx = t
+            if conn.terminate is not None:
+                # LL_TERMINATE_IND of the master is acknowledged in the same
+                # event; the one of the slave is acknowledged in the next.
+                link, reason, local_reason = conn.terminate
+                if link is m:
+                    self._close(conn, local_reason, reason)
+                elif conn.terminate_sent:
+                    self._close(conn, reason, local_reason)
+                conn.terminate_sent = True
+                break
+            if m_len is not None:
+                self._transmit(m, m_len)
+            if s_len is not None:
+                self._transmit(s, s_len)
+            if m_len is None and s_len is None:
+                # Nothing more to send, or no credits
+                break
+        if exchanged:
+            m.ctl.radio_free = s.ctl.radio_free = t
+        if conn.closed:
+            return
+        if anchor + intvl - conn.last_rx >= conn.supv_timeout:
+            self._close(conn, STATUS_CONN_TIMEOUT, STATUS_CONN_TIMEOUT)
+            return
+        conn.anchor = anchor + intvl
+        if m.tx_queue or s.tx_queue or conn.terminate is not None:
+            conn.timer = self.call_at(conn.anchor, self._conn_event, conn)
+
+    def _transmit(self, link, size):
+        # Send the next PDU of size octets of link to its peer.
+        pb_flag, data = link.tx_queue[0]
+        offset = link.tx_offset
+        # Start fragments are passed to the host as flushable
+        flag = 0x1 if offset > 0 or pb_flag == 0x1 else 0x2
+        fragment = data[offset:offset + size]
+        link.tx_offset = offset + size
+        link.credit -= size
+        peer = link.peer
+        latency = link.conn.conditions.latency
+        if latency:
+            self.call_later(latency, peer.deliver, flag, fragment)
+        else:
+            peer.deliver(flag, fragment)
+        if link.tx_offset >= len(data):
+            link.tx_queue.popleft()
+            link.tx_offset = 0
+            link.ctl.complete_pkt(link)
+
+
+class _VirtualConnection(object):
+    """Connection events shared by the two links of a connection.
+
+    Attributes:
+        anchor: Time of the medium of the next connection event.
+        last_rx: Time of the medium of the last successful exchange.
+        num_events: Number of connection events run.
+        num_lost: Number of exchanges lost.
+    """
+
+    def __init__(self, master, slave, conditions):
+        super(_VirtualConnection, self).__init__()
+        self.master = master
+        self.slave = slave
+        self.conditions = conditions
+        self.anchor = 0.0
+        self.last_rx = 0.0
+        self.timer = None
+        self.terminate = None
+        self.terminate_sent = False
+        self.closed = False
+        self.num_events = 0
+        self.num_lost = 0
+
+    @property
+    def intvl(self):
+        return self.master.conn_intvl * 1.25e-3
+
+    @property
+    def supv_timeout(self):
+        return self.master.supv_timeout * 10e-3
+
+
+class _VirtualLink(object):
+    def __init__(self, ctl, conn_handle, role, peer_addr, params):
+        super(_VirtualLink, self).__init__()
+        self.ctl = ctl
+        self.conn_handle = conn_handle
+        self.role = role
+        self.peer_addr = peer_addr
+        self.conn_intvl, self.conn_latency, self.supv_timeout = params
+        self.peer = None
+        self.conn = None
+        self.tx_pref = ctl.suggested_tx_octets
+        self.max_tx_octets = MIN_OCTETS
+        self.max_rx_octets = MIN_OCTETS
+        self.ltk = None
+        self.encrypted = False
+        self.num_outstanding = 0
+        self.num_completed = 0
+        # ACL packets (pb_flag, data) to transmit, and the octets of the
+        # first one already transmitted
+        self.tx_queue = collections.deque()
+        self.tx_offset = 0
+        # Octets which can be sent under max_rate, and when last refilled
+        self.credit = 0.0
+        self.credit_time = None
+
+    def refill(self, t, max_rate):
+        if max_rate is None:
+            self.credit = float('inf')
+            return
+        # Credits accumulate over at most one connection interval, in
+        # addition to a PDU partly covered by the remaining credits.
+        burst = self.conn.intvl * max_rate + self.max_tx_octets
+        if self.credit_time is None:
+            self.credit = burst
+        else:
+            self.credit = min(
+                self.credit + (t - self.credit_time) * max_rate, burst)
+        self.credit_time = t
+
+    def next_pdu_len(self):
+        """Return the octets of the next PDU, or None for an empty PDU."""
+        if not self.tx_queue:
+            return None
+        size = min(len(self.tx_queue[0][1]) - self.tx_offset,
+                   self.max_tx_octets)
+        if size > self.credit:
+            return None
+        return size
+
+    def deliver(self, pb_flag, data):
+        """Pass data received on the link to the host."""
+        if self.ctl.links.get(self.conn_handle) is self:
+            self.ctl.send_acl_to_host(self.conn_handle, pb_flag, data)
+
+
+class VirtualController(object):
+    """Software LE controller; see VirtualMedium.add_controller().
+
+    The controller is the transport of its HCISock.
+
+    Args:
+        medium: VirtualMedium the controller is attached to.
+        bd_addr: Public device address.
+        le_acl_pkt_len: LE ACL data packet length.
+        num_le_acl_pkts: Number of LE ACL data packets buffered.
+        max_rx_octets: Maximum octets received per data channel PDU.
+        white_list_size: Number of white list entries, raised for a master
+            of many links.
+
+    Attributes:
+        num_dropped: Number of advertising reports dropped while the host
+            was not reading.
+        num_overflows: Number of ACL packets sent by the host beyond its
+            credits.
+    """
+
+    def __init__(self, medium, bd_addr, le_acl_pkt_len=MAX_OCTETS,
+                 num_le_acl_pkts=8, max_rx_octets=MAX_OCTETS,
+                 white_list_size=64):
+        super(VirtualController, self).__init__()
+        self.log = logging.getLogger(
+            '{}.{}'.format(__name__, self.__class__.__name__))
+        self.medium = medium
+        self.bd_addr = bd_addr
+        self.le_acl_pkt_len = le_acl_pkt_len
+        self.num_le_acl_pkts = num_le_acl_pkts
+        self.default_max_rx_octets = max_rx_octets
+        self.white_list_size = white_list_size
+        self.num_dropped = 0
+        self.num_overflows = 0
+        self._host, self._ctl = socket.socketpair(socket.AF_UNIX,
+                                                  socket.SOCK_SEQPACKET)
+        self._ctl.setblocking(False)
+        self.clock_key = id(self)
+        self._backlog = collections.deque()
+        # Whether packets are held back for want of room in the socket, in
+        # shared memory for hosts in forked workers
+        self._backlogged = mp.RawValue(ctypes.c_bool, False)
+        self.links = {}
+        self._handles = itertools.count(1)
+        self._adv_timer = None
+        self.reset()
+
+    def __str__(self):
+        return 'virtual:{}'.format(bluez.ba2str(self.bd_addr))
+
+    # Transport of HCISock
+
+    def fileno(self):
+        return self._host.fileno()
+
+    def send(self, pkt):
+        ret = self._host.send(pkt)
+        self.medium.clock.notify(self.medium.clock_key)
+        return ret
+
+    def recv(self, bufsize):
+        buf = self._host.recv(bufsize)
+        if self._backlogged.value:
+            # Room for the packets held back
+            self.medium.clock.notify(self.medium.clock_key)
+        return buf
+
+    def close(self):
+        self._host.close()
+        self.medium.call_soon(self.medium._detach, self)
+
+    # Controller state
+
+    def reset(self, peer_reason=STATUS_CONN_TIMEOUT):
+        """Return to the state after power on; peers of open links are
+        disconnected with peer_reason after their supervision timeout."""
+        for link in self.links.values():
+            conn = link.conn
+            if conn.timer is not None:
+                conn.timer.cancel()
+                conn.timer = None
+            conn.closed = True
+            if link.peer is not None:
+                link.peer.peer = None
+                self.medium.call_later(
+                    conn.supv_timeout, link.peer.ctl.drop_link,
+                    link.peer, peer_reason)
+        self.links = {}
+        self.evt_mask = DEFAULT_EVT_MASK
+        self.le_evt_mask = DEFAULT_LE_EVT_MASK
+        self.random_addr = None
+        self.white_list = set()
+        self.adv_mode = None  # 'legacy' or 'ext' once used since reset
+        self.advertising = False
+        self.adv_type = ADV_IND
+        self.adv_intvl = 0x0800
+        self.adv_own_addr_type = 0
+        self.adv_peer_addr = None
+        self.adv_filter_policy = 0
+        self.adv_data = ''
+        self.scan_rsp_data = ''
+        if self._adv_timer is not None:
+            self._adv_timer.cancel()
+            self._adv_timer = None
+        self.scanning = False
+        self.scan_type = 0
+        self.scan_own_addr_type = 0
+        self.scan_filter_policy = 0
+        self.filter_duplicates = False
+        self._reported = set()
+        self.initiating = False
+        self.init_filter_policy = 0
+        self.init_peer = None
+        self.init_own_addr_type = 0
+        self.init_params = None
+        self.suggested_tx_octets = MIN_OCTETS
+        self.max_rx_octets = self.default_max_rx_octets
+        self.num_outstanding = 0
+        # Time of the medium the radio is busy until
+        self.radio_free = 0.0
+        self.medium.listen(self)
+
+    def own_addr(self, own_addr_type):
+        """Return (addr_type, addr) of own_addr_type."""
+        if own_addr_type & 0x1 and self.random_addr is not None:
+            return (1, self.random_addr)
+        return (0, self.bd_addr)
+
+    # Host interface
+
+    def _read_host(self):
+        while True:
+            try:
+                pkt = self._ctl.recv(65536)
+            except socket.error as err:
+                if err.errno == errno.EAGAIN:
+                    return
+                raise
+            if not pkt:
+                # Closed by every holder of the host socket
+                self.medium._detach(self)
+                return
+            ptype = ord(pkt[0])
+            if ptype == bluez.HCI_COMMAND_PKT and len(pkt) >= 4:
+                opcode, plen = struct.unpack_from('<HB', pkt, 1)
+                self._handle_cmd(opcode, pkt[4:4 + plen])
+            elif ptype == bluez.HCI_ACLDATA_PKT and len(pkt) >= 5:
+                hdr, dlen = struct.unpack_from('<HH', pkt, 1)
+                self._handle_acl(hdr & 0x0FFF, (hdr >> 12) & 0x3,
+                                 pkt[5:5 + dlen])
+            else:
+                self.log.warning('%s: ignore packet type %d', self, ptype)
+
+    def _send_pkt(self, pkt, droppable=False):
+        if self._backlog:
+            if droppable and len(self._backlog) >= MAX_BACKLOG:
+                self.num_dropped += 1
+                return
+            self._backlog.append(pkt)
+            return
+        try:
+            self._ctl.send(pkt)
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                return
+            self._backlog.append(pkt)
+            self._backlogged.value = True
+            self.medium._want_write(self, True)
+            return
+        self.medium._notified.add(self)
+
+    def _write_backlog(self):
+        backlog = self._backlog
+        while backlog:
+            try:
+                self._ctl.send(backlog[0])
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.ENOBUFS):
+                    return
+                backlog.clear()
+                break
+            backlog.popleft()
+            self.medium._notified.add(self)
+        self._backlogged.value = False
+        self.medium._want_write(self, False)
+
+    def evt(self, code, param, droppable=False):
+        """Send an event to the host unless masked."""
+        if (code not in (bluez.EVT_CMD_COMPLETE, bluez.EVT_CMD_STATUS,
+                         bluez.EVT_NUM_COMP_PKTS)
+                and not (self.evt_mask >> (code - 1)) & 0x1):
+            return
+        self._send_pkt(''.join((
+            struct.pack('<BBB', bluez.HCI_EVENT_PKT, code, len(param)),
+            param)), droppable)
+
+    def le_evt(self, subevt_code, param, droppable=False):
+        if not (self.le_evt_mask >> (subevt_code - 1)) & 0x1:
+            return
+        self.evt(bluez.EVT_LE_META_EVENT, ''.join((chr(subevt_code), param)),
+                 droppable)
+
+    def send_acl_to_host(self, conn_handle, pb_flag, data):
+        self._send_pkt(''.join((
+            struct.pack('<BHH', bluez.HCI_ACLDATA_PKT,
+                        conn_handle | (pb_flag << 12), len(data)),
+            data)))
+
+    def _cmd_complete(self, opcode, ret):
+        self.evt(bluez.EVT_CMD_COMPLETE,
+                 ''.join((struct.pack('<BH', 1, opcode), ret)))
+
+    def _cmd_status(self, opcode, status):
+        self.evt(bluez.EVT_CMD_STATUS,
+                 struct.pack('<BBH', status, 1, opcode))
+
+    def _handle_cmd(self, opcode, param):
+        handler = _cmd_handlers.get(opcode)
+        if handler is None:
+            self.log.info('%s: unknown command 0x%04x', self, opcode)
+            self._cmd_complete(opcode, chr(STATUS_UNKNOWN_CMD))
+            return
+        mode = _adv_cmd_modes.get(opcode)
+        if mode is not None:
+            if self.adv_mode is not None and self.adv_mode != mode:
+                if opcode in _cmd_status_opcodes:
+                    self._cmd_status(opcode, STATUS_CMD_DISALLOWED)
+                else:
+                    self._cmd_complete(opcode, ''.join((
+                        chr(STATUS_CMD_DISALLOWED),
+                        '\x00' * _ret_param_len.get(opcode, 0))))
+                return
+            self.adv_mode = mode
+        try:
+            ret = handler(self, param)
+        except (struct.error, IndexError):
+            ret = chr(STATUS_INVALID_PARAM)
+            if opcode in _cmd_status_opcodes:
+                ret = STATUS_INVALID_PARAM
+        if ret is None:
+            return
+        if opcode in _cmd_status_opcodes:
+            self._cmd_status(opcode, ret)
+        else:
+            self._cmd_complete(opcode, ret)
+
+    def _handle_acl(self, conn_handle, pb_flag, data):
+        link = self.links.get(conn_handle)
+        if link is None:
+            self.log.info('%s: ACL data of unknown handle 0x%04x', self,
+                          conn_handle)
+            return
+        if len(data) > self.le_acl_pkt_len:
+            self.log.warning('%s: ACL data of %d octets dropped', self,
+                             len(data))
+            return
+        if self.num_outstanding >= self.num_le_acl_pkts:
+            self.num_overflows += 1
+            self.log.warning('%s: ACL buffer overflow', self)
+            return
+        self.num_outstanding += 1
+        link.num_outstanding += 1
+        self.medium.send_acl(link, pb_flag, data)
+
+    def complete_pkt(self, link):
+        """Count an ACL packet of link as transmitted."""
+        if link.num_outstanding == 0:
+            return
+        link.num_outstanding -= 1
+        self.num_outstanding -= 1
+        link.num_completed += 1
+        self.medium._completed.add(self)
+
+    def _flush_completed(self):
+        completed = [link for link in self.links.itervalues()
+                     if link.num_completed]
+        if not completed:
+            return
+        param = [chr(len(completed))]
+        for link in completed:
+            param.append(struct.pack('<HH', link.conn_handle,
+                                     link.num_completed))
+            link.num_completed = 0
+        self.evt(bluez.EVT_NUM_COMP_PKTS, ''.join(param))
+
+    # Links
+
+    def new_link(self, role, peer_addr, params):
+        conn_handle = next(self._handles) & 0x0EFF
+        link = _VirtualLink(self, conn_handle, role, peer_addr, params)
+        self.links[conn_handle] = link
+        return link
+
+    def drop_link(self, link, reason):
+        """Remove link and report its disconnection with reason."""
+        if self.links.get(link.conn_handle) is not link:
+            return
+        del self.links[link.conn_handle]
+        # The host frees the buffers of the link on disconnection.
+        self.num_outstanding -= link.num_outstanding
+        self.evt(bluez.EVT_DISCONN_COMPLETE, struct.pack(
+            '<BHB', STATUS_SUCCESS, link.conn_handle, reason))
+
+    # Advertising, scanning and initiating
+
+    def _adv_event(self):
+        self._adv_timer = None
+        if not self.advertising:
+            return
+        self.medium.advertise(self)
+        if not self.advertising:
+            return
+        if self.adv_type == ADV_DIRECT_IND_HIGH:
+            delay = _HIGH_DUTY_INTVL
+        else:
+            delay = (self.adv_intvl * 0.625e-3
+                     + self.medium.rng.uniform(0, _ADV_DELAY_MAX))
+        self._adv_timer = self.medium.call_later(delay, self._adv_event)
+
+    def _adv_timeout(self):
+        if not self.advertising or self.adv_type != ADV_DIRECT_IND_HIGH:
+            return
+        self.stop_advertising()
+        self.le_evt(bluez.EVT_LE_CONN_COMPLETE, struct.pack(
+            '<BHBB6sHHHB', STATUS_ADV_TIMEOUT, 0, 1, 0, '\x00' * 6, 0, 0, 0,
+            0))
+
+    def stop_advertising(self):
+        self.advertising = False
+        if self._adv_timer is not None:
+            self._adv_timer.cancel()
+            self._adv_timer = None
+
+    def stop_initiating(self):
+        self.initiating = False
+        self.medium.listen(self)
+
+    def accepts_initiation(self, adv):
+        if adv.adv_type not in _CONNECTABLE:
+            return False
+        addr = adv.own_addr(adv.adv_own_addr_type)
+        if self.init_filter_policy:
+            return addr in self.white_list
+        return addr == self.init_peer
+
+    def report_adv(self, adv):
+        addr = adv.own_addr(adv.adv_own_addr_type)
+        if self.scan_filter_policy & 0x1 and addr not in self.white_list:
+            return
+        self._report(_report_evt_type[adv.adv_type], addr,
+                     '' if adv.adv_type in _DIRECTED else adv.adv_data)
+        if self.scan_type == 1 and adv.adv_type in _SCANNABLE:
+            self._report(_REPORT_SCAN_RSP, addr, adv.scan_rsp_data)
+
+    def _report(self, evt_type, addr, data):
+        if self.filter_duplicates:
+            key = (evt_type, addr)
+            if key in self._reported:
+                return
+            self._reported.add(key)
+        self.le_evt(bluez.EVT_LE_ADVERTISING_REPORT, ''.join((
+            struct.pack('<BBB6sB', 1, evt_type, addr[0], addr[1], len(data)),
+            data, struct.pack('<b', -50))), droppable=True)
+
+    # Command handlers return the return parameters of command complete, or
+    # the status of command status. Handlers sending the response themselves
+    # before acting on the command return None.
+
+    def _cmd_reset(self, param):
+        self.reset()
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_set_evt_mask(self, param):
+        self.evt_mask = struct.unpack('<Q', param)[0]
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_evt_mask(self, param):
+        self.le_evt_mask = struct.unpack('<Q', param)[0]
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_read_local_version(self, param):
+        return struct.pack('<BBHBHH', STATUS_SUCCESS, *VERSION)
+
+    def _cmd_read_local_cmds(self, param):
+        return ''.join((chr(STATUS_SUCCESS), _supported_cmds))
+
+    def _cmd_read_local_features(self, param):
+        return ''.join((chr(STATUS_SUCCESS), LMP_FEATURES))
+
+    def _cmd_read_bd_addr(self, param):
+        return ''.join((chr(STATUS_SUCCESS), self.bd_addr))
+
+    def _cmd_le_read_buffer_size(self, param):
+        return struct.pack('<BHB', STATUS_SUCCESS, self.le_acl_pkt_len,
+                           self.num_le_acl_pkts)
+
+    def _cmd_le_read_local_features(self, param):
+        return struct.pack('<BQ', STATUS_SUCCESS, LE_FEATURES)
+
+    def _cmd_le_set_random_addr(self, param):
+        if self.advertising or self.scanning or self.initiating:
+            return chr(STATUS_CMD_DISALLOWED)
+        self.random_addr = struct.unpack('<6s', param)[0]
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_adv_params(self, param):
+        if self.advertising:
+            return chr(STATUS_CMD_DISALLOWED)
+        (_, intvl_max, adv_type, own_addr_type, _, peer_addr, _,
+         filter_policy) = struct.unpack('<HHBBB6sBB', param)
+        if adv_type not in _report_evt_type:
+            return chr(STATUS_INVALID_PARAM)
+        self.adv_intvl = intvl_max
+        self.adv_type = adv_type
+        self.adv_own_addr_type = own_addr_type
+        self.adv_peer_addr = peer_addr
+        self.adv_filter_policy = filter_policy
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_read_adv_tx_power(self, param):
+        return struct.pack('<Bb', STATUS_SUCCESS, 0)
+
+    def _cmd_le_set_adv_data(self, param):
+        self.adv_data = param[1:1 + min(ord(param[0]), 31)]
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_scan_rsp_data(self, param):
+        self.scan_rsp_data = param[1:1 + min(ord(param[0]), 31)]
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_adv_enable(self, param):
+        enable = ord(param[0])
+        if enable and not self.advertising:
+            self.advertising = True
+            if self.adv_type == ADV_DIRECT_IND_HIGH:
+                self.medium.call_later(_HIGH_DUTY_TIMEOUT, self._adv_timeout)
+            self._adv_timer = self.medium.call_later(0, self._adv_event)
+        elif not enable:
+            self.stop_advertising()
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_scan_params(self, param):
+        if self.scanning:
+            return chr(STATUS_CMD_DISALLOWED)
+        (self.scan_type, _, _, self.scan_own_addr_type,
+         self.scan_filter_policy) = struct.unpack('<BHHBB', param)
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_scan_enable(self, param):
+        enable, filter_duplicates = struct.unpack('<BB', param)
+        if enable and not self.scanning:
+            self._reported = set()
+        self.scanning = bool(enable)
+        self.filter_duplicates = bool(filter_duplicates)
+        self.medium.listen(self)
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_create_conn(self, param):
+        if self.initiating:
+            return STATUS_CMD_DISALLOWED
+        (_, _, filter_policy, peer_addr_type, peer_addr, own_addr_type, _,
+         intvl_max, latency, supv_timeout, _, _) = struct.unpack(
+             '<HHBB6sBHHHHHH', param)
+        self.init_filter_policy = filter_policy
+        self.init_peer = (peer_addr_type & 0x1, peer_addr)
+        self.init_own_addr_type = own_addr_type
+        self.init_params = (intvl_max, latency, supv_timeout)
+        self.initiating = True
+        self.medium.listen(self)
+        return STATUS_SUCCESS
+
+    def _cmd_le_create_conn_cancel(self, param):
+        if not self.initiating:
+            return chr(STATUS_CMD_DISALLOWED)
+        self.stop_initiating()
+        self._cmd_complete(btcmd.HCILECreateConnectionCancel.opcode(),
+                           chr(STATUS_SUCCESS))
+        self.le_evt(bluez.EVT_LE_CONN_COMPLETE, struct.pack(
+            '<BHBB6sHHHB', STATUS_UNKNOWN_CONN_ID, 0, 0, 0, '\x00' * 6, 0, 0,
+            0, 0))
+        return None
+
+    def _cmd_le_read_white_list_size(self, param):
+        return struct.pack('<BB', STATUS_SUCCESS, self.white_list_size)
+
+    def _cmd_le_clear_white_list(self, param):
+        self.white_list.clear()
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_add_to_white_list(self, param):
+        addr_type, addr = struct.unpack('<B6s', param)
+        if len(self.white_list) >= self.white_list_size:
+            return chr(STATUS_MEM_CAPACITY_EXCEEDED)
+        self.white_list.add((addr_type & 0x1, addr))
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_remove_from_white_list(self, param):
+        addr_type, addr = struct.unpack('<B6s', param)
+        self.white_list.discard((addr_type & 0x1, addr))
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_disconnect(self, param):
+        conn_handle, reason = struct.unpack('<HB', param)
+        link = self.links.get(conn_handle)
+        if link is None:
+            return STATUS_UNKNOWN_CONN_ID
+        self._cmd_status(btcmd.HCIDisconnect.opcode(), STATUS_SUCCESS)
+        self.medium.disconnect(link, reason)
+        return None
+
+    def _cmd_le_conn_update(self, param):
+        (conn_handle, _, intvl_max, latency, supv_timeout, _,
+         _) = struct.unpack('<HHHHHHH', param)
+        link = self.links.get(conn_handle)
+        if link is None:
+            return STATUS_UNKNOWN_CONN_ID
+        self._cmd_status(btcmd.HCILEConnectionUpdate.opcode(), STATUS_SUCCESS)
+        self.medium.update_connection(link,
+                                      (intvl_max, latency, supv_timeout))
+        return None
+
+    def _cmd_le_start_encryption(self, param):
+        conn_handle, rand, ediv, ltk = struct.unpack('<H8sH16s', param)
+        link = self.links.get(conn_handle)
+        if link is None:
+            return STATUS_UNKNOWN_CONN_ID
+        if link.role != 0:
+            return STATUS_CMD_DISALLOWED
+        link.ltk = ltk
+        peer = link.peer
+        self._cmd_status(btcmd.HCILEStartEncryption.opcode(), STATUS_SUCCESS)
+        peer.ctl.le_evt(bluez.EVT_LE_LTK_REQUEST, struct.pack(
+            '<H8sH', peer.conn_handle, rand, ediv))
+        return None
+
+    def _cmd_le_ltk_reply(self, param):
+        conn_handle, ltk = struct.unpack('<H16s', param)
+        link = self.links.get(conn_handle)
+        if link is None or link.peer is None:
+            return struct.pack('<BH', STATUS_UNKNOWN_CONN_ID, conn_handle)
+        self._cmd_complete(btcmd.HCILELongTermKeyRequestReply.opcode(),
+                           struct.pack('<BH', STATUS_SUCCESS, conn_handle))
+        if ltk != link.peer.ltk:
+            self.medium.disconnect(link, STATUS_MIC_FAILURE,
+                                   STATUS_MIC_FAILURE)
+            return None
+        for l in (link.peer, link):
+            l.encrypted = True
+            l.ctl.evt(bluez.EVT_ENCRYPT_CHANGE, struct.pack(
+                '<BHB', STATUS_SUCCESS, l.conn_handle, 1))
+        return None
+
+    def _cmd_le_ltk_neg_reply(self, param):
+        conn_handle = struct.unpack('<H', param)[0]
+        link = self.links.get(conn_handle)
+        if link is None or link.peer is None:
+            return struct.pack('<BH', STATUS_UNKNOWN_CONN_ID, conn_handle)
+        self._cmd_complete(
+            btcmd.HCILELongTermKeyRequestNegtiveReply.opcode(),
+            struct.pack('<BH', STATUS_SUCCESS, conn_handle))
+        peer = link.peer
+        peer.ctl.evt(bluez.EVT_ENCRYPT_CHANGE, struct.pack(
+            '<BHB', STATUS_KEY_MISSING, peer.conn_handle, 0))
+        return None
+
+    def _cmd_le_set_data_len(self, param):
+        conn_handle, tx_octets, _ = struct.unpack('<HHH', param)
+        link = self.links.get(conn_handle)
+        if link is None:
+            return struct.pack('<BH', STATUS_UNKNOWN_CONN_ID, conn_handle)
+        if not MIN_OCTETS <= tx_octets <= MAX_OCTETS:
+            return struct.pack('<BH', STATUS_INVALID_PARAM, conn_handle)
+        self._cmd_complete(btcmd.HCILESetDataLength.opcode(),
+                           struct.pack('<BH', STATUS_SUCCESS, conn_handle))
+        link.tx_pref = tx_octets
+        self.medium.update_data_len(link)
+        return None
+
+    def _cmd_le_read_suggested_data_len(self, param):
+        return struct.pack('<BHH', STATUS_SUCCESS, self.suggested_tx_octets,
+                           octets_time(self.suggested_tx_octets))
+
+    def _cmd_le_write_suggested_data_len(self, param):
+        tx_octets, _ = struct.unpack('<HH', param)
+        if not MIN_OCTETS <= tx_octets <= MAX_OCTETS:
+            return chr(STATUS_INVALID_PARAM)
+        self.suggested_tx_octets = tx_octets
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_vendor_write_local_max_rx_octets(self, param):
+        self.max_rx_octets = struct.unpack('<H', param)[0]
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_ext_accepted(self, param):
+        return chr(STATUS_SUCCESS)
+
+    def _cmd_le_set_ext_adv_params(self, param):
+        return struct.pack('<Bb', STATUS_SUCCESS, 0)
+
+    def _cmd_le_read_max_adv_data_len(self, param):
+        return struct.pack('<BH', STATUS_SUCCESS, 31)
+
+    def _cmd_le_read_num_adv_sets(self, param):
+        return struct.pack('<BB', STATUS_SUCCESS, 1)
+
+    def _cmd_le_ext_create_conn(self, param):
+        return STATUS_SUCCESS
+
+
+def _opcode(ogf, ocf):
+    return bluez.cmd_opcode_pack(ogf, ocf)
+
+
+_cmd_handlers = {
+    btcmd.HCIReset.opcode(): VirtualController._cmd_reset,
+    btcmd.HCISetEventMask.opcode(): VirtualController._cmd_set_evt_mask,
+    btcmd.HCIReadLocalVersionInformation.opcode():
+        VirtualController._cmd_read_local_version,
+    btcmd.HCIReadLocalSupportedCommands.opcode():
+        VirtualController._cmd_read_local_cmds,
+    btcmd.HCIReadLocalSupportedFeatures.opcode():
+        VirtualController._cmd_read_local_features,
+    btcmd.HCIReadBDAddr.opcode(): VirtualController._cmd_read_bd_addr,
+    btcmd.HCIDisconnect.opcode(): VirtualController._cmd_disconnect,
+    btcmd.HCILESetEventMask.opcode(): VirtualController._cmd_le_set_evt_mask,
+    btcmd.HCILEReadBufferSize.opcode():
+        VirtualController._cmd_le_read_buffer_size,
+    btcmd.HCILEReadLocalSupportedFeatures.opcode():
+        VirtualController._cmd_le_read_local_features,
+    _opcode(bluez.OGF_LE_CTL, bluez.OCF_LE_SET_RANDOM_ADDRESS):
+        VirtualController._cmd_le_set_random_addr,
+    btcmd.HCILESetAdvertisingParameters.opcode():
+        VirtualController._cmd_le_set_adv_params,
+    btcmd.HCILEReadAdvertisingChannelTxPower.opcode():
+        VirtualController._cmd_le_read_adv_tx_power,
+    btcmd.HCILESetAdvertisingData.opcode():
+        VirtualController._cmd_le_set_adv_data,
+    btcmd.HCILESetScanResponseData.opcode():
+        VirtualController._cmd_le_set_scan_rsp_data,
+    btcmd.HCILESetAdvertiseEnable.opcode():
+        VirtualController._cmd_le_set_adv_enable,
+    btcmd.HCILESetScanParameters.opcode():
+        VirtualController._cmd_le_set_scan_params,
+    btcmd.HCILESetScanEnable.opcode():
+        VirtualController._cmd_le_set_scan_enable,
+    btcmd.HCILECreateConnection.opcode():
+        VirtualController._cmd_le_create_conn,
+    btcmd.HCILECreateConnectionCancel.opcode():
+        VirtualController._cmd_le_create_conn_cancel,
+    btcmd.HCILEReadWhiteListSize.opcode():
+        VirtualController._cmd_le_read_white_list_size,
+    btcmd.HCILEClearWhiteList.opcode():
+        VirtualController._cmd_le_clear_white_list,
+    btcmd.HCILEAddDeviceToWhiteList.opcode():
+        VirtualController._cmd_le_add_to_white_list,
+    btcmd.HCILERemoveDeviceFromWhiteList.opcode():
+        VirtualController._cmd_le_remove_from_white_list,
+    btcmd.HCILEConnectionUpdate.opcode():
+        VirtualController._cmd_le_conn_update,
+    btcmd.HCILEStartEncryption.opcode():
+        VirtualController._cmd_le_start_encryption,
+    btcmd.HCILELongTermKeyRequestReply.opcode():
+        VirtualController._cmd_le_ltk_reply,
+    btcmd.HCILELongTermKeyRequestNegtiveReply.opcode():
+        VirtualController._cmd_le_ltk_neg_reply,
+    btcmd.HCILESetDataLength.opcode():
+        VirtualController._cmd_le_set_data_len,
+    btcmd.HCILEReadSuggestedDefaultDataLength.opcode():
+        VirtualController._cmd_le_read_suggested_data_len,
+    btcmd.HCILEWriteSuggestedDefaultDataLength.opcode():
+        VirtualController._cmd_le_write_suggested_data_len,
+    _opcode(bluez.OGF_VENDOR_CMD, OCF_VENDOR_WRITE_LOCAL_MAX_RX_OCTETS):
+        VirtualController._cmd_vendor_write_local_max_rx_octets,
+    btcmd.HCILESetAdvertisingSetRandomAddress.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILESetExtendedAdvertisingParameters.opcode():
+        VirtualController._cmd_le_set_ext_adv_params,
+    btcmd.HCILESetExtendedAdvertisingData.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILESetExtendedScanResponseData.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILESetExtendedAdvertisingEnable.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILEReadMaximumAdvertisingDataLength.opcode():
+        VirtualController._cmd_le_read_max_adv_data_len,
+    btcmd.HCILEReadNumberOfSupportedAdvertisingSets.opcode():
+        VirtualController._cmd_le_read_num_adv_sets,
+    btcmd.HCILERemoveAdvertisingSet.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILEClearAdvertisingSets.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILESetExtendedScanParameters.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILESetExtendedScanEnable.opcode():
+        VirtualController._cmd_ext_accepted,
+    btcmd.HCILEExtendedCreateConnection.opcode():
+        VirtualController._cmd_le_ext_create_conn,
+}
+
+# Commands answered by command status instead of command complete
+_cmd_status_opcodes = frozenset((
+    btcmd.HCIDisconnect.opcode(),
+    btcmd.HCILECreateConnection.opcode(),
+    btcmd.HCILEConnectionUpdate.opcode(),
+    btcmd.HCILEStartEncryption.opcode(),
+    btcmd.HCILEExtendedCreateConnection.opcode(),
+))
+
+# Length of the return parameters after the status of mixed advertising
+# commands, returned as zeros when disallowed
+_ret_param_len = {
+    btcmd.HCILEReadAdvertisingChannelTxPower.opcode(): 1,
+    btcmd.HCILESetExtendedAdvertisingParameters.opcode(): 1,
+    btcmd.HCILEReadMaximumAdvertisingDataLength.opcode(): 2,
+    btcmd.HCILEReadNumberOfSupportedAdvertisingSets.opcode(): 1,
+}
+
+# Legacy and extended advertising commands may not be mixed until reset.
+_adv_cmd_modes = dict(
+    [(cls.opcode(), 'legacy') for cls in (
+        btcmd.HCILESetAdvertisingParameters,
+        btcmd.HCILEReadAdvertisingChannelTxPower,
+        btcmd.HCILESetAdvertisingData,
+        btcmd.HCILESetScanResponseData,
+        btcmd.HCILESetAdvertiseEnable,
+        btcmd.HCILESetScanParameters,
+        btcmd.HCILESetScanEnable,
+        btcmd.HCILECreateConnection)]
+    + [(cls.opcode(), 'ext') for cls in (
+        btcmd.HCILESetAdvertisingSetRandomAddress,
+        btcmd.HCILESetExtendedAdvertisingParameters,
+        btcmd.HCILESetExtendedAdvertisingData,
+        btcmd.HCILESetExtendedScanResponseData,
+        btcmd.HCILESetExtendedAdvertisingEnable,
+        btcmd.HCILEReadMaximumAdvertisingDataLength,
+        btcmd.HCILEReadNumberOfSupportedAdvertisingSets,
+        btcmd.HCILERemoveAdvertisingSet,
+        btcmd.HCILEClearAdvertisingSets,
+        btcmd.HCILESetExtendedScanParameters,
+        btcmd.HCILESetExtendedScanEnable,
+        btcmd.HCILEExtendedCreateConnection)])
+
+
+def _pack_supported_cmds(bits):
+    octets = [0] * 64
+    for octet, bit in bits:
+        octets[octet] |= 1 << bit
+    return ''.join(chr(o) for o in octets)
+
+# (octet, bit) of the commands reported as supported. Extended advertising
+# is not reported, since it has no effect on the medium.
+_supported_cmds = _pack_supported_cmds((
+    (0, 5),  # Disconnect
+    (5, 6), (5, 7),  # Set Event Mask, Reset
+    (14, 3), (14, 5),  # Read Local Version Information, Features
+    (15, 1),  # Read BD_ADDR
+    (25, 0), (25, 1), (25, 2), (25, 4), (25, 5), (25, 6), (25, 7),
+    (26, 0), (26, 1), (26, 2), (26, 3), (26, 4), (26, 5), (26, 6), (26, 7),
+    (27, 0), (27, 1), (27, 2),
+    (28, 0), (28, 1), (28, 2),  # Start Encryption, LTK (Negative) Reply
+    (33, 6), (33, 7), (34, 0),  # Data length
+))
@@ -75,5 +75,8 @@ setup(
     install_requires=[
         'PyBluez>=0.18'
     ],
+    extras_require={
+        'analytics': ['numpy']
+    },
     packages=find_packages()
 )
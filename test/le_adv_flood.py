@@ -0,0 +1,113 @@
+# Measure LE scan capacity under a synthetic advertising flood
+#
+# The first device scans; the others share the target advertising rate over
+# all their advertising sets. Each round reports the target, achieved on-air
+# and received rates. The test fails if any advertising set does not
+# terminate within a round.
+
+import bluetool
+from bluetool.bluez import ba2str
+from bluetool.core import HCICoordinator, HCIWorker, LEHelper
+from bluetool.flood import FloodAdvertiser, FloodScanner, plan_flood
+import logging
+import os
+
+TARGET_RATE = float(os.environ.get('FLOOD_RATE', 1000))
+NUM_ADVERTISERS = int(os.environ.get('FLOOD_ADVERTISERS', 3))
+MAX_SETS_PER_CTL = int(os.environ.get('FLOOD_MAX_SETS', 16))
+PAYLOAD_SIZES = ((31, 4), (100, 2), (250, 1), (600, 1))
+CHURN = 0.1
+NUM_ROUNDS = 5
+ROUND_DURATION = 5
+CMD_TIMEOUT = 5
+SEED = 1
+
+
+class FloodAdvWorker(HCIWorker):
+    def main(self):
+        seed = self.recv()
+        LEHelper(self.sock).reset()
+        helper = FloodAdvertiser(self.sock, seed)
+        num_sets = min(helper.num_supported_adv_sets or 1, MAX_SETS_PER_CTL)
+        self.send(num_sets)
+
+        set_rate = self.recv()
+        helper.setup(num_sets, set_rate, PAYLOAD_SIZES, CMD_TIMEOUT)
+        self.send(True)
+
+        while True:
+            going = self.recv()
+            if not going:
+                break
+            result = helper.run_round(ROUND_DURATION, CHURN, CMD_TIMEOUT)
+            self.send(result)
+        helper.clear(CMD_TIMEOUT)
+
+
+class FloodScanWorker(HCIWorker):
+    def main(self):
+        helper = FloodScanner(self.sock)
+        helper.reset()
+        helper.configure(timeout=CMD_TIMEOUT)
+        self.send(True)
+
+        while True:
+            duration = self.recv()
+            if duration is None:
+                break
+            self.send(helper.measure(duration))
+
+
+class FloodTester(HCICoordinator):
+    def main(self):
+        advertisers = [getattr(self, 'adv{}'.format(i + 1))
+                       for i in xrange(0, NUM_ADVERTISERS)]
+        self.scanner.recv()
+        for i, adv in enumerate(advertisers):
+            adv.send(SEED + i)
+        num_sets = [adv.recv() for adv in advertisers]
+        set_rate, expected = plan_flood(TARGET_RATE, num_sets)
+        print 'target {:.0f}/s over {} sets: {:.1f}/s per set, {:.0f}/s ' \
+            'expected'.format(TARGET_RATE, sum(num_sets), set_rate, expected)
+        for adv in advertisers:
+            adv.send(set_rate)
+        for adv in advertisers:
+            adv.recv()
+
+        num_failed = 0
+        for i in xrange(1, NUM_ROUNDS + 1):
+            self.scanner.send(ROUND_DURATION)
+            for adv in advertisers:
+                adv.send(True)
+            results = [adv.recv() for adv in advertisers]
+            received = self.scanner.recv()
+            on_air = sum(r.rate for r in results)
+            print 'round #{}: on-air {:.1f}/s, received {}'.format(
+                i, on_air, received)
+            for adv, result in zip(advertisers, results):
+                print '  {}: {}'.format(ba2str(adv.bd_addr), result)
+            if any(r.failed for r in results):
+                num_failed += 1
+
+        for adv in advertisers:
+            adv.send(False)
+        self.scanner.send(None)
+
+        if num_failed:
+            print '{}/{} rounds failed'.format(num_failed, NUM_ROUNDS)
+            return 1
+        return 0
+
+
+bluetest = {
+    'coordinator': FloodTester,
+    'worker': [('scanner', FloodScanWorker)] + [
+        ('adv{}'.format(i + 1), FloodAdvWorker)
+        for i in xrange(0, NUM_ADVERTISERS)]
+}
+
+
+if __name__ == "__main__":
+    bluetool.log_to_stream()
+    bluetool.log_set_level(logging.INFO)
+    bluetool.run_config(bluetest)
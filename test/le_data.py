@@ -8,7 +8,7 @@ import bluetool.bluez as bluez
 from bluetool.data import HCIACLData
 import logging
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 HCI_ACL_MAX_SIZE = 27
 NUM_ACL_DATA = 1600
 
@@ -137,7 +137,7 @@ class LESlave(HCIWorker):
                 self.signal()  # triger master to disconnect
 
                 helper.wait_disconnection_complete(
-                    self.conn_handle, CONN_TIMEOUT_MS)
+                    self.conn_handle, CONN_TIMEOUT)
                 succeeded = True
             except (HCICommandError, HCITimeoutError):
                 self.log.warning('fail to connect to initiator', exc_info=True)
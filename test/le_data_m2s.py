@@ -12,7 +12,7 @@ import bluetool.event as btevt
 from bluetool.data import HCIACLData
 from bluetool.utils import bytes2str
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 HCI_ACL_MAX_SIZE = 251
 NUM_ACL_DATA = 1600
 
@@ -139,7 +139,7 @@ class LESlave(HCIWorker):
             except (HCICommandError, HCITimeoutError):
                 self.log.warning('fail to receive ACL data from master', exc_info=True)
 
-        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT)
 
 
 class LETester(HCICoordinator):
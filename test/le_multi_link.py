@@ -1,22 +1,22 @@
 # Test LE multiple link QoS
 
 import bluetool
-from bluetool.core import HCICoordinator, HCIWorker, LEHelper, ReadBDAddrTask
+from bluetool.clock import Deadline
+from bluetool.core import (HCICoordinator, HCIWorker, LEConnectionManager,
+                           LEHelper, ReadBDAddrTask)
 from bluetool.error import HCICommandError, TestError, HCITimeoutError
 from bluetool.utils import bytes2str
 from bluetool import bluez
 import logging
-import time
 
 
 class LEMaster(HCIWorker):
     def main(self):
         self.num_peers = self.recv()
         self.peer_addr = self.recv()
-        self.conn_handle = [0]*self.num_peers
-        self.connected = [False]*self.num_peers
+        peers = [(0, addr) for addr in self.peer_addr]
 
-        helper = LEHelper(self.sock)
+        helper = LEConnectionManager(self.sock, 12, 0, 1000, 6)
         helper.reset()
 
         self.signal()  # signal master reset completion
@@ -27,40 +27,19 @@ class LEMaster(HCIWorker):
                 break
 
             try:
-                i = 0
-                while i < self.num_peers:
-                    helper.create_connection_by_peer_addr(
-                        0, self.peer_addr[i], 12, 0, 1000, 6)
-                    self.log.info('create connection to %s',
-                                  bytes2str(self.peer_addr[i]))
-                    evt = helper.wait_connection_complete()
-                    if evt.status != 0:
-                        raise TestError(
-                            'connection fail: status: 0x{:02x}'.format(
-                                evt.status))
-                    self.conn_handle[i] = evt.conn_handle
-                    self.connected[i] = True
-                    self.log.info('connect to %s', bytes2str(evt.peer_addr))
-                    try:
-                        self.wait(10)  # wait slave connection complete
-                    except HCITimeoutError:
-                        evt = helper.wait_disconnection_complete(
-                            self.conn_handle[i])
-                        if evt.reason == 0x3E:
-                            continue
-                        raise TestError(
-                            'disconnect {} reason 0x{:02x}'.format(
-                                bytes2str(self.peer_addr[i]), evt.reason))
-
-                    time.sleep(0.1)
-                    i += 1
+                # Connect all peers and watch for links failing to be
+                # established (0x3E) for a while after the last one.
+                links = helper.connect(peers, 30, 0.1)
+                self.wait(10)  # wait slave connection complete
 
                 last_i = self.num_peers - 1
+                last_conn_handle = links[peers[last_i]].conn_handle
                 for ce_interval in xrange(13, 37):
                     helper.connection_update(
-                        self.conn_handle[last_i], ce_interval, 0, 1000, 6)
+                        last_conn_handle, ce_interval, 0, 1000, 6)
+                    deadline = Deadline(10)
                     while True:
-                        evt = self.recv_hci_evt(10000)
+                        evt = self.recv_hci_evt(deadline)
                         if (evt.code == bluez.EVT_LE_META_EVENT
                                 and (evt.subevt_code
                                      == bluez.EVT_LE_CONN_UPDATE_COMPLETE)):
@@ -73,33 +52,25 @@ class LEMaster(HCIWorker):
                                         bytes2str(self.peer_addr[last_i]),
                                         evt.status))
                         elif evt.code == bluez.EVT_DISCONN_COMPLETE:
-                            self.connected[last_i] = False
+                            helper.process_evt(evt)
                             raise TestError(
                                 'disconnect {} reason 0x{:02x}'.format(
                                     bytes2str(self.peer_addr[last_i]),
                                     evt.reason))
                     # Make sure no supervision timeout in 10 secs
                     try:
-                        evt = helper.wait_disconnection_complete(None, 10000)
-                        self.connected[last_i] = False
+                        evt = helper.wait_disconnection_complete(None, 10)
+                        helper.process_evt(evt)
                         raise TestError(
                             'disconnect handle 0x{:x} reason 0x{:02x}'.format(
                                 evt.conn_handle, evt.reason))
                     except HCITimeoutError:
                         pass
 
-                for i in xrange(0, self.num_peers):
-                    helper.disconnect(self.conn_handle[i], 0x13)
-                    helper.wait_disconnection_complete(self.conn_handle[i])
-                    self.connected[i] = False
-
+                helper.disconnect_all()
                 succeeded = True
             except (HCICommandError, HCITimeoutError, TestError) as err:
-                for i in xrange(0, self.num_peers):
-                    if self.connected[i]:
-                        helper.disconnect(self.conn_handle[i], 0x13)
-                        helper.wait_disconnection_complete(self.conn_handle[i])
-                        self.connected[i] = False
+                helper.disconnect_all()
                 self.log.warning(str(err), exc_info=True)
                 succeeded = False
             self.send(succeeded)
@@ -173,9 +144,11 @@ class LETester(HCICoordinator):
             for s in slave:
                 s.send(True)
                 self.log.info('tester sends true to %s', bytes2str(s.bd_addr))
+            # The master is signaled once all slaves are connected.
+            for s in slave:
                 s.wait()
                 self.log.info('tester receives from %s', bytes2str(s.bd_addr))
-                self.master.signal()
+            self.master.signal()
 
             print 'run #{}: '.format(i),
             succeeded = self.master.recv()
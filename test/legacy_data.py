@@ -10,7 +10,7 @@ import bluetool.command as btcmd
 import bluetool.event as btevt
 from bluetool.data import HCIACLData
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 HCI_ACL_MAX_SIZE = 27
 NUM_ACL_DATA = 1600
 
@@ -160,7 +160,7 @@ class LegacySlave(HCIWorker):
             except (HCICommandError, TestError):
                 self.log.warning('fail to create connection by white list', exc_info=True)
 
-        helper.wait_disconnection_complete(self.conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(self.conn_handle, CONN_TIMEOUT)
 
 
 class LegacyTester(HCICoordinator):
@@ -1,7 +1,6 @@
 # Test transmitting data after exiting sniff mode
-import time
-
 import bluetool
+from bluetool.clock import sleep
 from bluetool.core import HCICoordinator, HCIWorker, HCIWorkerProxy, HCITask, BREDRHelper
 from bluetool.bluez import ba2str
 from bluetool.error import HCICommandError, TestError, HCITimeoutError
@@ -10,7 +9,7 @@ import bluetool.command as btcmd
 import bluetool.event as btevt
 from bluetool.data import HCIACLData
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 HCI_ACL_MAX_SIZE = 27
 NUM_ACL_DATA = 1600
 
@@ -65,7 +64,7 @@ class LegacyMaster(HCIWorker):
                     if pkt_type == bluez.HCI_ACLDATA_PKT:
                         print i, pkt
                         i = i + 1
-                        self.send(True) # tell that ACL data are successfully received
+                        self.counter('acl_rx').increment() # tell that ACL data are successfully received
                     else:
                         self.log.info('ptype: {}, {}'.format(pkt_type, pkt))
             except (HCICommandError, HCITimeoutError):
@@ -115,13 +114,13 @@ class LegacySlave(HCIWorker):
         helper.sniff_mode(self.conn_handle, 996, 996, 10, 10)
         helper.wait_hci_evt(lambda evt: evt.code == bluez.EVT_MODE_CHANGE)
 
-        time.sleep(20) # Wait to enter LPS
+        sleep(20) # Wait to enter LPS
 
         helper.exit_sniff_mode(self.conn_handle)
         helper.wait_hci_evt(lambda evt: evt.code == bluez.EVT_MODE_CHANGE)
 
         self.wait() # Wait for remote device to exit sniff mode
-        #time.sleep(1)
+        #sleep(1)
         self.send(True) # Signal to send data
 
         while True:
@@ -130,18 +129,22 @@ class LegacySlave(HCIWorker):
                 break
             try:
                 data = self.create_test_acl_data(num_acl_data)
+                acl_rx = self.counter('acl_rx')
+                num_acl_rx = acl_rx.value
                 for d in data:
                     self.send_acl_data(d)
-                    self.wait() # Wait for remote device to receive data
+                    num_acl_rx += 1
+                    acl_rx.wait_ge(num_acl_rx) # Wait for remote device to receive data
             except (HCICommandError, TestError):
                 self.log.warning('fail to create connection by white list', exc_info=True)
 
-        helper.wait_disconnection_complete(self.conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(self.conn_handle, CONN_TIMEOUT)
 
 
 class LegacyTester(HCICoordinator):
     def __init__(self):
         super(LegacyTester, self).__init__()
+        self.add_counter('acl_rx')
         self.worker.append(HCIWorkerProxy(0, self, LegacyMaster))
         self.worker.append(HCIWorkerProxy(1, self, LegacySlave))
         self.worker[0].worker.peer_addr = self.worker[1].bd_addr
@@ -170,9 +173,6 @@ class LegacyTester(HCICoordinator):
         num_acl_data = 100
         self.worker[0].send(num_acl_data)
         self.worker[1].send(num_acl_data)
-        for i in xrange(0, num_acl_data):
-            self.worker[0].recv()
-            self.worker[1].signal()
 
         self.worker[0].send(0)
         self.worker[1].send(0)
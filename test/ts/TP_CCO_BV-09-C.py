@@ -8,7 +8,7 @@ import bluetool.bluez as bluez
 import bluetool.error as bterr
 from bluetool.utils import bytes2str
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 
 
 class IUT(HCIWorker):
@@ -31,7 +31,7 @@ class IUT(HCIWorker):
         helper.wait_le_event(bluez.EVT_LE_DATA_LEN_CHANGE)
 
         helper.disconnect(conn_handle, 0x13)
-        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT)
 
 
 class LowerTester(HCIWorker):
@@ -49,7 +49,7 @@ class LowerTester(HCIWorker):
         self.log.info('connect to %s', bytes2str(evt.peer_addr))
 
         helper.wait_le_event(bluez.EVT_LE_DATA_LEN_CHANGE)
-        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT)
 
 
 class TestManager(HCICoordinator):
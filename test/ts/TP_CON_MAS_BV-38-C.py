@@ -13,7 +13,7 @@ import bluetool.event as btevt
 import bluetool.error as bterr
 from bluetool.utils import bytes2str, htole16
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 
 
 class HCIVendorWriteLocalMaxRxOctets(btcmd.HCIVendorCommand,
@@ -57,7 +57,7 @@ class IUT(HCIDataTransWorker):
         self.wait()  # Wait lower tester to finish data length update
 
         # Send ACL data
-        self.test_acl_trans_send(CONN_TIMEOUT_MS / 1000)
+        self.test_acl_trans_send(CONN_TIMEOUT)
 
         helper.disconnect(conn_handle, 0x13)
         helper.wait_disconnection_complete(conn_handle)
@@ -85,9 +85,9 @@ class LowerTester(HCIDataTransWorker):
         helper.wait_le_event(bluez.EVT_LE_DATA_LEN_CHANGE)
         self.signal()  # Trigger next step
 
-        self.test_acl_trans_recv(CONN_TIMEOUT_MS / 1000)
+        self.test_acl_trans_recv(CONN_TIMEOUT)
 
-        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT)
 
 
 class TestManager(HCIDataTransCoordinator):
@@ -105,7 +105,7 @@ class TestManager(HCIDataTransCoordinator):
 
         acl_list = self.create_test_acl_data(send_conn_handle, 1, 251)
         succeeded = self.test_acl_trans(self.iut, self.lt, recv_conn_handle,
-                                        acl_list, CONN_TIMEOUT_MS / 1000)
+                                        acl_list, CONN_TIMEOUT)
 
         if succeeded:
             return 0
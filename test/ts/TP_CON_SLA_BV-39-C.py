@@ -4,7 +4,7 @@
 # Verify that the IUT as Slave correctly handles communication with a Lower
 # Tester that does not support the Data Length Update Procedure
 
-import time
+from bluetool.clock import sleep
 
 import bluetool
 from bluetool.core import HCIDataTransCoordinator, HCIDataTransWorker, LEHelper
@@ -12,7 +12,7 @@ import bluetool.command as btcmd
 import bluetool.error as bterr
 from bluetool.utils import bytes2str
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 
 
 class IUT(HCIDataTransWorker):
@@ -35,7 +35,7 @@ class IUT(HCIDataTransWorker):
 
         self.wait()  # Wait lower tester to connect and reject LL_LENGTH_REQ
 
-        self.test_acl_trans_send(CONN_TIMEOUT_MS / 1000)
+        self.test_acl_trans_send(CONN_TIMEOUT)
 
         helper.disconnect(conn_handle, 0x13)
         helper.wait_disconnection_complete(conn_handle)
@@ -59,9 +59,9 @@ class LowerTester(HCIDataTransWorker):
 
         self.send(conn_handle)
 
-        self.test_acl_trans_recv(CONN_TIMEOUT_MS / 1000)
+        self.test_acl_trans_recv(CONN_TIMEOUT)
 
-        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT_MS)
+        helper.wait_disconnection_complete(conn_handle, CONN_TIMEOUT)
 
 
 class TestManager(HCIDataTransCoordinator):
@@ -70,12 +70,12 @@ class TestManager(HCIDataTransCoordinator):
 
         send_conn_handle = self.iut.recv()
         recv_conn_handle = self.lt.recv()
-        time.sleep(1)  # Wait for data length update procedure to finish
+        sleep(1)  # Wait for data length update procedure to finish
         self.iut.signal()
 
         acl_list = self.create_test_acl_data(send_conn_handle, 1, 251)
         succeeded = self.test_acl_trans(self.iut, self.lt, recv_conn_handle,
-                                        acl_list, CONN_TIMEOUT_MS / 1000)
+                                        acl_list, CONN_TIMEOUT)
 
         if succeeded:
             return 0
@@ -6,9 +6,9 @@ from bluetool.core import HCICoordinator, HCIWorker, LEHelper
 from bluetool.error import TestError
 import bluetool.bluez as bluez
 import bluetool.command as btcmd
-import time
+from bluetool.clock import sleep
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 
 LTK = '\xbf\x01\xfb\x9d\x4e\xf3\xbc\x36\xd8\x74\xf5\x39\x41\x38\x68\x4c'
 EDIV = 0x2474
@@ -41,7 +41,7 @@ class UpperTester(HCIWorker):
                 'encryption failed: status:{}, enabled:{}'.format(
                     evt.status, evt.enc_enabled))
 
-        time.sleep(60)
+        sleep(60)
         cmd = btcmd.HCIDisconnect(conn_handle, 0x13)
         helper.send_hci_cmd_wait_cmd_status_check_status(cmd)
         helper.wait_disconnection_complete(conn_handle)
@@ -1,8 +1,7 @@
 # Test host and remote device disconnect simultaneously and quickly create
 # connection again.
-import time
-
-from bluetool.core import HCICoordinator, HCIFilter, HCIWorker, HCIWorkerProxy, HCITask
+from bluetool.clock import sleep
+from bluetool.core import HCICoordinator, HCIWorker, HCIWorkerProxy, HCITask
 from bluetool.bluez import ba2str
 from bluetool.error import HCICommandError, TestError
 import bluetool.bluez as bluez
@@ -99,7 +98,6 @@ class LEInitiator(HCIWorker):
         self.peer_addr = peer_addr
 
     def main(self):
-        self.set_hci_filter(HCIFilter(ptypes=bluez.HCI_EVENT_PKT).all_events())
         helper = LEHelper(self.sock)
 
         try:
@@ -132,7 +130,7 @@ class LEInitiator(HCIWorker):
             if not succeeded:
                 continue
 
-            time.sleep(0.1)
+            sleep(0.1)
             try:
                 helper.disconnect(self.conn_handle, 0x13)
                 helper.create_connect_by_white_list(80, None)
@@ -164,7 +162,6 @@ class LEAdvertiser(HCIWorker):
         self.peer_addr = peer_addr
 
     def main(self):
-        self.set_hci_filter(HCIFilter(ptypes=bluez.HCI_EVENT_PKT).all_events())
         helper = LEHelper(self.sock)
 
         try:
@@ -220,10 +217,10 @@ class LEAdvertiser(HCIWorker):
             self.send(succeeded)
 
 class TwoDisconnectTester(HCICoordinator):
-    def __init__(self):
+    def __init__(self, devs=(0, 1)):
         super(TwoDisconnectTester, self).__init__()
-        self.worker.append(HCIWorkerProxy(0, self, LEInitiator))
-        self.worker.append(HCIWorkerProxy(1, self, LEAdvertiser))
+        self.worker.append(HCIWorkerProxy(devs[0], self, LEInitiator))
+        self.worker.append(HCIWorkerProxy(devs[1], self, LEAdvertiser))
         self.worker[0].worker.peer_addr = self.worker[1].bd_addr
         self.worker[1].worker.peer_addr = self.worker[0].bd_addr
 
@@ -1,6 +1,5 @@
 # Test white list add/remove
-import time
-
+from bluetool.clock import sleep
 from bluetool.core import HCICoordinator, HCIFilter, HCIWorker, HCIWorkerProxy, HCITask
 from bluetool.bluez import ba2str
 from bluetool.error import HCICommandError, TestError, HCITimeoutError
@@ -8,7 +7,7 @@ import bluetool.bluez as bluez
 import bluetool.command as btcmd
 import bluetool.event as btevt
 
-CONN_TIMEOUT_MS = 10000
+CONN_TIMEOUT = 10
 
 class LEHelper(HCITask):
     def __init__(self, hci_sock):
@@ -125,7 +124,7 @@ class WhiteListMaster(HCIWorker):
                 self.conn_handle = evt.conn_handle
                 self.log.info('connect to %s', ba2str(evt.peer_addr))
 
-                time.sleep(1)
+                sleep(1)
 
                 try:
                     helper.disconnect(self.conn_handle, 0x13)
@@ -143,7 +142,7 @@ class WhiteListMaster(HCIWorker):
             try:
                 try:
                     helper.create_connect_by_white_list(12)
-                    evt = helper.wait_connection_complete(CONN_TIMEOUT_MS)
+                    evt = helper.wait_connection_complete(CONN_TIMEOUT)
                     if evt.status == 0 and evt.peer_addr == self.peer_addr:
                         helper.disconnect(evt.conn_handle, 0x13)
                         helper.wait_disconnection_complete(evt.conn_handle)
@@ -190,7 +189,7 @@ class WhiteListSlave(HCIWorker):
                 self.log.info('connect to %s', ba2str(evt.peer_addr))
                 helper.stop_advertising()
 
-                helper.wait_disconnection_complete(self.conn_handle, CONN_TIMEOUT_MS)
+                helper.wait_disconnection_complete(self.conn_handle, CONN_TIMEOUT)
                 succeeded = True
             except (HCICommandError, HCITimeoutError):
                 self.log.warning('fail to connect to initiator', exc_info=True)
@@ -202,7 +201,7 @@ class WhiteListSlave(HCIWorker):
             try:
                 try:
                     helper.start_advertising(0xA0)
-                    evt = helper.wait_connection_complete(CONN_TIMEOUT_MS)
+                    evt = helper.wait_connection_complete(CONN_TIMEOUT)
                     if evt.status == 0:
                         helper.wait_disconnection_complete(evt.conn_handle)
                         raise TestError('device not in white list connects to initiator')